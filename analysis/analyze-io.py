@@ -1,15 +1,35 @@
 #!/usr/bin/env python3
 
+import os
+import argparse
 import pandas as pd
 
-df = pd.read_csv('/Users/lpottier/research/projects/active/decaf-work/cori-runs-log/pegasus-io-1000genome.csv')
+import records
 
-df['Size(B)'] = df['Size(B)']/(1024*1024)
-df['MAXRSS(KB)'] = df['MAXRSS(KB)']/(1024*1024)
-df = df.rename(columns={"Size(B)": "Size(MB)", "MAXRSS(KB)": "MAXRSS(GB)"})
+parser = argparse.ArgumentParser(description="I/O and memory footprint of the jobs")
+parser.add_argument('path', nargs='?',
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pegasus-io-1000genome.csv'),
+                    help='CSV with K,Trial,JobID,Size(B),MAXRSS(KB), or a run directory with job records (bin/instrument.py)')
+args = parser.parse_args()
 
-df = df.groupby(['K','Trial']).max()
-df = df.groupby('K').agg(['mean', 'std'])
+if os.path.isdir(args.path):
+    # Bytes read and written by each job (including its children) and its peak RSS, per stage
+    jobs = records.load_records(args.path)
+    df = pd.DataFrame({
+        'Stage': [r['stage'] for r in jobs],
+        'Size(MB)': [(r['bytes_read'] + r['bytes_written'])/(1024*1024) for r in jobs],
+        'MAXRSS(GB)': [r['max_rss']/(1024**3) for r in jobs],
+    })
+    df = df.groupby('Stage').agg(['mean', 'std'])
+else:
+    df = pd.read_csv(args.path)
+
+    df['Size(B)'] = df['Size(B)']/(1024*1024)
+    df['MAXRSS(KB)'] = df['MAXRSS(KB)']/(1024*1024)
+    df = df.rename(columns={"Size(B)": "Size(MB)", "MAXRSS(KB)": "MAXRSS(GB)"})
+
+    df = df.groupby(['K','Trial']).max()
+    df = df.groupby('K').agg(['mean', 'std'])
 
 df[('Size(MB)', 'mean')] = df[('Size(MB)', 'mean')].round(2)
 df[('MAXRSS(GB)', 'mean')] = df[('MAXRSS(GB)', 'mean')].round(2)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import os
+import argparse
 import pandas as pd
 
+import records
+
 def filter_job(row):
     data = row['ID'].split('_')
     if data[0] in ["chmod", "create", "cleanup"]:
@@ -11,9 +15,31 @@ def filter_job(row):
     else:
         return data[0].capitalize()+'_'+data[1].capitalize() 
 
-df = pd.read_csv('/Users/lpottier/research/projects/active/decaf-integration-paper/data/breakdown-1000genome.csv')
-df = df.rename(columns={"Job": "ID", "Duration": "Execution Time (s)"})
-df['Job'] = df.apply(filter_job, axis=1)
+parser = argparse.ArgumentParser(description="Execution time breakdown per job class")
+parser.add_argument('path', nargs='?',
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'breakdown-1000genome.csv'),
+                    help='pegasus-statistics breakdown CSV, or a run directory with job records (bin/instrument.py)')
+args = parser.parse_args()
+
+if os.path.isdir(args.path):
+    # One row per job from its record, one row per job and phase for the phase table
+    jobs = records.load_records(args.path)
+    df = pd.DataFrame({
+        'ID': ['{}_{}'.format(r['stage'], r['pid']) for r in jobs],
+        'Job': [r['stage'].capitalize() for r in jobs],
+        'Execution Time (s)': [r['wall'] for r in jobs],
+    })
+    df_phases = pd.DataFrame([
+        {'Job': r['stage'].capitalize(), 'Phase': name, 'Wall (s)': p['wall'], 'CPU (s)': p['cpu']}
+        for r in jobs for name, p in r['phases'].items()
+    ])
+    if not df_phases.empty:
+        df_phases = df_phases.groupby(['Job', 'Phase']).agg(['mean', 'max']).round(2)
+        print(df_phases.to_markdown(index=True))
+else:
+    df = pd.read_csv(args.path)
+    df = df.rename(columns={"Job": "ID", "Duration": "Execution Time (s)"})
+    df['Job'] = df.apply(filter_job, axis=1)
 
 df_sum = df.groupby('Job').max()
 total_exec = df_sum['Execution Time (s)'].sum()
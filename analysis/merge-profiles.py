@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Merges the profiles of the jobs of a run (bin/profiling.py) by stage.
+#
+# The profiles are named <stage>.<output>.prof (cProfile) or
+# <stage>.<output>.collapsed (py-spy). For each stage, the cProfile stats are
+# added up into <stage>.merged.prof and the sampled stacks into
+# <stage>.merged.collapsed (usable with flamegraph.pl or speedscope), and the
+# hottest functions are printed.
+
+import os
+import sys
+import pstats
+import argparse
+import collections
+
+def find_profiles(run_dir):
+    profiles = collections.defaultdict(lambda: {'.prof': [], '.collapsed': []})
+    for root, dirs, files in os.walk(run_dir):
+        for filename in sorted(files):
+            stem, ext = os.path.splitext(filename)
+            if ext not in ('.prof', '.collapsed') or stem.endswith('.merged'):
+                continue
+            path = os.path.join(root, filename)
+            if os.path.getsize(path) == 0:
+                print("WARNING: {} is empty".format(path), file=sys.stderr)
+                continue
+            profiles[stem.split('.')[0]][ext].append(path)
+    return profiles
+
+def merge_cprofile(stage, files, out_dir, sort, top):
+    stats = pstats.Stats(files[0], stream=sys.stdout)
+    for filename in files[1:]:
+        stats.add(filename)
+    merged = os.path.join(out_dir, '{}.merged.prof'.format(stage))
+    stats.dump_stats(merged)
+    print("= {}: {} cProfile profiles merged into {}".format(stage, len(files), merged))
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+def merge_collapsed(stage, files, out_dir, top):
+    # 'frame;frame;frame count' lines, the counts of the same stack add up
+    stacks = collections.Counter()
+    for filename in files:
+        with open(filename, 'r') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    merged = os.path.join(out_dir, '{}.merged.collapsed'.format(stage))
+    with open(merged, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('{} {}\n'.format(stack, count))
+
+    total = sum(stacks.values())
+    leaves = collections.Counter()
+    for stack, count in stacks.items():
+        leaves[stack.split(';')[-1]] += count
+    print("= {}: {} py-spy profiles ({} samples) merged into {}".format(stage, len(files), total, merged))
+    for frame, count in leaves.most_common(top):
+        print("{:>8} {:6.2f}%  {}".format(count, 100 * count / total, frame))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the job profiles of a run by stage")
+    parser.add_argument('run_dir', help='Directory with the .prof and .collapsed files of the jobs')
+    parser.add_argument('-o', '--output-dir', default=None, help='Directory of the merged profiles (default: run_dir)')
+    parser.add_argument('-s', '--stage', default=None, help='Only merge the profiles of this stage')
+    parser.add_argument('-n', '--top', type=int, default=20, help='Number of functions printed per stage')
+    parser.add_argument('--sort', default='cumulative', help='pstats sort key of the cProfile report')
+    args = parser.parse_args()
+
+    out_dir = args.output_dir or args.run_dir
+    os.makedirs(out_dir, exist_ok=True)
+    for stage, files in sorted(find_profiles(args.run_dir).items()):
+        if args.stage and stage != args.stage:
+            continue
+        if files['.prof']:
+            merge_cprofile(stage, files['.prof'], out_dir, args.sort, args.top)
+        if files['.collapsed']:
+            merge_collapsed(stage, files['.collapsed'], out_dir, args.top)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Collects the job records written by bin/instrument.py in a run directory:
+# the *.stats.json files ($JOBSTATS_DIR) and the '@@jobstats ' lines found in
+# the job outputs (Pegasus .out files, TaskVine task outputs, local runner logs).
+# Prints one JSON record per line, the output can be used as --calibration.
+
+import os
+import sys
+import json
+import argparse
+
+MARKER = '@@jobstats '
+
+def is_output(filename):
+    # Pegasus keeps retries as .out.000, .out.001, ...
+    return filename.endswith(('.stats.json', '.out', '.log', '.err')) or '.out.' in filename
+
+def read_records(filename):
+    records = []
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            if filename.endswith('.stats.json'):
+                line = line.strip()
+            elif line.startswith(MARKER):
+                line = line[len(MARKER):].strip()
+            else:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print("WARNING: invalid record in {}".format(filename), file=sys.stderr)
+    return records
+
+def load_records(run_dir, stage=None):
+    records = {}
+    for root, dirs, files in os.walk(run_dir):
+        for filename in sorted(files):
+            if not is_output(filename):
+                continue
+            for record in read_records(os.path.join(root, filename)):
+                if stage and record.get('stage') != stage:
+                    continue
+                # The same job can be found in its output and in its .stats.json
+                records[(record.get('host'), record.get('pid'), record.get('start'))] = record
+    return sorted(records.values(), key=lambda r: r.get('start', 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect the job records of a run directory")
+    parser.add_argument('run_dir', help='Directory with the job outputs or the *.stats.json files')
+    parser.add_argument('-s', '--stage', default=None, help='Only keep the records of this stage')
+    args = parser.parse_args()
+
+    for record in load_records(args.run_dir, args.stage):
+        print(json.dumps(record, sort_keys=True))
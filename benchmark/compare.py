@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Compares the results of run.py for two versions: median wall time of every
+# stage and size, and their ratio. Exits with status 1 when a stage got slower
+# than --threshold, so it can gate a change.
+
+import os
+import sys
+import json
+import argparse
+import statistics
+
+
+def load_results(path, results_dir):
+    # A results file or the name of a version in results_dir
+    if not os.path.exists(path):
+        path = os.path.join(results_dir, '{}.jsonl'.format(path))
+    walls = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = (record['stage'], record['samples'], record['lines'])
+            walls.setdefault(key, []).append(record['wall'])
+    return {key: statistics.median(values) for key, values in walls.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the benchmark results of two versions")
+    parser.add_argument('baseline', help='Results file or version of the reference')
+    parser.add_argument('candidate', help='Results file or version to compare')
+    parser.add_argument('-t', '--threshold', type=float, default=1.10,
+                        help='Ratio candidate/baseline above which a stage is reported as a regression')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'),
+                        help='Directory of the results')
+    args = parser.parse_args()
+
+    baseline = load_results(args.baseline, args.results)
+    candidate = load_results(args.candidate, args.results)
+
+    regressions = 0
+    print("{:<18} {:>8} {:>8} {:>12} {:>12} {:>7}".format('stage', 'samples', 'lines', 'baseline (s)', 'candidate (s)', 'ratio'))
+    for key in sorted(set(baseline) & set(candidate)):
+        ratio = candidate[key] / baseline[key] if baseline[key] > 0 else float('inf')
+        flag = ''
+        if ratio > args.threshold:
+            flag = ' <- slower'
+            regressions += 1
+        elif ratio < 1 / args.threshold:
+            flag = ' <- faster'
+        print("{:<18} {:>8} {:>8} {:>12.3f} {:>12.3f} {:>7.2f}{}".format(
+            key[0], key[1], key[2], baseline[key], candidate[key], ratio, flag))
+
+    missing = set(baseline) ^ set(candidate)
+    if missing:
+        print("{} stage/size pairs are only measured in one of the versions".format(len(missing)))
+    sys.exit(1 if regressions else 0)
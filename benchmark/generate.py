@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Synthetic inputs for the 1000 genome workflow, generated offline.
+#
+# The files follow the layout of the real data so that every stage runs
+# unmodified on them:
+#   data/<dataset>/ALL.chr<c>.<lines>.vcf        phased genotypes, INFO with the
+#                                               super population AFs (EUR_AF is
+#                                               the 9th field, as in phase 3)
+#   data/<dataset>/columns.txt                  header line of the VCFs
+#   data/<dataset>/sifting/ALL.chr<c>.annotation.vcf
+#                                               VEP annotations, the ENSG id, SIFT
+#                                               and PolyPhen scores are the 5th,
+#                                               17th and 18th '|' fields
+#   data/populations/{ALL,AFR,AMR,EAS,EUR,GBR,SAS}
+#   data.csv                                    vcf,number of lines,annotation
+#   bin -> the bin/ directory of this repository
+# so the output directory can be given as --src-path to local_genomes.py.
+
+import os
+import argparse
+
+import numpy as np
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+HEADER = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+SUPER_POPULATIONS = ['AFR', 'AMR', 'EAS', 'EUR', 'SAS']
+MIN_POPULATION = 26  # mutation_overlap samples groups of 26 individuals
+BASES = np.array(list('ACGT'))
+GENOTYPES = np.array(['0|0', '0|1', '1|0', '1|1'])
+
+META = [
+    '##fileformat=VCFv4.1',
+    '##source=1000genome-workflow benchmark/generate.py',
+    '##INFO=<ID=AF,Number=A,Type=Float,Description="Estimated allele frequency in the range (0,1)">',
+    '##INFO=<ID=EUR_AF,Number=A,Type=Float,Description="Allele frequency in the EUR populations calculated from AC and AN, in the range (0,1)">',
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+]
+
+def sample_names(n_samples):
+    return ['HG{:05d}'.format(i) for i in range(n_samples)]
+
+def write_populations(pop_dir, names, rng):
+    os.makedirs(pop_dir, exist_ok=True)
+    populations = {'ALL': names}
+    groups = np.array_split(rng.permutation(len(names)), len(SUPER_POPULATIONS))
+    for pop, group in zip(SUPER_POPULATIONS, groups):
+        members = [names[i] for i in sorted(group)]
+        populations[pop] = members
+    populations['GBR'] = populations['EUR'][:len(populations['EUR']) // 2]
+
+    for pop, members in populations.items():
+        # Small runs still need groups of 26 individuals in every population
+        if len(members) < MIN_POPULATION:
+            others = [n for n in names if n not in set(members)]
+            extra = rng.choice(len(others), MIN_POPULATION - len(members), replace=False)
+            members = sorted(members + [others[i] for i in extra])
+        with open(os.path.join(pop_dir, pop), 'w') as f:
+            f.write('\n'.join(members) + '\n')
+
+def allele_frequencies(rng, n):
+    # Most variants are rare, as in the real data
+    return np.round(rng.beta(0.3, 2.0, size=n), 4)
+
+def info_field(rng, af, multi):
+    pops = allele_frequencies(rng, len(SUPER_POPULATIONS))
+    eur = pops[SUPER_POPULATIONS.index('EUR')]
+    if multi:
+        af = '{},{}'.format(af, round(af / 10, 4))
+        eur = '{},{}'.format(eur, round(eur / 10, 4))
+    return 'AC={};AF={};AN=5008;NS=2504;DP={};EAS_AF={};AMR_AF={};AFR_AF={};EUR_AF={};SAS_AF={};AA=.|||;VT=SNP'.format(
+        int(float(str(af).split(',')[0]) * 5008), af, rng.integers(5000, 30000),
+        pops[2], pops[1], pops[0], eur, pops[4])
+
+def write_vcf(filename, c, names, n_lines, rng, block=1000):
+    # n_lines includes the header, as in data.csv
+    n_variants = n_lines - len(META) - 1
+    columns = '\t'.join(HEADER + names)
+    with open(filename, 'w') as f:
+        f.write('\n'.join(META) + '\n' + columns + '\n')
+        pos = 10000
+        for start in range(0, n_variants, block):
+            n = min(block, n_variants - start)
+            afs = allele_frequencies(rng, n)
+            # Both haplotypes carry the ALT allele with probability AF
+            alleles = rng.random((n, len(names), 2)) < afs[:, None, None]
+            codes = 2 * alleles[:, :, 0] + alleles[:, :, 1]
+            refs = rng.integers(0, 4, n)
+            alts = (refs + rng.integers(1, 4, n)) % 4
+            multi = rng.random(n) < 0.02
+            for k in range(n):
+                pos += int(rng.integers(1, 500))
+                alt = BASES[alts[k]] + (',' + BASES[(alts[k] + 1) % 4] if multi[k] and (alts[k] + 1) % 4 != refs[k] else '')
+                row = [str(c), str(pos), 'rs{}'.format(start + k + 1), BASES[refs[k]], alt, '100', 'PASS',
+                       info_field(rng, afs[k], ',' in alt), 'GT']
+                f.write('\t'.join(row) + '\t' + '\t'.join(GENOTYPES[codes[k]]) + '\n')
+    return columns
+
+def write_annotations(filename, c, n_variants, rng, fraction=0.3):
+    # VEP-like CSQ records for a fraction of the variants, most of them with SIFT scores
+    with open(filename, 'w') as f:
+        f.write('##fileformat=VCFv4.1\n##VEP="v83"\n')
+        f.write('\t'.join(HEADER[:8]) + '\n')
+        annotated = np.sort(rng.choice(n_variants, int(n_variants * fraction), replace=False)) + 1
+        for rs in annotated:
+            csq = ['A', 'missense_variant', 'MODERATE', 'GENE{}'.format(rs // 50),
+                   'ENSG{:011d}'.format(rs // 50), 'Transcript', 'ENST{:011d}'.format(rs),
+                   'protein_coding'] + [''] * 8
+            score = rng.random()
+            if score < 0.8:
+                sift = 'deleterious' if score < 0.3 else 'tolerated'
+                csq += ['{}({:.2f})'.format(sift, rng.random()),
+                        '{}({:.3f})'.format('probably_damaging' if score < 0.3 else 'benign', rng.random())]
+            else:
+                csq += ['', '']
+            f.write('{}\t{}\trs{}\tA\tG\t.\t.\tCSQ={}\n'.format(c, 10000 + rs, rs, '|'.join(csq)))
+
+def generate(out_dir, n_samples, n_lines, chromosomes=1, dataset='20130502', seed=1):
+    if n_samples < MIN_POPULATION:
+        raise ValueError('at least {} samples are needed, got {}'.format(MIN_POPULATION, n_samples))
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(out_dir, 'data', dataset)
+    os.makedirs(os.path.join(data_dir, 'sifting'), exist_ok=True)
+    names = sample_names(n_samples)
+
+    rows = []
+    for c in range(1, chromosomes + 1):
+        vcf = 'ALL.chr{}.{}.vcf'.format(c, n_lines)
+        annotation = 'ALL.chr{}.annotation.vcf'.format(c)
+        print("= Generating {} ({} samples x {} lines)".format(vcf, n_samples, n_lines))
+        columns = write_vcf(os.path.join(data_dir, vcf), c, names, n_lines, rng)
+        write_annotations(os.path.join(data_dir, 'sifting', annotation), c, n_lines - len(META) - 1, rng)
+        rows.append('{},{},{}'.format(vcf, n_lines, annotation))
+
+    with open(os.path.join(data_dir, 'columns.txt'), 'w') as f:
+        f.write(columns + '\n')
+    write_populations(os.path.join(out_dir, 'data', 'populations'), names, rng)
+    with open(os.path.join(out_dir, 'data.csv'), 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+
+    if not os.path.lexists(os.path.join(out_dir, 'bin')):
+        os.symlink(BIN_DIR, os.path.join(out_dir, 'bin'))
+    return out_dir
+
+def prepare_inputs(inputs_dir, n_samples, n_lines):
+    # Inputs of a size are generated once and reused
+    src_path = os.path.join(inputs_dir, '{}x{}'.format(n_samples, n_lines))
+    if not os.path.exists(os.path.join(src_path, 'data.csv')):
+        generate(src_path, n_samples, n_lines)
+    return src_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic 1000 genome inputs")
+    parser.add_argument('out_dir', help='Output directory (usable as --src-path)')
+    parser.add_argument('-n', '--samples', type=int, default=100, help='Number of samples (columns)')
+    parser.add_argument('-l', '--lines', type=int, default=10000, help='Number of lines of each VCF')
+    parser.add_argument('-c', '--chromosomes', type=int, default=1, help='Number of chromosomes')
+    parser.add_argument('-D', '--dataset', default='20130502', help='Dataset folder')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    generate(args.out_dir, args.samples, args.lines, args.chromosomes, args.dataset, args.seed)
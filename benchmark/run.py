@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Times every stage of the workflow on synthetic inputs of several sizes.
+#
+# For each size SAMPLESxLINES, the inputs are generated once (generate.py) and
+# kept under --inputs. Each repetition runs the stages one after the other in a
+# fresh directory, as separate processes: the individuals jobs (-i per
+# chromosome), individuals_merge, sifting, then mutation_overlap and frequency
+# for one population. The results are appended as JSON lines to
+# <results>/<version>.jsonl, the version being the git description of the tree,
+# so that compare.py can show the differences between two versions.
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+import generate
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import job_planner
+
+STAGES = ['individuals', 'individuals_merge', 'sifting', 'mutation_overlap', 'frequency']
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def parse_size(value):
+    try:
+        samples, lines = (int(x) for x in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size {}, expected SAMPLESxLINES'.format(value))
+    return samples, lines
+
+def run_job(run_dir, stage, args, inputs):
+    # One job of a stage, in run_dir, returns its wall time and its record (bin/instrument.py)
+    for path in inputs:
+        link = os.path.join(run_dir, os.path.basename(path))
+        if not os.path.lexists(link):
+            os.symlink(path, link)
+
+    stats_dir = os.path.join(run_dir, 'stats', stage)
+    env = dict(os.environ, JOBSTATS_DIR=stats_dir)
+    log = os.path.join(run_dir, '{}.log'.format(stage))
+    tic = time.perf_counter()
+    with open(log, 'a') as f:
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, 'bin', stage + '.py')] + [str(a) for a in args],
+                       cwd=run_dir, env=env, stdout=f, stderr=subprocess.STDOUT, check=True)
+    wall = time.perf_counter() - tic
+
+    record = {}
+    if os.path.isdir(stats_dir):
+        # The newest record is the one of this job
+        files = sorted(os.listdir(stats_dir), key=lambda n: os.path.getmtime(os.path.join(stats_dir, n)))
+        with open(os.path.join(stats_dir, files[-1]), 'r') as f:
+            record = json.loads(f.readline())
+    return wall, record
+
+def run_stages(src_path, stages, ind_jobs, population, work_dir):
+    # Returns {stage: (wall, cpu, max_rss, phases)} for one repetition
+    data_dir = os.path.join(src_path, 'data', '20130502')
+    columns = os.path.join(data_dir, 'columns.txt')
+    f_pop = os.path.join(src_path, 'data', 'populations', population)
+    with open(os.path.join(src_path, 'data.csv'), 'r') as f:
+        vcf, total, annotation = f.readline().strip().split(',')
+    total = int(total)
+    c = vcf[vcf.find('chr')+3:]
+    c = c[0:c.find('.')]
+
+    run_dir = tempfile.mkdtemp(prefix='bench-', dir=work_dir)
+    results = {}
+
+    def add(stage, wall, record):
+        result = results.setdefault(stage, {'wall': 0.0, 'cpu': 0.0, 'max_rss': 0, 'phases': {}})
+        result['wall'] += wall
+        result['cpu'] += record.get('cpu', 0.0)
+        result['max_rss'] = max(result['max_rss'], record.get('max_rss', 0))
+        for name, phase in record.get('phases', {}).items():
+            result['phases'][name] = result['phases'].get(name, 0.0) + phase['wall']
+
+    try:
+        # Stages depending on skipped ones still need their inputs
+        chunks = job_planner.split_lines(total, ind_jobs)
+        archives = []
+        for counter, stop in chunks:
+            archives.append('chr{}n-{}-{}.tar.gz'.format(c, counter, stop))
+            wall, record = run_job(run_dir, 'individuals', [vcf, c, counter, stop, total],
+                                   [os.path.join(data_dir, vcf), columns])
+            if 'individuals' in stages:
+                add('individuals', wall, record)
+
+        wall, record = run_job(run_dir, 'individuals_merge', [c] + archives, [])
+        if 'individuals_merge' in stages:
+            add('individuals_merge', wall, record)
+
+        wall, record = run_job(run_dir, 'sifting', [annotation, c],
+                               [os.path.join(data_dir, 'sifting', annotation)])
+        if 'sifting' in stages:
+            add('sifting', wall, record)
+
+        for stage in ('mutation_overlap', 'frequency'):
+            if stage in stages:
+                wall, record = run_job(run_dir, stage, ['-c', c, '-pop', population], [f_pop, columns])
+                add(stage, wall, record)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of the workflow on synthetic inputs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('-s', '--size', type=parse_size, action='append', default=None, metavar='SAMPLESxLINES',
+                        help='Input size (repeatable, default: 100x2000 and 500x10000)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of repetitions of each size')
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated list of the stages to time')
+    parser.add_argument('-i', '--individuals-jobs', dest='ind_jobs', type=int, default=2,
+                        help='Number of individuals jobs of the chromosome')
+    parser.add_argument('-P', '--population', default='GBR', help='Population of the analysis jobs')
+    parser.add_argument('--inputs', default=os.path.join(bench_dir, 'inputs'), help='Directory of the generated inputs')
+    parser.add_argument('--results', default=os.path.join(bench_dir, 'results'), help='Directory of the results')
+    parser.add_argument('-w', '--work-dir', default=None, help='Directory where the stages run (default: system temporary directory)')
+    parser.add_argument('--version', default=None, help='Name of the results (default: git describe of the tree)')
+    args = parser.parse_args()
+
+    sizes = args.size or [(100, 2000), (500, 10000)]
+    stages = [s for s in args.stages.split(',') if s]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage {}'.format(stage))
+    version = args.version or git_version()
+
+    os.makedirs(args.results, exist_ok=True)
+    results_file = os.path.join(args.results, '{}.jsonl'.format(version))
+    print("= Benchmarking version {}, results in {}".format(version, results_file))
+
+    summary = {}
+    for samples, lines in sizes:
+        src_path = generate.prepare_inputs(args.inputs, samples, lines)
+        for repeat in range(args.repeat):
+            print("== {} samples x {} lines, run {}/{}".format(samples, lines, repeat + 1, args.repeat))
+            results = run_stages(src_path, stages, args.ind_jobs, args.population, args.work_dir)
+            with open(results_file, 'a') as f:
+                for stage, result in results.items():
+                    record = dict(result, version=version, stage=stage, samples=samples, lines=lines,
+                                  ind_jobs=args.ind_jobs, population=args.population, repeat=repeat,
+                                  host=socket.gethostname(), date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+                    summary.setdefault((stage, samples, lines), []).append(result['wall'])
+
+    print("{:<18} {:>8} {:>8} {:>12} {:>8}".format('stage', 'samples', 'lines', 'median (s)', 'stdev'))
+    for (stage, samples, lines), walls in sorted(summary.items(), key=lambda x: (STAGES.index(x[0][0]), x[0][1:])):
+        stdev = statistics.stdev(walls) if len(walls) > 1 else 0.0
+        print("{:<18} {:>8} {:>8} {:>12.3f} {:>8.3f}".format(stage, samples, lines, statistics.median(walls), stdev))
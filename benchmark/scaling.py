@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Scaling study of the individuals and individuals_merge stages.
+#
+# Runs the individuals jobs and the merge of each chromosome with
+# local_genomes.py for a sweep of individuals job counts (-i) and worker counts
+# (-j), and reports the makespan, the individuals and merge job times and the
+# I/O volume of each point (from the job records of bin/instrument.py).
+#   strong: same input for every point, every -i with every -j
+#   weak:   the number of lines grows with -i (--size gives the lines per job)
+#           and each point runs with as many workers as jobs
+# The inputs are either a source tree (-p, e.g. the real data) or synthetic
+# inputs generated for --size.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import generate
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'analysis'))
+import local_genomes
+import records
+
+STAGES = ['individuals', 'individuals_merge']
+
+
+def parse_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+def run_point(src_path, ind_jobs, workers, work_dir):
+    workflow = local_genomes.LocalWorkflow(
+        datafile=os.path.join(src_path, 'data.csv'),
+        ind_jobs=ind_jobs,
+        src_path=src_path,
+    )
+    workflow.create_workflow()
+    # Only the individuals jobs and the merges are timed
+    workflow.tasks = {name: task for name, task in workflow.tasks.items() if task.stage in STAGES}
+
+    run_dir = tempfile.mkdtemp(prefix='scaling-', dir=work_dir)
+    stats_dir = os.path.join(run_dir, 'stats')
+    try:
+        tic = time.perf_counter()
+        workflow.run(run_dir, os.path.join(run_dir, 'output'), workers, {}, stats_dir)
+        makespan = time.perf_counter() - tic
+        jobs = records.load_records(stats_dir)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    individuals = [r['wall'] for r in jobs if r['stage'] == 'individuals']
+    merges = [r['wall'] for r in jobs if r['stage'] == 'individuals_merge']
+    return {
+        'ind_jobs': ind_jobs,
+        'workers': workers,
+        'makespan': makespan,
+        'individuals_mean': sum(individuals) / len(individuals),
+        'individuals_max': max(individuals),
+        'merge': max(merges),
+        'io_mb': sum(r['bytes_read'] + r['bytes_written'] for r in jobs) / (1024 * 1024),
+        'max_rss_gb': max(r['max_rss'] for r in jobs) / 1024**3,
+    }
+
+def report(points, mode):
+    reference = points[0]['makespan']
+    print("{:>5} {:>7} {:>12} {:>12} {:>12} {:>10} {:>10} {:>8} {:>10}".format(
+        '-i', 'workers', 'makespan (s)', 'ind mean (s)', 'ind max (s)', 'merge (s)', 'I/O (MB)', 'RSS (GB)',
+        'speedup' if mode == 'strong' else 'efficiency'))
+    for p in points:
+        scale = reference / p['makespan']
+        print("{:>5} {:>7} {:>12.2f} {:>12.2f} {:>12.2f} {:>10.2f} {:>10.1f} {:>8.2f} {:>10.2f}".format(
+            p['ind_jobs'], p['workers'], p['makespan'], p['individuals_mean'], p['individuals_max'],
+            p['merge'], p['io_mb'], p['max_rss_gb'], scale))
+
+    if mode == 'strong':
+        # Best fan-out for each number of workers
+        for workers in sorted({p['workers'] for p in points}):
+            best = min((p for p in points if p['workers'] == workers), key=lambda p: p['makespan'])
+            print("== {} workers: best with -i {} ({:0.2f} sec)".format(workers, best['ind_jobs'], best['makespan']))
+        best = min(points, key=lambda p: p['makespan'])
+        print("= Best fan-out: -i {} with {} workers ({:0.2f} sec)".format(
+            best['ind_jobs'], best['workers'], best['makespan']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Strong and weak scaling of the individuals and merge stages",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('mode', choices=['strong', 'weak'], help='Scaling study')
+    parser.add_argument('-p', '--src-path', default=None,
+                        help='Source tree with data.csv and data/ (default: synthetic inputs of --size)')
+    parser.add_argument('-s', '--size', default='500x20000', metavar='SAMPLESxLINES',
+                        help='Synthetic input size (lines per individuals job in weak mode)')
+    parser.add_argument('-i', '--individuals-jobs', dest='ind_jobs', type=parse_list, default='1,2,4,8,16',
+                        help='Comma separated individuals job counts')
+    parser.add_argument('-j', '--workers', type=parse_list, default='1,2,4,8',
+                        help='Comma separated worker counts (strong mode)')
+    parser.add_argument('--inputs', default=os.path.join(bench_dir, 'inputs'), help='Directory of the generated inputs')
+    parser.add_argument('-w', '--work-dir', default=None, help='Directory where the jobs run (default: /dev/shm or the temporary directory)')
+    parser.add_argument('-o', '--output', default=None, help='Append the measures to this file (JSON lines)')
+    args = parser.parse_args()
+
+    samples, lines = (int(x) for x in args.size.lower().split('x'))
+    work_dir = args.work_dir
+    if work_dir is None and os.access('/dev/shm', os.W_OK):
+        work_dir = '/dev/shm'
+
+    points = []
+    if args.mode == 'strong':
+        src_path = args.src_path or generate.prepare_inputs(args.inputs, samples, lines)
+        for workers in args.workers:
+            for ind_jobs in args.ind_jobs:
+                print("== -i {} with {} workers".format(ind_jobs, workers))
+                points.append(run_point(src_path, ind_jobs, workers, work_dir))
+    else:
+        if args.src_path:
+            parser.error('weak scaling needs synthetic inputs, whose size grows with -i')
+        for ind_jobs in args.ind_jobs:
+            size = lines * ind_jobs
+            src_path = generate.prepare_inputs(args.inputs, samples, size)
+            print("== -i {} with {} workers, {} lines".format(ind_jobs, ind_jobs, size))
+            points.append(run_point(src_path, ind_jobs, ind_jobs, work_dir))
+
+    report(points, args.mode)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for p in points:
+                f.write(json.dumps(dict(p, mode=args.mode, samples=samples, lines=lines), sort_keys=True) + '\n')
@@ -24,12 +24,25 @@ from pylab import pcolor, show, colorbar, xticks, yticks
 from matplotlib import pyplot
 import matplotlib as mpl
 
+import instrument
+import profiling
+
 c_help = 'type a chromosome 1-22'
 pop_help = 'type a population 0-6; 0:ALL, 1:EUR, 2:EAS, 3:AFR, 4:AMR, 5:SAS, 6:GBR'
+cache_help = 'node-local genotype cache directory (default: $GENOTYPE_CACHE_DIR, disabled if unset)'
+budget_help = 'disk budget of the genotype cache in bytes'
+matrix_help = 'chr<c>n.npz sparse matrix of individuals_merge.py --format csr, instead of chr<c>n.tar.gz'
+shards_help = 'layout of sample_shards.py, the chr<c>n.<shard>.tar.gz holding the population are read instead of chr<c>n.tar.gz'
 description = 'Process mutation sets (-c and -POP are required).'
 parser = argparse.ArgumentParser(description=description)
 parser.add_argument("-c", type=int, help=c_help)
 parser.add_argument("-pop", help=pop_help)
+parser.add_argument("--cache-dir", default=os.environ.get('GENOTYPE_CACHE_DIR'), help=cache_help)
+parser.add_argument("--cache-budget", type=int, default=os.environ.get('GENOTYPE_CACHE_BUDGET', 16 * 1024**3),
+                    help=budget_help)
+parser.add_argument("--matrix", default=None, help=matrix_help)
+parser.add_argument("--shards", default=None, help=shards_help)
+profiling.parse_argv()
 args = parser.parse_args()
 c = args.c
 
@@ -60,9 +73,21 @@ plt.rc('font', **font)
 # untar input data
 import tarfile
 
-tar = tarfile.open(chrom + 'n.tar.gz')
-tar.extractall(path='./' + chrom + 'n')
-tar.close()
+
+def extract_individuals():
+    archives = [chrom + 'n.tar.gz']
+    if args.shards:
+        # Only the shards holding samples of the population (sample_shards.py)
+        import sample_shards
+        with open(pop_dir + POP, 'r') as f:
+            samples = f.read().split()
+        layout = sample_shards.load(args.shards)
+        archives = [sample_shards.archive_name(chrom + 'n.tar.gz', shard)
+                    for shard in sample_shards.shards_of(layout, samples)]
+    for archive in archives:
+        tar = tarfile.open(archive)
+        tar.extractall(path='./' + chrom + 'n')
+        tar.close()
 
 
 class ReadData:
@@ -108,6 +133,15 @@ class ReadData:
     def read_individuals(self, ids, rs_numbers):
         print('reading in individual mutation files')
         tic = time.perf_counter()
+        if args.matrix:
+            mutation_index_array = self.read_matrix_individuals(ids, rs_numbers)
+            print('time: %s' % (time.perf_counter() - tic))
+            return mutation_index_array
+        if args.cache_dir:
+            mutation_index_array = self.read_cached_individuals(ids)
+            print('time: %s' % (time.perf_counter() - tic))
+            return mutation_index_array
+
         mutation_index_array = []
         for name in ids:
             filename = data_dir + chrom + 'n/' + chrom + '.' + name
@@ -125,6 +159,19 @@ class ReadData:
         print('time: %s' % (time.perf_counter() - tic))
         return mutation_index_array
 
+    def read_cached_individuals(self, ids):
+        # The sifted rs numbers of each individual come from the node-local genotype matrix
+        import genotype_cache
+        cache = genotype_cache.GenotypeCache(args.cache_dir, budget=args.cache_budget)
+        matrix, samples, variants = cache.load(chrom + 'n.tar.gz', siftfile, data_dir + 'columns.txt')
+        return genotype_cache.mutation_index_array(matrix, samples, variants, ids)
+
+    def read_matrix_individuals(self, ids, rs_numbers):
+        # Population rows and SIFT columns of the sparse individuals x variants matrix
+        import variant_matrix
+        self.genotypes, self.variants = variant_matrix.VariantMatrix.load(args.matrix).genotypes(ids, rs_numbers)
+        return variant_matrix.mutation_index_array(self.genotypes, self.variants)
+
 
 class Results:
 
@@ -151,6 +198,23 @@ class Results:
         print('time: %s' % (time.perf_counter() - tic))
         return mutation_overlap, random_indiv
 
+    def overlap_matrix(self, ids, genotypes, variants):
+        n_p = len(genotypes)
+        print('calculating the number overlapings mutations between %s individuals selected randomly (matrix)' % n_p)
+        tic = time.perf_counter()
+        list_p = np.linspace(0, n_p - 1, n_p).astype(int)
+        mutation_overlap = []
+        random_indiv = []
+        for run in range(n_runs):
+            randomized_list = sample(list(list_p), n_p)
+            # same individuals as overlap_ind, their rows are summed up
+            rows = randomized_list[0:2 * n_indiv:2]
+            counts = genotypes[rows].sum(axis=0, dtype=np.int64)
+            random_indiv.append([ids[r] for r in rows])
+            mutation_overlap.append(Counter({variants[k]: int(counts[k]) for k in np.flatnonzero(counts)}))
+        print('time: %s' % (time.perf_counter() - tic))
+        return mutation_overlap, random_indiv
+
     def histogram_overlap(self, mutation_overlap):
         print('calculating the frequency/historgram of overlapings mutations')
         tic = time.perf_counter()
@@ -268,26 +332,44 @@ if __name__ == '__main__':
     randomindiv_file = outdata_dir + 'random_indiv' + str(c) + '_s' + \
                        str(SIFT) + '_' + POP + '_'
 
-    ids = rd.read_names(POP)
-    n_pairs = len(ids) / 2
+    profiling.start('frequency', 'chr{}-{}-freq'.format(c, POP))
+    stats = instrument.JobStats('frequency', chromosome=str(c), population=POP,
+                                cached=bool(args.cache_dir), matrix=bool(args.matrix))
+
+    with stats.phase('read'):
+        if not args.cache_dir and not args.matrix:
+            extract_individuals()
+
+        ids = rd.read_names(POP)
+        n_pairs = len(ids) / 2
 
-    rs_numbers, map_variations = rd.read_rs_numbers(siftfile)
-    mutation_index_array = rd.read_individuals(ids, rs_numbers)
+        rs_numbers, map_variations = rd.read_rs_numbers(siftfile)
+        mutation_index_array = rd.read_individuals(ids, rs_numbers)
+    stats.set(samples=len(ids), variants=len(rs_numbers))
 
-    wr.write_map_variations(map_variations_file, map_variations)
-    wr.write_mutation_index_array(mutation_index_array_file, mutation_index_array)
+    with stats.phase('write'):
+        wr.write_map_variations(map_variations_file, map_variations)
+        wr.write_mutation_index_array(mutation_index_array_file, mutation_index_array)
 
-    mutation_overlap, random_indiv = res.overlap_ind(ids, mutation_index_array)
-    histogram_overlap = res.histogram_overlap(mutation_overlap)
+    with stats.phase('compute'):
+        if args.matrix:
+            mutation_overlap, random_indiv = res.overlap_matrix(ids, rd.genotypes, rd.variants)
+        else:
+            mutation_overlap, random_indiv = res.overlap_ind(ids, mutation_index_array)
+        histogram_overlap = res.histogram_overlap(mutation_overlap)
 
-    wr.write_mutation_overlap(mutation_overlapfile, mutation_overlap)
-    wr.write_histogram_overlap(histogram_overlapfile, histogram_overlap)
-    wr.write_random_indiv(randomindiv_file, random_indiv)
+    with stats.phase('write'):
+        wr.write_mutation_overlap(mutation_overlapfile, mutation_overlap)
+        wr.write_histogram_overlap(histogram_overlapfile, histogram_overlap)
+        wr.write_random_indiv(randomindiv_file, random_indiv)
 
-    pd.plot_histogram_overlap(POP, histogram_overlap, histogram_overlap_plot)
+    with stats.phase('plot'):
+        pd.plot_histogram_overlap(POP, histogram_overlap, histogram_overlap_plot)
 
     # gen final output
-    tar = tarfile.open('chr%s-%s-freq.tar.gz' % (c, POP), 'w:gz')
-    tar.add(outdata_dir)
-    tar.add(plot_dir)
-    tar.close()
+    with stats.phase('compress'):
+        tar = tarfile.open('chr%s-%s-freq.tar.gz' % (c, POP), 'w:gz')
+        tar.add(outdata_dir)
+        tar.add(plot_dir)
+        tar.close()
+    stats.emit()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Node-local cache of the individuals x SIFT-variants matrix used by
+# mutation_overlap.py and frequency.py.
+#
+# Every analysis job of a chromosome rebuilds the same data from the text
+# files inside chr{c}n.tar.gz. With the cache, the first job landing on a node
+# builds a read-only uint8 matrix (rows: samples from columns.txt, columns:
+# rs numbers of sifted.SIFT.chr{c}.txt) and the following jobs simply map it.
+#
+#   <cache_dir>/<key>/matrix.npy    rows x variants, 1 if the sample carries it
+#   <cache_dir>/<key>/samples.txt   one sample name per row
+#   <cache_dir>/<key>/variants.txt  one rs number per column
+#
+# The key is derived from the checksums of the archive and of the sifted file.
+# Entries are built in a temporary directory and renamed in place, the build
+# itself is serialized with a lock file so concurrent jobs never build twice.
+# Entries are evicted least recently used first once the cache is larger than
+# its disk budget. Jobs hold a shared lock on an entry (<key>.lock) from the
+# moment they find it until its matrix is mapped, and eviction skips the
+# entries it cannot lock exclusively. The lock of an entry is deleted with it.
+
+import os
+import sys
+import time
+import fcntl
+import shutil
+import hashlib
+import tarfile
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_BUDGET = 16 * 1024**3
+
+def checksum(filename, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def readfile(filename):
+    with open(filename, 'r') as f:
+        content = f.read().split()
+    return content
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+class FileLock(object):
+    # Exclusive by default, shared readers with shared=True; raises BlockingIOError
+    # instead of waiting with blocking=False. The lock file may be deleted by its
+    # exclusive holder (evict), the lock is then taken again on the new file
+    def __init__(self, filename, shared=False, blocking=True):
+        self.filename = filename
+        self.shared = shared
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            self.fd = os.open(self.filename, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(self.fd, flags)
+                if os.path.samestat(os.fstat(self.fd), os.stat(self.filename)):
+                    return self
+            except FileNotFoundError:
+                pass
+            except OSError:
+                os.close(self.fd)
+                self.fd = None
+                raise
+            # Deleted while we were waiting for it
+            os.close(self.fd)
+            self.fd = None
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+class GenotypeCache(object):
+    def __init__(self, cache_dir, budget=DEFAULT_CACHE_BUDGET):
+        self.cache_dir = cache_dir
+        self.budget = int(budget)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, archive, siftfile):
+        h = hashlib.sha256()
+        h.update(checksum(archive).encode())
+        h.update(checksum(siftfile).encode())
+        return h.hexdigest()[:32]
+
+    def load(self, archive, siftfile, columfile):
+        tic = time.perf_counter()
+        key = self.key(archive, siftfile)
+        entry = os.path.join(self.cache_dir, key)
+
+        # The entry is only used under a shared lock, evict() takes it exclusively: it is
+        # never deleted between the check and the mapping, which outlives the entry
+        built = False
+        while True:
+            with FileLock(entry + '.lock', shared=True):
+                if os.path.isdir(entry):
+                    # LRU bookkeeping: the mtime of the entry is its last use
+                    os.utime(entry)
+                    matrix = np.load(os.path.join(entry, 'matrix.npy'), mmap_mode='r')
+                    samples = readfile(os.path.join(entry, 'samples.txt'))
+                    variants = readfile(os.path.join(entry, 'variants.txt'))
+                    break
+            with FileLock(entry + '.lock'):
+                # Another job may have built it while we were waiting
+                if not os.path.isdir(entry):
+                    print('= Genotype cache miss for {} ({}), building it'.format(archive, key))
+                    self.build(entry, archive, siftfile, columfile)
+                    built = True
+        if not built:
+            print('= Genotype cache hit for {} ({})'.format(archive, key))
+        self.evict(keep=key)
+
+        print('== Mapped {}x{} genotype matrix in {:0.2f} sec'.format(
+            matrix.shape[0], matrix.shape[1], time.perf_counter() - tic))
+        return matrix, samples, variants
+
+    def build(self, entry, archive, siftfile, columfile):
+        tic = time.perf_counter()
+        start_data = 9
+        samples = readfile(columfile)[start_data:]
+        rows = {name: i for i, name in enumerate(samples)}
+
+        variants = []
+        cols = {}
+        with open(siftfile, 'r') as f:
+            for item in f:
+                item = item.split()
+                if len(item) > 2 and item[1] not in cols:
+                    cols[item[1]] = len(variants)
+                    variants.append(item[1])
+
+        tmp_dir = tempfile.mkdtemp(prefix='.build-', dir=self.cache_dir)
+        try:
+            matrix = np.lib.format.open_memmap(os.path.join(tmp_dir, 'matrix.npy'),
+                mode='w+', dtype=np.uint8, shape=(len(samples), len(variants)))
+
+            with tarfile.open(archive, 'r:*') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    # members are named chr{c}.{sample}
+                    name = os.path.basename(member.name).split('.', 1)[-1]
+                    if name not in rows:
+                        continue
+                    index = []
+                    for line in tar.extractfile(member).read().decode().splitlines():
+                        line = line.split()
+                        if len(line) > 1 and line[1] in cols:
+                            index.append(cols[line[1]])
+                    matrix[rows[name], index] = 1
+
+            matrix.flush()
+            del matrix
+
+            with open(os.path.join(tmp_dir, 'samples.txt'), 'w') as f:
+                f.writelines('{}\n'.format(name) for name in samples)
+            with open(os.path.join(tmp_dir, 'variants.txt'), 'w') as f:
+                f.writelines('{}\n'.format(rs) for rs in variants)
+
+            os.rename(tmp_dir, entry)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        print('== Built genotype matrix {} in {:0.2f} sec'.format(entry, time.perf_counter() - tic))
+
+    def evict(self, keep=None):
+        with FileLock(os.path.join(self.cache_dir, '.evict.lock')):
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.endswith('.lock') and not name.startswith('.') and not os.path.isdir(path[:-5]):
+                    # Lock of an entry that is gone (evicted or failed build)
+                    self.unlink_lock(path)
+                if name.startswith('.') or not os.path.isdir(path):
+                    continue
+                entries.append((os.path.getmtime(path), disk_usage(path), name, path))
+
+            used = sum(e[1] for e in entries)
+            # Jobs that already mapped an evicted matrix keep their mapping
+            for _, size, name, path in sorted(entries):
+                if used <= self.budget:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    with FileLock(path + '.lock', blocking=False):
+                        print('== Evicting genotype matrix {} ({} bytes)'.format(path, size))
+                        shutil.rmtree(path, ignore_errors=True)
+                        os.unlink(path + '.lock')
+                except BlockingIOError:
+                    # Being mapped or built by another job
+                    continue
+                used -= size
+
+    def unlink_lock(self, lockfile):
+        try:
+            with FileLock(lockfile, blocking=False):
+                # Still missing its entry now that nobody uses it
+                if not os.path.isdir(lockfile[:-5]):
+                    os.unlink(lockfile)
+        except BlockingIOError:
+            pass
+
+
+def mutation_index_array(matrix, samples, variants, ids):
+    rows = {name: i for i, name in enumerate(samples)}
+    return [[variants[k] for k in np.flatnonzero(matrix[rows[name]])] for name in ids]
+
+
+if __name__ == '__main__':
+    # Pre-populate the cache: genotype_cache.py <cache_dir> <chr{c}n.tar.gz> <sifted> <columns.txt>
+    cache = GenotypeCache(sys.argv[1], budget=os.environ.get('GENOTYPE_CACHE_BUDGET', DEFAULT_CACHE_BUDGET))
+    cache.load(archive=sys.argv[2], siftfile=sys.argv[3], columfile=sys.argv[4])
@@ -3,21 +3,104 @@
 import os
 import sys
 import re
+import gzip
 import time
 import tarfile
 import shutil
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import instrument
+import profiling
+import variant_table
 
 
 def compress(output, input_dir):
     with tarfile.open(output, "w:gz") as file:
         file.add(input_dir, arcname=os.path.basename(input_dir))
 
+def compress_shards(output, input_dir, c, layout):
+    # One archive per shard of the layout (sample_shards.py), holding the files of its samples
+    import sample_shards
+    for shard, names in layout['shards'].items():
+        with tarfile.open(sample_shards.archive_name(output, shard), "w:gz") as file:
+            for name in names:
+                filename = "chr{}.{}".format(c, name)
+                file.add(os.path.join(input_dir, filename), arcname=filename)
+
 def readfile(file):
-    with open(file, 'r') as f:
+    opener = gzip.open if file.endswith('.gz') else open
+    with opener(file, 'rt') as f:
         content = f.readlines()
     return content
 
-def processing(inputfile, columfile, c, counter, stop, total):
+def read_sifted(siftfile):
+    # rs numbers of the variants with a SIFT score (line, rs, ENSG, SIFT, phenotype)
+    rs_numbers = set()
+    with open(siftfile, 'r') as f:
+        for line in f:
+            item = line.split()
+            if len(item) > 2:
+                rs_numbers.add(item[1])
+    return rs_numbers
+
+def parse_window(data, n_samples):
+    # The allele matrix (samples x lines) lives in shared memory, for the workers
+    shm = shared_memory.SharedMemory(create=True, size=max(1, n_samples * len(data)))
+    alleles = np.ndarray((n_samples, len(data)), dtype=np.uint8, buffer=shm.buf)
+    table, wanted = variant_table.parse(data, alleles)
+    return shm, alleles, wanted, table
+
+def write_samples(alleles, wanted, table, names, first, last, c, ndir):
+    tic = time.perf_counter()
+    for i in range(first, last):
+        with open("{}/chr{}.{}".format(ndir, c, names[i]), 'wb') as f:
+            table.write(f, variant_table.sample_rows(alleles, wanted, i))
+    # One write per line, the workers share stdout
+    sys.stdout.write("=== Samples {} to {} written in {:0.2f} sec\n".format(first, last - 1, time.perf_counter() - tic))
+    sys.stdout.flush()
+
+def run_workers(alleles, wanted, table, names, c, ndir, workers):
+    # Forked workers inherit the shared buffer, each one writes a contiguous slice of samples
+    ctx = multiprocessing.get_context('fork')
+    edges = [(k * len(names)) // workers for k in range(workers + 1)]
+    procs = [ctx.Process(target=write_samples, args=(alleles, wanted, table, names, first, last, c, ndir))
+             for first, last in zip(edges[:-1], edges[1:]) if last > first]
+    sys.stdout.flush()
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    if any(p.exitcode != 0 for p in procs):
+        sys.exit("ERROR: a worker writing the samples failed")
+    return len(procs)
+
+def write_parallel(data, names, c, ndir, workers):
+    shm, alleles, wanted, table = parse_window(data, len(names))
+    try:
+        n = run_workers(alleles, wanted, table, names, c, ndir, workers)
+    finally:
+        # The buffer can only be released once no array uses it
+        del alleles
+        shm.close()
+        shm.unlink()
+    print("== {} samples written by {} workers".format(len(names), n))
+
+def processing(inputfile, columfile, c, counter, stop, total, stats, siftfile=None, is_slice=False, workers=1,
+               layout=None):
+    with stats.phase('read'):
+        rawdata = readfile(inputfile)
+        columndata = readfile(columfile)[0].rstrip('\n').split('\t')
+    # A slice of split_vcf.py starts at line counter of the chromosome
+    offset = int(counter) if is_slice else 0
+    extract(rawdata, columndata, c, counter, stop, total, stats, siftfile, offset, workers, layout)
+
+def extract(rawdata, columndata, c, counter, stop, total, stats, siftfile=None, offset=0, workers=1, layout=None):
+    # Lines [counter, stop) of the chromosome already in memory (rawdata, from line offset), also
+    # called by the function calls of the TaskVine library (vine_genomes.py --function-calls)
     print('= Now processing chromosome: {}'.format(c))
     tic = time.perf_counter()
 
@@ -33,8 +116,6 @@ def processing(inputfile, columfile, c, counter, stop, total):
     # if not os.path.exists(unzipped):
     #     decompress(inputfile, unzipped)
 
-    rawdata = readfile(inputfile)
-
     ### step 2
     ## Giving a different directory name (chromosome no-counter) for each individuals job
     ndir = 'chr{}n-{}/'.format(c, counter)
@@ -48,69 +129,60 @@ def processing(inputfile, columfile, c, counter, stop, total):
 
     # We consider the line from counter to stop and we don't over total, then we remove lines starting with '#'
     #sed -n "$counter"','"$stop"'p;'"$total"'q' $unzipped | grep -ve "#" > cc
-    regex = re.compile('(?!#)')
-    # print(counter, min(stop, total), data[int(counter):int(min(stop, total))] )
-    data = list(filter(regex.match, rawdata[counter:ending]))
-    data = [x.rstrip('\n') for x in data] # Remove \n from words 
-
-    chrp_data = {}
-    columndata = readfile(columfile)[0].rstrip('\n').split('\t')
+    with stats.phase('read'):
+        regex = re.compile('(?!#)')
+        # print(counter, min(stop, total), data[int(counter):int(min(stop, total))] )
+        data = list(filter(regex.match, rawdata[counter - offset:max(0, ending - offset)]))
+        data = [x.rstrip('\n') for x in data] # Remove \n from words 
+
+    if siftfile:
+        # mutation_overlap and frequency only use the variants with a SIFT score
+        with stats.phase('prefilter'):
+            rs_numbers = read_sifted(siftfile)
+            data = [x for x in data if x.split('\t', 3)[2] in rs_numbers]
+        print("== Keeping {} lines with a SIFT score from {}".format(len(data), siftfile))
 
     start_data = 9  # where the real data start, the first 0|1, 1|1, 1|0 or 0|0
     # position of the last element (normally equals to len(data[0].split(' '))
     #end_data = 2504
     end_data = len(columndata) - start_data
     print("== Number of columns {}".format(end_data))
-
-    for i in range(0, end_data):
-        col = i + start_data
-        name = columndata[col]
-
-        filename = "{}/chr{}.{}".format(ndir, c, name)
-        print("=== Writing file {}".format(filename), end=" => ")
-        tic_iter = time.perf_counter()
-        chrp_data[i] = []
-
-        with open(filename, 'w') as f:
-            for line in data:
-                #print(i, line.split('\t'))
-                first = line.split('\t')[col]  # first =`echo $l | cut -d -f$i`
-                #second =`echo $l | cut -d -f 2, 3, 4, 5, 8 --output-delimiter = '   '`
-                second = line.split('\t')[0:8]
-                # We select the one we want
-                second = [elem for id, elem in enumerate(second) if id in [1, 2, 3, 4, 7]]
-                af_value = second[4].split(';')[8].split('=')[1]
-                # We replace with AF_Value
-                second[4] = af_value
-                try:
-                    if ',' in af_value:
-                        # We only keep the first value if more than one (that's what awk is doing)
-                        af_value = float(af_value.split(',')[0])
-                    else:
-                        af_value = float(af_value)
-
-                    elem = first.split('|')
-                    # We skip some lines that do not meet these conditions
-                    if af_value >= 0.5 and elem[0] == '0':
-                        chrp_data[i].append(second)
-                    elif af_value < 0.5 and elem[0] == '1':
-                        chrp_data[i].append(second)
-                    else:
-                        continue
-
-                    f.write("{0}        {1}    {2}    {3}    {4}\n".format(
-                        second[0], second[1], second[2], second[3], second[4])
-                    )
-                except ValueError:
-                    continue
-
-        print("processed in {:0.2f} sec".format(time.perf_counter()-tic_iter))
+    # lines is the size of the chunk, the unit of job_planner.py, whatever was filtered out of it
+    stats.set(chromosome=c, lines=max(0, ending - counter), kept_lines=len(data), samples=end_data, workers=workers)
+
+    if workers > 1:
+        # Parsed once, the samples are written by workers sharing the parsed window
+        with stats.phase('filter'):
+            write_parallel(data, columndata[start_data:], c, ndir, workers)
+    else:
+        # The variants are parsed once, each sample file is the rows it carries
+        with stats.phase('filter'):
+            alleles = np.empty((end_data, len(data)), dtype=np.uint8)
+            table, wanted = variant_table.parse(data, alleles, start_data)
+            for i in range(0, end_data):
+                col = i + start_data
+                name = columndata[col]
+
+                filename = "{}/chr{}.{}".format(ndir, c, name)
+                print("=== Writing file {}".format(filename), end=" => ")
+                tic_iter = time.perf_counter()
+
+                with open(filename, 'wb') as f:
+                    table.write(f, variant_table.sample_rows(alleles, wanted, i))
+
+                print("processed in {:0.2f} sec".format(time.perf_counter()-tic_iter))
 
     outputfile = "chr{}n-{}-{}.tar.gz".format(c, counter, stop)
-    print("== Done. Zipping {} files into {}.".format(end_data, outputfile))
+    if layout:
+        print("== Done. Zipping {} files into {} shards of {}.".format(end_data, len(layout['shards']), outputfile))
+        with stats.phase('compress'):
+            compress_shards(outputfile, ndir, c, layout)
+    else:
+        print("== Done. Zipping {} files into {}.".format(end_data, outputfile))
 
-    # tar -zcf .. /$outputfile .
-    compress(outputfile, ndir)
+        # tar -zcf .. /$outputfile .
+        with stats.phase('compress'):
+            compress(outputfile, ndir)
 
     # Cleaning temporary files
     try:
@@ -123,16 +195,40 @@ def processing(inputfile, columfile, c, counter, stop, total):
 if __name__ == "__main__":
     print(f"Host = {os.uname()[1]}")
     print(f"CPUs = {os.sched_getaffinity(0)}")
-    inputfile = sys.argv[1]
-    c = sys.argv[2]
-    counter = sys.argv[3]
-    stop = sys.argv[4]
-    total = sys.argv[5]
+    profiling.parse_argv()
+    parser = argparse.ArgumentParser(description='Extract the variants of each individual from lines [counter, stop) of a chromosome')
+    parser.add_argument('inputfile', help='chromosome VCF')
+    parser.add_argument('c', help='chromosome number')
+    parser.add_argument('counter', help='first line')
+    parser.add_argument('stop', help='last line (excluded)')
+    parser.add_argument('total', help='number of lines of the VCF')
+    parser.add_argument('--sift-file', default=None,
+                        help='sifted.SIFT.chr<c>.txt of the sifting job, only its variants are kept')
+    parser.add_argument('--slice', action='store_true',
+                        help='inputfile only holds lines [counter, stop) (split_vcf.py)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes writing the samples, 0 for all the CPUs of the job')
+    parser.add_argument('--shards', default=None,
+                        help='layout file of sample_shards.py, one archive is written per shard')
+    args = parser.parse_args()
+    workers = args.workers or len(os.sched_getaffinity(0))
+    layout = None
+    if args.shards:
+        import sample_shards
+        layout = sample_shards.load(args.shards)
     columfile = 'columns.txt'
+    profiling.start('individuals', 'chr{}n-{}-{}'.format(args.c, args.counter, args.stop))
+    stats = instrument.JobStats('individuals', prefilter=bool(args.sift_file))
 
-    processing(inputfile=inputfile, 
+    processing(inputfile=args.inputfile, 
             columfile=columfile, 
-            c=c, 
-            counter=counter, 
-            stop=stop,
-            total=total)
+            c=args.c, 
+            counter=args.counter, 
+            stop=args.stop,
+            total=args.total,
+            stats=stats,
+            siftfile=args.sift_file,
+            is_slice=args.slice,
+            workers=workers,
+            layout=layout)
+    stats.emit()
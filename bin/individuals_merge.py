@@ -1,62 +1,102 @@
 #!/usr/bin/env python3
 
 import os
-import sys
 import time
 import tarfile
 import shutil
-import tempfile
+import argparse
+import collections
+import concurrent.futures
+
+import instrument
+import profiling
 
 
 def compress(archive, input_dir):
     with tarfile.open(archive, "w:gz") as f:
         f.add(input_dir, arcname="")
 
-def extract_all(archive, output_dir):
+def read_archive(archive):
+    # (member, content) of the files of an archive, read in memory without extracting it
+    tic = time.perf_counter()
+    members = []
     with tarfile.open(archive, "r:*") as f:
-        f.extractall(os.path.basename(output_dir))
-        flist = f.getnames()
-        if flist[0] == '':
-            flist = flist[1:]
-        return flist
-
-def readfile(filename):
-    with open(filename, 'r') as f:
-        content = f.readlines()
-    return content
+        for member in f:
+            if member.isfile():
+                members.append((os.path.basename(member.name), f.extractfile(member).read()))
+    return members, time.perf_counter() - tic
+
+def read_archives(tar_files, readers):
+    # The archives are decompressed by a pool of threads (zlib releases the GIL), at most
+    # 2 * readers ahead of the merge, and handed to it in the order of tar_files
+    with concurrent.futures.ThreadPoolExecutor(readers) as pool:
+        todo = iter(tar_files)
+        pending = collections.deque()
+        for tar in todo:
+            pending.append((tar, pool.submit(read_archive, tar)))
+            if len(pending) >= 2 * readers:
+                break
+        while pending:
+            tar, future = pending.popleft()
+            for following in todo:
+                pending.append((following, pool.submit(read_archive, following)))
+                break
+            yield (tar,) + future.result()
 
 def writefile(filename, content):
-    with open(filename, 'w') as f:
+    with open(filename, 'wb') as f:
         f.writelines(content)
 
-def merging(c, tar_files):
+def writematrix(c, data, stats):
+    import variant_matrix
+    # members are named chr{c}.{sample}
+    individuals = {filename.split('.', 1)[-1]: b''.join(content).decode().splitlines()
+                   for filename, content in data.items()}
+    with stats.phase('compute'):
+        matrix = variant_matrix.VariantMatrix.from_individuals(c, individuals)
+    outputfile = "chr{}n.npz".format(c)
+    print("== Done. Writing {}x{} matrix ({} entries) into {}.".format(
+        matrix.shape[0], matrix.shape[1], matrix.nnz, outputfile))
+    with stats.phase('write'):
+        matrix.save(outputfile)
+
+def merging(c, tar_files, stats, output_format='text', shard=None, readers=1):
     print('= Merging chromosome {}...'.format(c))
     tic = time.perf_counter()
 
-    merged_dir = "merged_chr{}".format(c)
+    # A shard of the samples (sample_shards.py) is merged into chr{c}n.{shard}.tar.gz
+    suffix = ".{}".format(shard) if shard else ""
+    merged_dir = "merged_chr{}{}".format(c, suffix)
     os.makedirs(merged_dir, exist_ok=True)
 
+    # The contents of each sample, in the order of tar_files
     data = {}
 
-    for tar in tar_files:
-        tic_iter = time.perf_counter()
-        with tempfile.TemporaryDirectory(dir=os.curdir) as temp_dir:
-            for filename in extract_all(tar, temp_dir):
-                content = readfile(os.path.join(temp_dir, filename))
-                if filename in data:
-                    data[filename] += content
-                else:
-                    data[filename] = content
-
-        print("Merged {} in {:0.2f} sec".format(tar, time.perf_counter()-tic_iter))
+    with stats.phase('read'):
+        for tar, members, elapsed in read_archives(tar_files, readers):
+            for filename, content in members:
+                data.setdefault(filename, []).append(content)
+
+            print("Merged {} in {:0.2f} sec".format(tar, elapsed))
     
-    for filename,content in data.items():
-        writefile(os.path.join(merged_dir, filename), content)
+    stats.set(chromosome=c, archives=len(tar_files), samples=len(data), format=output_format, shard=shard,
+              readers=readers)
+    if output_format == 'csr':
+        writematrix(c, data, stats)
+        shutil.rmtree(merged_dir, ignore_errors=True)
+        print("= Chromosome {} merged in {:0.2f} seconds.".format(
+            c, time.perf_counter() - tic))
+        return
+
+    with stats.phase('write'):
+        for filename,content in data.items():
+            writefile(os.path.join(merged_dir, filename), content)
     
-    outputfile = "chr{}n.tar.gz".format(c)
+    outputfile = "chr{}n{}.tar.gz".format(c, suffix)
     print("== Done. Zipping {} files into {}.".format(len(data), outputfile))
 
-    compress(outputfile, merged_dir)
+    with stats.phase('compress'):
+        compress(outputfile, merged_dir)
 
     # Cleaning temporary files
     try:
@@ -71,4 +111,22 @@ def merging(c, tar_files):
 if __name__ == "__main__":
     print(f"Host = {os.uname()[1]}")
     print(f"CPUs = {os.sched_getaffinity(0)}")
-    merging(c=sys.argv[1], tar_files=sys.argv[2:])
+    profiling.parse_argv()
+    parser = argparse.ArgumentParser(description='Merge the individuals archives of a chromosome')
+    parser.add_argument('c', help='chromosome number')
+    parser.add_argument('tar_files', nargs='+', help='chr<c>n-<counter>-<stop>.tar.gz archives, in line order')
+    parser.add_argument('--format', choices=['text', 'csr'], default='text',
+                        help='chr<c>n.tar.gz of per-sample files or chr<c>n.npz sparse matrix (variant_matrix.py)')
+    parser.add_argument('--shard', default=None,
+                        help='merge the archives of this shard of samples (sample_shards.py) into chr<c>n.<shard>.tar.gz')
+    parser.add_argument('--readers', type=int, default=4,
+                        help='threads decompressing the archives ahead of the merge, 0 for all the CPUs of the job')
+    args = parser.parse_args()
+    readers = args.readers or len(os.sched_getaffinity(0))
+    if args.shard and args.format == 'csr':
+        parser.error('the variant matrix holds all the samples, --shard only merges text archives')
+    profiling.start('individuals_merge', 'chr{}n{}'.format(args.c, '.' + args.shard if args.shard else ''))
+    stats = instrument.JobStats('individuals_merge')
+    merging(c=args.c, tar_files=args.tar_files, stats=stats, output_format=args.format, shard=args.shard,
+            readers=readers)
+    stats.emit()
@@ -4,6 +4,10 @@ import pybredala as bd
 import pydecaf as d
 from mpi4py import MPI
 
+import mpi_transport
+import instrument
+import profiling
+
 import os
 import sys
 import time
@@ -30,45 +34,67 @@ def readfile(file):
     return content
 
 def writefile(file, content):
-    with open(file, 'w') as f:
+    with open(file, 'wb') as f:
         f.writelines(content)
 
 #orc@09-08: the things I omitted are with ##
-def merging(c, tar_files):
+def merging(c, tar_files, columfile, stats):
     print('= Merging chromosome {}...'.format(c))
     tic = time.perf_counter()
 
     merged_dir = 'merged/'
-    os.makedirs(merged_dir, exist_ok=True)
-
 
     comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
     size = comm.Get_size()
-    num_recv = size - 1
-
-    data = {}
-    end_data = 2504 #TODO we can fetch this via Decaf/mpi from individuals job as metadata if needed.
-
-    for k in range(0, num_recv):
+    merge_ranks = mpi_transport.merge_ranks(size)
+    num_recv = merge_ranks[0]
+
+    # The sample count comes from columns.txt, this rank only merges its slice of samples
+    samples = mpi_transport.read_samples(columfile)
+    lo, hi = mpi_transport.partition(len(samples), len(merge_ranks))[merge_ranks.index(rank)]
+    print("== Rank {} merges samples {} to {} out of {}".format(rank, lo, hi, len(samples)))
+
+    # Only the rows of our own samples are received, from every individuals rank at once
+    tic_comm = time.perf_counter()
+    with stats.phase('transfer'):
+        received = mpi_transport.exchange(comm, mpi_transport.empty_messages(size))
+        chunks = [mpi_transport.decode_chunk(received[k]) for k in range(0, num_recv)]
+    stats.set(chromosome=c, chunks=len(chunks), samples=hi - lo)
+    print("== Received {} chunks in {:0.2f} sec".format(len(chunks), time.perf_counter() - tic_comm))
 
-        filename_arr = comm.recv(source=k, tag=12)
-        end_line_arr = comm.recv(source=k, tag=7)
-        all_data = comm.recv(source=k, tag=13)
-
-        for i in range(0, end_data):
-##            tic_iter = time.perf_counter()
-            file = filename_arr[i]
-            end_line = end_line_arr[i]
-            sub_data = all_data[i]
 ##orc@11-08: need to append in multi mode.
-            with open(merged_dir+'/'+file, 'a') as f:
-                for m in range(0,end_line):
-                    second = sub_data[m]
-
-                    f.write("{0}        {1}    {2}    {3}    {4}\n".format(
-                            second[0], second[1], second[2],second[3],second[4])
-                    )
-
+    # Each sample file is built once, chunks in rank order
+    def sample_file(i):
+        return b''.join(table.gather(sample_rows[i - lo]) for table, sample_rows in chunks)
+
+    # The first merge rank writes all the sample files, those of the other merge ranks are
+    # sent to it one rank after the other: the merge ranks may run without a shared directory
+    merge_comm = comm.Create_group(comm.Get_group().Incl(merge_ranks))
+    index = merge_comm.Get_rank()
+    slices = mpi_transport.partition(len(samples), len(merge_ranks))
+    tic_write = time.perf_counter()
+    if index == 0:
+        os.makedirs(merged_dir, exist_ok=True)
+        with stats.phase('write'):
+            for i in range(lo, hi):
+                writefile(merged_dir + "chr{}.{}".format(c, samples[i]), [sample_file(i)])
+    for k in range(1, len(merge_ranks)):
+        with stats.phase('transfer'):
+            messages = mpi_transport.empty_messages(len(merge_ranks))
+            if index == k:
+                messages[0] = mpi_transport.encode_files([sample_file(i) for i in range(lo, hi)])
+            received = mpi_transport.exchange(merge_comm, messages)
+        if index == 0:
+            with stats.phase('write'):
+                k_lo, k_hi = slices[k]
+                contents = mpi_transport.decode_files(received[k])
+                if len(contents) != k_hi - k_lo:
+                    raise ValueError('merge rank {} sent {} samples instead of {}'.format(
+                        merge_ranks[k], len(contents), k_hi - k_lo))
+                for i, content in zip(range(k_lo, k_hi), contents):
+                    writefile(merged_dir + "chr{}.{}".format(c, samples[i]), [content])
+    print("== Merged {} samples in {:0.2f} sec".format(hi - lo, time.perf_counter() - tic_write))
 
 ##orc@09-08: first gain w the mpi version -- no need to decompress/read
 ##    for tar in tar_files:
@@ -94,16 +120,18 @@ def merging(c, tar_files):
 
     ##print("Wrote in {:0.2f} sec".format(time.perf_counter()-tic_write))
 
-    outputfile = "chr{}n.tar.gz".format(c)
-    print("== Done. Zipping {} files into {}.".format(len(data), outputfile))
+    if rank == merge_ranks[0]:
+        outputfile = "chr{}n.tar.gz".format(c)
+        print("== Done. Zipping {} files into {}.".format(len(samples), outputfile))
 
-    compress(outputfile, merged_dir)
+        with stats.phase('compress'):
+            compress(outputfile, merged_dir)
 
-    # Cleaning temporary files
-    try:
-        shutil.rmtree(merged_dir)
-    except OSError as e:
-        print("Error: %s : %s" % (merged_dir, e.strerror))
+        # Cleaning temporary files
+        try:
+            shutil.rmtree(merged_dir)
+        except OSError as e:
+            print("Error: %s : %s" % (merged_dir, e.strerror))
 
     print("= Chromosome {} merged in {:0.2f} seconds.".format(
         c, time.perf_counter() - tic))
@@ -120,7 +148,12 @@ if __name__ == "__main__":
     r = MPI.COMM_WORLD.Get_rank()
     decaf = d.Decaf(a,w)
 
-    merging(c=sys.argv[1], tar_files=sys.argv[2:])
+    profiling.parse_argv()
+    # An MPI rank cannot re-execute itself under py-spy
+    profiling.start('individuals_merge', 'chr{}n.{}'.format(sys.argv[1], r), reexec=False)
+    stats = instrument.JobStats('individuals_merge', rank=r, transport='mpi')
+    merging(c=sys.argv[1], tar_files=sys.argv[2:], columfile='columns.txt', stats=stats)
+    stats.emit()
 
     print("individuals_merge at rank " + str(r) + " terminating")
     decaf.terminate()
@@ -3,10 +3,17 @@
 import pybredala as bd
 import pydecaf as d
 from mpi4py import MPI
+import numpy as np
+
+import mpi_transport
+import variant_table
+import instrument
+import profiling
 
 import os
 import sys
 import re
+import gzip
 import time
 import tarfile
 import shutil
@@ -17,12 +24,13 @@ def compress(output, input_dir):
         file.add(input_dir, arcname=os.path.basename(input_dir))
 
 def readfile(file):
-    with open(file, 'r') as f:
+    opener = gzip.open if file.endswith('.gz') else open
+    with opener(file, 'rt') as f:
         content = f.readlines()
     return content
 
 #orc@09-08: the things I omitted are with ##
-def processing(inputfile, columfile, c, counter, stop, total):
+def processing(inputfile, columfile, c, counter, stop, total, stats):
     print('= Now processing chromosome: {}'.format(c))
     tic = time.perf_counter()
 
@@ -38,7 +46,8 @@ def processing(inputfile, columfile, c, counter, stop, total):
     # if not os.path.exists(unzipped):
     #     decompress(inputfile, unzipped)
 
-    rawdata = readfile(inputfile)
+    with stats.phase('read'):
+        rawdata = readfile(inputfile)
 
     ### step 2
     ##ndir = 'chr{}n/'.format(c)
@@ -52,85 +61,48 @@ def processing(inputfile, columfile, c, counter, stop, total):
 
     # We consider the line from counter to stop and we don't over total, then we remove lines starting with '#'
     #sed -n "$counter"','"$stop"'p;'"$total"'q' $unzipped | grep -ve "#" > cc
-    regex = re.compile('(?!#)')
-    # print(counter, min(stop, total), data[int(counter):int(min(stop, total))] )
-    data = list(filter(regex.match, rawdata[counter:ending]))
-    data = [x.rstrip('\n') for x in data] # Remove \n from words 
-
-    chrp_data = {}
-    filename_arr = []
-    count_arr = []
+    with stats.phase('read'):
+        regex = re.compile('(?!#)')
+        # print(counter, min(stop, total), data[int(counter):int(min(stop, total))] )
+        data = list(filter(regex.match, rawdata[counter:ending]))
+        data = [x.rstrip('\n') for x in data] # Remove \n from words 
 
-    columndata = readfile(columfile)[0].rstrip('\n').split('\t')
+        columndata = readfile(columfile)[0].rstrip('\n').split('\t')
 
-    start_data = 9  # where the real data start, the first 0|1, 1|1, 1|0 or 0|0
+    start_data = mpi_transport.START_DATA  # where the real data start, the first 0|1, 1|1, 1|0 or 0|0
     # position of the last element (normally equals to len(data[0].split(' '))
     #end_data = 2504
     end_data = len(columndata) - start_data
     print("== Number of columns {}".format(end_data))
+    stats.set(chromosome=c, lines=max(0, ending - counter), kept_lines=len(data), samples=end_data)
 
     comm = MPI.COMM_WORLD
 
-    for i in range(0, end_data):
-        col = i + start_data
-        name = columndata[col]
-        ##filename = "{}/chr{}.{}".format(ndir, c, name)
-        filename_mpi = "chr{}.{}".format(c, name)
-        filename_arr.append(filename_mpi)
-        print("=== Sending the file {} contents over MPI".format(filename_mpi), end=" => ")
-        tic_iter = time.perf_counter()
-        chrp_data[i] = []
-        count = 0
-
-##        with open(filename, 'w') as f:
-        for line in data:
-            #print(i, line.split('\t'))
-            first = line.split('\t')[col]  # first =`echo $l | cut -d -f$i`
-            #second =`echo $l | cut -d -f 2, 3, 4, 5, 8 --output-delimiter = '   '`
-            second = line.split('\t')[0:8]
-            # We select the one we want
-            second = [elem for id, elem in enumerate(second) if id in [1, 2, 3, 4, 7]]
-            af_value = second[4].split(';')[8].split('=')[1]
-            # We replace with AF_Value
-            second[4] = af_value
-            #af_value = float(af_value.split(',')[0]) # We only keep the first value if more than one (that's what awk is doing)
-            try:
-                if ',' in af_value:
-                    # We only keep the first value if more than one (that's what awk is doing)
-                    af_value = float(af_value.split(',')[0])
-                else:
-                    af_value = float(af_value)
-                    
-                elem = first.split('|')
-                # We skip some lines that do not meet these conditions
-                if af_value >= 0.5 and elem[0] == '0':
-                    chrp_data[i].append(second)
-                    count = count + 1
-                elif af_value < 0.5 and elem[0] == '1':
-                    chrp_data[i].append(second)
-                    count = count + 1
-                else:
-                    continue
-            except ValueError:
-                continue
-
-##orc@09-08: first gains w the mpi version, eliminating the file write on individuals
-##                f.write("{0}        {1}    {2}    {3}    {4}\n".format(
-##                    second[0], second[1], second[2],second[3],second[4])
-##               )
-
-        tic_comm = time.perf_counter()
-        count_arr.append(count)
-        print("processed in {:0.2f} sec".format(time.perf_counter()-tic_iter))
+    with stats.phase('filter'):
+        # Every line is parsed once into the variant table, shared by all the samples
+        alleles = np.empty((end_data, len(data)), dtype=np.uint8)
+        table, wanted = variant_table.parse(data, alleles, start_data)
+
+        sample_rows = []
+        for i in range(0, end_data):
+            col = i + start_data
+            print("=== Selecting rows of chr{}.{}".format(c, columndata[col]), end=" => ")
+            tic_iter = time.perf_counter()
+
+    ##orc@09-08: first gains w the mpi version, eliminating the file write on individuals
+            sample_rows.append(variant_table.sample_rows(alleles, wanted, i))
+            print("processed in {:0.2f} sec".format(time.perf_counter()-tic_iter))
+        del alleles
 
     tic_comm = time.perf_counter()
     size = comm.Get_size()
-    # orc@11-08: for now, assuming a 2-job workflow: multi indv + indv_merge
-    send_dest = size-1
-    ##orc@10-08: sending the filename, line count, and the data itself to indv_merge
-    comm.send(filename_arr,dest=send_dest, tag=12)
-    comm.send(count_arr,   dest=send_dest, tag=7)
-    comm.send(chrp_data,   dest=send_dest, tag=13)
+    # Each merge rank receives the whole row table and the indices of its own samples
+    merge_ranks = mpi_transport.merge_ranks(size)
+    messages = mpi_transport.empty_messages(size)
+    for dest, (lo, hi) in zip(merge_ranks, mpi_transport.partition(end_data, len(merge_ranks))):
+        messages[dest] = mpi_transport.encode_chunk(table, sample_rows[lo:hi])
+    with stats.phase('transfer'):
+        mpi_transport.exchange(comm, messages)
 
 ##orc@09-08: another gain w the mpi version -- eliminating compression and removal of temp files
 ##    outputfile = "chr{}n-{}-{}.tar.gz".format(c, counter, stop)
@@ -156,6 +128,7 @@ if __name__ == "__main__":
     print(f"Host = {os.uname()[1]}")
     print(f"CPUs = {os.sched_getaffinity(0)}")
     start = time.time()
+    profiling.parse_argv()
     inputfile = sys.argv[1]
     c = sys.argv[2]
     counter = sys.argv[3]
@@ -170,13 +143,18 @@ if __name__ == "__main__":
     a = MPI._addressof(MPI.COMM_WORLD)
     r = MPI.COMM_WORLD.Get_rank()
     decaf = d.Decaf(a,w)
+    # An MPI rank cannot re-execute itself under py-spy
+    profiling.start('individuals', 'chr{}n-{}-{}'.format(c, counter, stop), reexec=False)
+    stats = instrument.JobStats('individuals', rank=r, transport='mpi')
 
     processing(inputfile=inputfile, 
             columfile=columfile, 
             c=c, 
             counter=counter, 
             stop=stop,
-            total=total)
+            total=total,
+            stats=stats)
+    stats.emit()
 
     print("individuals at rank " + str(r) + " terminating")
     decaf.terminate()
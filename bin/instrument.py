@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Structured timing and resource records for the bin/ scripts.
+#
+# A script creates one JobStats, wraps each of its phases (read, filter,
+# write, compress, plot, ...) in stats.phase(name) and calls stats.emit() at
+# the end. Each phase records its wall time, CPU time (including children such
+# as grep), peak RSS so far, and bytes read and written. The job record is
+# printed on stdout as a single line prefixed with MARKER, so it ends up in the
+# Pegasus .out files, the TaskVine task output and the local runner logs, and
+# is also written to $JOBSTATS_DIR/<stage>-<id>.stats.json when that variable
+# is set. analysis/records.py collects both forms from any run directory.
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import contextlib
+
+MARKER = '@@jobstats '
+
+def io_counters():
+    # Bytes passed to read/write syscalls, zeros where /proc is not available
+    counters = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters['rchar'], counters['wchar']
+
+def cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def max_rss():
+    # ru_maxrss is in KB on Linux
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class JobStats(object):
+    def __init__(self, stage, **meta):
+        self.stage = stage
+        self.record = {
+            'stage': stage,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'args': sys.argv[1:],
+            'start': time.time(),
+            'phases': {},
+        }
+        self.record.update(meta)
+        self.tic = time.perf_counter()
+        self.cpu = cpu_time()
+        self.io = io_counters()
+
+    def set(self, **meta):
+        self.record.update(meta)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        tic = time.perf_counter()
+        cpu = cpu_time()
+        rchar, wchar = io_counters()
+        try:
+            yield
+        finally:
+            end_rchar, end_wchar = io_counters()
+            phase = self.record['phases'].setdefault(name, {
+                'wall': 0.0, 'cpu': 0.0, 'bytes_read': 0, 'bytes_written': 0})
+            # A phase entered several times accumulates
+            phase['wall'] += time.perf_counter() - tic
+            phase['cpu'] += cpu_time() - cpu
+            phase['bytes_read'] += end_rchar - rchar
+            phase['bytes_written'] += end_wchar - wchar
+            phase['max_rss'] = max_rss()
+
+    def emit(self):
+        rchar, wchar = io_counters()
+        self.record.update({
+            'wall': time.perf_counter() - self.tic,
+            'cpu': cpu_time() - self.cpu,
+            'max_rss': max_rss(),
+            'bytes_read': rchar - self.io[0],
+            'bytes_written': wchar - self.io[1],
+        })
+        line = json.dumps(self.record, sort_keys=True)
+        print(MARKER + line, flush=True)
+
+        stats_dir = os.environ.get('JOBSTATS_DIR')
+        if stats_dir:
+            os.makedirs(stats_dir, exist_ok=True)
+            filename = '{}-{}-{}-{}.stats.json'.format(
+                self.stage, socket.gethostname(), os.getpid(), int(self.record['start'] * 1000))
+            with open(os.path.join(stats_dir, filename), 'w') as f:
+                f.write(line + '\n')
+        return self.record
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# In-memory transport between individuals_mpi.py and individuals_merge_mpi.py.
+#
+# The MPI job is laid out as [individuals ranks..., merge ranks...]: the last
+# INDIVIDUALS_MERGE_RANKS ranks of COMM_WORLD (1 by default) merge, all the
+# others process one chunk of the chromosome each, in chunk order. Samples are
+# partitioned into contiguous slices, one per merge rank.
+#
+# The rows travel with collectives over COMM_WORLD (Alltoallv), so every rank
+# of the job, individuals or merge, calls exchange(). Each individuals rank
+# sends one message to each merge rank and nothing to the other ranks; merge
+# ranks send nothing. MPI counts and displacements are C ints, so messages are
+# cut into rounds that keep every buffer of a collective below 2 GB. A message
+# is a uint8 buffer:
+#   header   int64[4]  number of rows, table size in bytes, number of samples
+#                      in the slice, total number of indices
+#   table    uint8[]   the rows of the chunk variant table (variant_table.py)
+#                      carried by the samples of the slice, newline terminated,
+#                      padded to a multiple of 8 bytes
+#   counts   int64[]   number of rows of each sample of the slice
+#   indices  int32[]   row indices of each sample, concatenated
+#
+# The merge ranks then send the files of their samples to the first merge rank
+# (encode_files), which writes and zips the whole chromosome: the ranks do not
+# need to share a working directory.
+
+import os
+
+import numpy as np
+
+import variant_table
+
+START_DATA = variant_table.START_DATA  # where the real data start in columns.txt
+MAX_BYTES = 2**31 - 1  # largest MPI count
+
+def read_samples(columfile):
+    with open(columfile, 'r') as f:
+        columndata = f.readline().rstrip('\n').split('\t')
+    return columndata[START_DATA:]
+
+def merge_ranks(size):
+    n_merge = int(os.environ.get('INDIVIDUALS_MERGE_RANKS', 1))
+    if not 0 < n_merge < size:
+        raise ValueError('INDIVIDUALS_MERGE_RANKS={} is invalid for {} MPI ranks'.format(n_merge, size))
+    return list(range(size - n_merge, size))
+
+def partition(n_samples, n_parts):
+    # Contiguous [lo, hi) slices of samples, one per merge rank
+    bounds = [(k * n_samples) // n_parts for k in range(n_parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def encode_chunk(table, sample_rows):
+    # Only the rows carried by the samples of the slice are sent, renumbered
+    counts = np.array([len(r) for r in sample_rows], dtype=np.int64)
+    if sample_rows:
+        indices = np.concatenate(sample_rows).astype(np.int32, copy=False)
+    else:
+        indices = np.empty(0, dtype=np.int32)
+    used = np.unique(indices)
+    table = table.take(used)
+    indices = np.searchsorted(used, indices).astype(np.int32)
+
+    padding = np.zeros(-table.buffer.size % 8, dtype=np.uint8)
+    header = np.array([len(table), table.buffer.size, counts.size, indices.size], dtype=np.int64)
+    return np.concatenate([header.view(np.uint8), table.buffer, padding,
+                           counts.view(np.uint8), indices.view(np.uint8)])
+
+def decode_chunk(message):
+    n_rows, table_size, n_samples, n_indices = (int(x) for x in message[:32].view(np.int64))
+    offset = 32
+    table = variant_table.VariantTable(message[offset:offset + table_size])
+    offset += table_size + (-table_size % 8)
+    counts = message[offset:offset + 8 * n_samples].view(np.int64)
+    offset += 8 * n_samples
+    indices = message[offset:offset + 4 * n_indices].view(np.int32)
+
+    if len(table) != n_rows:
+        raise ValueError('message holds {} rows but announces {}'.format(len(table), n_rows))
+
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return table, [indices[offsets[i]:offsets[i+1]] for i in range(n_samples)]
+
+def exchange(comm, messages, max_bytes=MAX_BYTES):
+    # messages[dest] is the uint8 buffer for rank dest, returns the buffers received from each rank
+    from mpi4py import MPI
+
+    size = comm.Get_size()
+    sendcounts = np.array([m.size for m in messages], dtype=np.int64)
+    recvcounts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(sendcounts, recvcounts)
+
+    received = [np.empty(int(n), dtype=np.uint8) for n in recvcounts]
+
+    # Every round carries at most step bytes between two ranks, so the counts, the
+    # displacements and the buffers of a round all stay below MAX_BYTES
+    step = max_bytes // size
+    longest = comm.allreduce(int(sendcounts.max(initial=0)), op=MPI.MAX)
+    for start in range(0, longest, step):
+        pieces = [m[start:start + step] for m in messages]
+        scounts = np.array([p.size for p in pieces], dtype=np.int64)
+        rcounts = np.clip(recvcounts - start, 0, step)
+        sdispls = np.concatenate(([0], np.cumsum(scounts)[:-1]))
+        rdispls = np.concatenate(([0], np.cumsum(rcounts)[:-1]))
+        sendbuf = np.concatenate(pieces)
+        recvbuf = np.empty(int(rcounts.sum()), dtype=np.uint8)
+
+        comm.Alltoallv([sendbuf, (scounts.astype(np.int32), sdispls.astype(np.int32)), MPI.BYTE],
+                       [recvbuf, (rcounts.astype(np.int32), rdispls.astype(np.int32)), MPI.BYTE])
+        for k in range(size):
+            received[k][start:start + rcounts[k]] = recvbuf[rdispls[k]:rdispls[k] + rcounts[k]]
+
+    return received
+
+def encode_files(contents):
+    # Several files in one message: int64 number of files, int64[] sizes, then their bytes
+    sizes = np.array([len(content) for content in contents], dtype=np.int64)
+    header = np.array([sizes.size], dtype=np.int64)
+    return np.concatenate([header.view(np.uint8), sizes.view(np.uint8),
+                           np.frombuffer(b''.join(contents), dtype=np.uint8)])
+
+def decode_files(message):
+    n_files = int(message[:8].view(np.int64)[0])
+    sizes = message[8:8 + 8 * n_files].view(np.int64)
+    offsets = 8 + 8 * n_files + np.concatenate(([0], np.cumsum(sizes)))
+    return [message[offsets[i]:offsets[i+1]] for i in range(n_files)]
+
+def empty_messages(size):
+    return [np.empty(0, dtype=np.uint8) for _ in range(size)]
@@ -23,15 +23,32 @@ import matplotlib as mpl
 import collections
 from collections import Counter
 
+import instrument
+import profiling
+
 
 c_help = 'type a chromosome 1-22'
 pop_help = 'type a population 0-6; 0:ALL, 1:EUR, 2:EAS, 3:AFR, 4:AMR, 5:SAS, 6:GBR'
+cache_help = 'node-local genotype cache directory (default: $GENOTYPE_CACHE_DIR, disabled if unset)'
+budget_help = 'disk budget of the genotype cache in bytes'
+matrix_help = 'chr<c>n.npz sparse matrix of individuals_merge.py --format csr, instead of chr<c>n.tar.gz'
+shards_help = 'layout of sample_shards.py, the chr<c>n.<shard>.tar.gz holding the population are read instead of chr<c>n.tar.gz'
 description = 'Process mutation sets (-c and -POP are required).'
 parser = argparse.ArgumentParser(description = description)
 parser.add_argument("-c", type=int,
                     help=c_help)
 parser.add_argument("-pop", 
                     help=pop_help)
+parser.add_argument("--cache-dir", default=os.environ.get('GENOTYPE_CACHE_DIR'),
+                    help=cache_help)
+parser.add_argument("--cache-budget", type=int,
+                    default=os.environ.get('GENOTYPE_CACHE_BUDGET', 16 * 1024**3),
+                    help=budget_help)
+parser.add_argument("--matrix", default=None,
+                    help=matrix_help)
+parser.add_argument("--shards", default=None,
+                    help=shards_help)
+profiling.parse_argv()
 args = parser.parse_args()
 c = args.c
 
@@ -60,9 +77,20 @@ plt.rc('font', **font)
 
 # untar input data
 import tarfile
-tar = tarfile.open(chrom + 'n.tar.gz')
-tar.extractall(path='./' + chrom + 'n')
-tar.close()
+def extract_individuals():
+    archives = [chrom + 'n.tar.gz']
+    if args.shards:
+        # Only the shards holding samples of the population (sample_shards.py)
+        import sample_shards
+        with open(pop_dir + POP, 'r') as f:
+            samples = f.read().split()
+        layout = sample_shards.load(args.shards)
+        archives = [sample_shards.archive_name(chrom + 'n.tar.gz', shard)
+                    for shard in sample_shards.shards_of(layout, samples)]
+    for archive in archives:
+        tar = tarfile.open(archive)
+        tar.extractall(path='./' + chrom + 'n')
+        tar.close()
 
 tic = time.perf_counter()
 
@@ -116,13 +144,20 @@ class ReadData :
         mutation_index_array = []
         total_mutations={}  
         total_mutations_list =[]    
-        for name in ids :
-            filename = data_dir + chrom + 'n/' + chrom + '.' + name
-            f = open(filename, 'r')
-            text = f.read()
-            f.close()
-            text = text.split()
-            sifted_mutations = list(set(rs_numbers).intersection(text))
+        if args.matrix:
+            cached_mutations = self.read_matrix_individuals(ids, rs_numbers)
+        elif args.cache_dir:
+            cached_mutations = self.read_cached_individuals(ids)
+        for i, name in enumerate(ids) :
+            if args.matrix or args.cache_dir:
+                sifted_mutations = cached_mutations[i]
+            else:
+                filename = data_dir + chrom + 'n/' + chrom + '.' + name
+                f = open(filename, 'r')
+                text = f.read()
+                f.close()
+                text = text.split()
+                sifted_mutations = list(set(rs_numbers).intersection(text))
             mutation_index_array.append(sifted_mutations)
             total_mutations[name]= len(sifted_mutations)
             total_mutations_list.append(len(sifted_mutations))
@@ -134,6 +169,19 @@ class ReadData :
         print('time: %s' % (time.perf_counter() - tic))
         return mutation_index_array, total_mutations, total_mutations_list    
    
+    def read_cached_individuals(self, ids) :
+        # The sifted rs numbers of each individual come from the node-local genotype matrix
+        import genotype_cache
+        cache = genotype_cache.GenotypeCache(args.cache_dir, budget=args.cache_budget)
+        matrix, samples, variants = cache.load(chrom + 'n.tar.gz', siftfile, data_dir + 'columns.txt')
+        return genotype_cache.mutation_index_array(matrix, samples, variants, ids)
+
+    def read_matrix_individuals(self, ids, rs_numbers) :
+        # Population rows and SIFT columns of the sparse individuals x variants matrix
+        import variant_matrix
+        self.genotypes, variants = variant_matrix.VariantMatrix.load(args.matrix).genotypes(ids, rs_numbers)
+        return variant_matrix.mutation_index_array(self.genotypes, variants)
+
     def read_pairs_overlap(self, indpairsfile) :
         print('reading in individual crossover mutations')
         tic = time.perf_counter()
@@ -194,6 +242,18 @@ class Results :
         print('time: %s' % (time.perf_counter() - tic))
         return total_pairs_overlap , simetric_overlap
 
+    def total_pair_matrix(self, genotypes) :
+        print('cross matching mutations total individuals (matrix)')
+        tic = time.perf_counter()
+        # overlaps of every pair of individuals at once, exact in float32 below 2**24 variants
+        x = genotypes.astype(np.float32)
+        simetric_overlap = x @ x.T
+        np.fill_diagonal(simetric_overlap, 0)
+        total_pairs_overlap = np.triu(simetric_overlap, 1)
+
+        print('time: %s' % (time.perf_counter() - tic))
+        return total_pairs_overlap.astype(np.float64), simetric_overlap.astype(np.float64)
+
     def half_pair_individuals(self, mutation_index_array) :
         print('cross matching mutations in individuals - half with half')
         tic = time.perf_counter()
@@ -402,40 +462,62 @@ if __name__ == '__main__':
     
 
 
-    ids = rd.read_names(POP)
-    n_pairs = len(ids)/2
+    profiling.start('mutation_overlap', 'chr{}-{}'.format(c, POP))
+    stats = instrument.JobStats('mutation_overlap', chromosome=str(c), population=POP,
+                                cached=bool(args.cache_dir), matrix=bool(args.matrix))
+
+    with stats.phase('read'):
+        if not args.cache_dir and not args.matrix:
+            extract_individuals()
+
+        ids = rd.read_names(POP)
+        n_pairs = len(ids)/2
     
 
-    rs_numbers, map_variations = rd.read_rs_numbers(siftfile)
-    mutation_index_array, total_mutations, total_mutations_list = rd.read_individuals(ids, rs_numbers)
-    wr.write_total_indiv(total_mutations_filename, total_mutations)
-    wr.write_map_variations(map_variations_file, map_variations)    
+        rs_numbers, map_variations = rd.read_rs_numbers(siftfile)
+        mutation_index_array, total_mutations, total_mutations_list = rd.read_individuals(ids, rs_numbers)
+    stats.set(samples=len(ids), variants=len(rs_numbers))
+    with stats.phase('write'):
+        wr.write_total_indiv(total_mutations_filename, total_mutations)
+        wr.write_map_variations(map_variations_file, map_variations)    
    
     #cross-correlations mutations overlapping
-    half_pairs_overlap = res.half_pair_individuals(mutation_index_array)
-    total_pairs_overlap, simetric_overlap = res.total_pair_individuals(mutation_index_array)
-    random_pairs_overlap = res.pair_individuals(mutation_index_array)
+    with stats.phase('compute'):
+        half_pairs_overlap = res.half_pair_individuals(mutation_index_array)
+        if args.matrix:
+            total_pairs_overlap, simetric_overlap = res.total_pair_matrix(rd.genotypes)
+        else:
+            total_pairs_overlap, simetric_overlap = res.total_pair_individuals(mutation_index_array)
+        random_pairs_overlap = res.pair_individuals(mutation_index_array)
     
-    wr.write_mutation_index_array(mutation_index_array_file, mutation_index_array)
-    wr.write_pair_individuals(half_indpairsfile, half_pairs_overlap)
-    wr.write_pair_individuals(total_indpairsfile, total_pairs_overlap)
-    wr.write_pair_individuals(random_indpairsfile, random_pairs_overlap)
+    with stats.phase('write'):
+        wr.write_mutation_index_array(mutation_index_array_file, mutation_index_array)
+        wr.write_pair_individuals(half_indpairsfile, half_pairs_overlap)
+        wr.write_pair_individuals(total_indpairsfile, total_pairs_overlap)
+        wr.write_pair_individuals(random_indpairsfile, random_pairs_overlap)
     
-    pd.individual_overlap(POP, half_pairs_overlap, half_overlap)
-    pd.individual_overlap(POP, simetric_overlap, total_overlap)
-    pd.individual_overlap(POP, random_pairs_overlap, random_overlap)
-    pd.total_colormap_overlap(POP, total_pairs_overlap, colormap)
+    with stats.phase('plot'):
+        pd.individual_overlap(POP, half_pairs_overlap, half_overlap)
+        pd.individual_overlap(POP, simetric_overlap, total_overlap)
+        pd.individual_overlap(POP, random_pairs_overlap, random_overlap)
+        pd.total_colormap_overlap(POP, total_pairs_overlap, colormap)
 
     #list of frecuency of mutations in 26 individuals
-    random_mutations_list=res.group_indivuals(total_mutations_list)
-    wr.write_random_mutations_list(random_mutations_filename, random_mutations_list)
+    with stats.phase('compute'):
+        random_mutations_list=res.group_indivuals(total_mutations_list)
+    with stats.phase('write'):
+        wr.write_random_mutations_list(random_mutations_filename, random_mutations_list)
 
     # gen overlapping
-    gene_pair_list = res.gene_pairs(mutation_index_array)
-    wr.write_gene_pairs(genepairsfile, gene_pair_list)
+    with stats.phase('compute'):
+        gene_pair_list = res.gene_pairs(mutation_index_array)
+    with stats.phase('write'):
+        wr.write_gene_pairs(genepairsfile, gene_pair_list)
 
     # gen final output
-    tar = tarfile.open('chr%s-%s.tar.gz' % (c, POP), 'w:gz')
-    tar.add(outdata_dir)
-    tar.add(plots_dir)
-    tar.close()
+    with stats.phase('compress'):
+        tar = tarfile.open('chr%s-%s.tar.gz' % (c, POP), 'w:gz')
+        tar.add(outdata_dir)
+        tar.add(plots_dir)
+        tar.close()
+    stats.emit()
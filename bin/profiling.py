@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Optional profiling of the bin/ scripts.
+#
+# Profiling is requested with $JOB_PROFILE or with --profile[=MODE] on the
+# command line of a script (the option is removed before the script parses its
+# arguments), MODE being:
+#   cprofile  the job runs under cProfile, the stats are dumped at exit to
+#             <stage>.<name>.prof (pstats format)
+#   py-spy    the job re-executes itself under 'py-spy record', the sampled
+#             stacks are written to <stage>.<name>.collapsed (flamegraph format)
+# <name> is the main output of the job without its extension, the profile is
+# written next to it so the workflow systems stage it back with the outputs.
+# analysis/merge-profiles.py merges the profiles of all the jobs of a stage.
+
+import os
+import sys
+import atexit
+import shutil
+import cProfile
+
+MODES = ('cprofile', 'py-spy')
+EXTENSIONS = {'cprofile': '.prof', 'py-spy': '.collapsed'}
+
+mode = os.environ.get('JOB_PROFILE') or None
+
+def parse_argv():
+    # Removes --profile[=MODE] from sys.argv, must be called before the script parses it
+    global mode
+    for arg in list(sys.argv[1:]):
+        if arg == '--profile' or arg.startswith('--profile='):
+            sys.argv.remove(arg)
+            mode = arg.partition('=')[2] or 'cprofile'
+    if mode and mode not in MODES:
+        sys.exit("ERROR: unknown profiling mode {} (one of {})".format(mode, ', '.join(MODES)))
+    return mode
+
+def profile_name(stage, name, profile_mode=None):
+    return '{}.{}{}'.format(stage, name, EXTENSIONS[profile_mode or mode or 'cprofile'])
+
+def dump(profiler, filename):
+    profiler.disable()
+    profiler.dump_stats(filename)
+    print("= Profile written to {}".format(filename))
+
+def start(stage, name, reexec=True):
+    # Starts the profiler of the job, returns the profile filename or None
+    parse_argv()
+    if not mode:
+        return None
+    filename = profile_name(stage, name)
+
+    if mode == 'py-spy':
+        if os.environ.get('JOB_PROFILE_CHILD'):
+            # Already running under py-spy
+            return filename
+        pyspy = shutil.which('py-spy')
+        if pyspy and reexec:
+            env = dict(os.environ, JOB_PROFILE='py-spy', JOB_PROFILE_CHILD='1')
+            sys.stdout.flush()
+            os.execve(pyspy, [pyspy, 'record', '--format', 'raw', '--output', filename, '--',
+                              sys.executable] + sys.argv, env)
+        # The workflow expects the profile as an output of the job
+        print("WARNING: cannot re-execute under py-spy, {} will be empty".format(filename))
+        open(filename, 'w').close()
+        return filename
+
+    profiler = cProfile.Profile()
+    atexit.register(dump, profiler, filename)
+    profiler.enable()
+    return filename
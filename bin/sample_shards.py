@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Sample-sharded layout of the individuals outputs.
+#
+# With a layout, each individuals job writes one archive per shard of samples,
+# chr{c}n-{counter}-{stop}.{shard}.tar.gz, each shard is merged on its own into
+# chr{c}n.{shard}.tar.gz, and the analysis jobs of a population only extract
+# the shards holding its samples. The layout is a small JSON file, the same
+# for all the chromosomes:
+#
+#   {"by": "index" | "population", "shards": {shard: [sample, ...]}}
+#
+# Shards by index are contiguous slices of the samples of columns.txt, named
+# s00, s01, ... Shards by population hold the samples of each population file
+# given, in order, a sample going to the first population listing it; the
+# samples of none of them go to the shard 'other'. A layout is written with:
+#   ./bin/sample_shards.py columns.txt shards.json -n 16
+#   ./bin/sample_shards.py columns.txt shards.json -P data/populations/{AFR,AMR,EAS,EUR,SAS}
+
+import os
+import json
+import argparse
+
+START_DATA = 9  # where the real data start in columns.txt
+
+
+def read_samples(columfile):
+    with open(columfile, 'r') as f:
+        columndata = f.readline().rstrip('\n').split('\t')
+    return columndata[START_DATA:]
+
+def by_index(samples, n_shards):
+    n_shards = max(1, min(n_shards, len(samples)))
+    bounds = [(k * len(samples)) // n_shards for k in range(n_shards + 1)]
+    width = max(2, len(str(n_shards - 1)))
+    return {'by': 'index',
+            'shards': {'s{:0{}d}'.format(k, width): samples[lo:hi]
+                       for k, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))}}
+
+def by_population(samples, popfiles):
+    shards = {}
+    assigned = set()
+    for popfile in popfiles:
+        with open(popfile, 'r') as f:
+            members = set(f.read().split())
+        shard = [name for name in samples if name in members and name not in assigned]
+        assigned.update(shard)
+        if shard:
+            shards[os.path.basename(popfile)] = shard
+    other = [name for name in samples if name not in assigned]
+    if other:
+        shards['other'] = other
+    return {'by': 'population', 'shards': shards}
+
+def load(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def save(layout, filename):
+    with open(filename, 'w') as f:
+        json.dump(layout, f, indent=1)
+
+def archive_name(archive, shard):
+    # chr1n-1-151.tar.gz -> chr1n-1-151.s00.tar.gz
+    return '{}.{}.tar.gz'.format(archive[:-len('.tar.gz')], shard)
+
+def shard_of(layout):
+    # {sample: shard}
+    return {name: shard for shard, names in layout['shards'].items() for name in names}
+
+def shards_of(layout, samples):
+    # Shards holding at least one of samples, in layout order
+    samples = set(samples)
+    return [shard for shard, names in layout['shards'].items() if samples.intersection(names)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the sample-sharded layout of the individuals outputs')
+    parser.add_argument('columns', help='columns.txt of the dataset')
+    parser.add_argument('output', help='layout file (JSON)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-n', '--shards', type=int, help='number of shards of contiguous samples')
+    group.add_argument('-P', '--populations', nargs='+', help='population files, one shard each')
+    args = parser.parse_args()
+
+    samples = read_samples(args.columns)
+    if args.shards:
+        layout = by_index(samples, args.shards)
+    else:
+        layout = by_population(samples, args.populations)
+    save(layout, args.output)
+    print('= {} samples in {} shards written to {}'.format(len(samples), len(layout['shards']), args.output))
@@ -6,18 +6,22 @@ import re
 import time
 import subprocess
 
+import instrument
+import profiling
+
 def readfile(file):
     with open(file, 'r') as f:
         content = f.readlines()
     return content
 
-def sifting(inputfile, c):
+def sifting(inputfile, c, stats):
     tic = time.perf_counter()
 
     # unzipped = 'ALL.chr{}.vcf'.format(c)
     final = 'sifted.SIFT.chr{}.txt'.format(c)
 
-    rawdata = readfile(inputfile)
+    with stats.phase('read'):
+        rawdata = readfile(inputfile)
 
     print("= Taking columns from {}".format(inputfile))
     print("== Filtering over {} lines".format(len(rawdata)))
@@ -41,17 +45,19 @@ def sifting(inputfile, c):
     #     print('{}/{}'.format(lineno, init_size), end='\r')
 
     siftfile = 'SIFT.chr{}.vcf'.format(c)
-    with open(siftfile, 'w') as f:
-        subprocess.run(["grep -n \"deleterious\|tolerated\" {}".format(inputfile)], shell=True, stdout=f)
+    with stats.phase('filter'):
+        with open(siftfile, 'w') as f:
+            subprocess.run(["grep -n \"deleterious\|tolerated\" {}".format(inputfile)], shell=True, stdout=f)
 
-    data_temp = readfile(siftfile)
+        data_temp = readfile(siftfile)
 
-    r3 = re.compile('.*(rs).*')
-    data = list(filter(r3.match, data_temp))
+        r3 = re.compile('.*(rs).*')
+        data = list(filter(r3.match, data_temp))
+    stats.set(chromosome=c, lines=len(rawdata), variants=len(data))
 
     print("== Starting processing {} lines".format(len(data)))
 
-    with open(final, 'w') as f:
+    with stats.phase('write'), open(final, 'w') as f:
         for l in data:
             # awk '{print $1}' $siftfile | awk -F ":" '{print $1-'$header'}' > $lines #.txt
             line = str(int(l.split('\t')[0].split(':')[0]) - int(header))
@@ -78,4 +84,8 @@ def sifting(inputfile, c):
     print("= Line, id, ENSG id, SIFT, and phenotype printed to {} in {:0.2f} seconds.".format(final, time.perf_counter() - tic))
 
 if __name__ == "__main__":
-    sifting(inputfile=sys.argv[1], c=sys.argv[2])
+    profiling.parse_argv()
+    profiling.start('sifting', 'sifted.SIFT.chr{}'.format(sys.argv[2]))
+    stats = instrument.JobStats('sifting')
+    sifting(inputfile=sys.argv[1], c=sys.argv[2], stats=stats)
+    stats.emit()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Splits a chromosome VCF into the slices of its individuals jobs.
+#
+# Each chunk [counter, stop) of the VCF (the lines individuals.py would keep,
+# without the header) is written to chr{c}n-{counter}-{stop}.vcf, or
+# chr{c}n-{counter}-{stop}.vcf.gz with --compress, in a single pass over the
+# file. individuals.py --slice then reads its slice instead of the whole VCF,
+# so each individuals job only stages its own lines.
+
+import gzip
+import time
+import argparse
+
+import instrument
+import profiling
+
+def slice_name(c, counter, stop, compress=False):
+    return 'chr{}n-{}-{}.vcf{}'.format(c, counter, stop, '.gz' if compress else '')
+
+def split(inputfile, c, total, chunks, stats, compress=False):
+    tic = time.perf_counter()
+    total = int(total)
+    print('= Splitting {} into {} slices'.format(inputfile, len(chunks)))
+
+    # The slices only live until the individuals jobs read them: the fastest level is enough
+    opener = (lambda name, mode: gzip.open(name, mode, compresslevel=1)) if compress else open
+    written = 0
+    with stats.phase('split'), (gzip.open if inputfile.endswith('.gz') else open)(inputfile, 'rt') as f:
+        lines = enumerate(f)
+        for counter, stop in chunks:
+            ending = min(stop, total)
+            with opener(slice_name(c, counter, stop, compress), 'wt') as out:
+                for i, line in lines:
+                    if i >= counter and not line.startswith('#'):
+                        out.write(line)
+                        written += 1
+                    if i + 1 >= ending:
+                        break
+    stats.set(chromosome=c, lines=written, slices=len(chunks))
+    print('= {} lines written to {} slices in {:0.2f} seconds.'.format(written, len(chunks), time.perf_counter() - tic))
+
+
+if __name__ == '__main__':
+    profiling.parse_argv()
+    parser = argparse.ArgumentParser(description='Split a chromosome VCF into the slices of its individuals jobs')
+    parser.add_argument('inputfile', help='chromosome VCF')
+    parser.add_argument('c', help='chromosome number')
+    parser.add_argument('total', help='number of lines of the VCF')
+    parser.add_argument('chunks', nargs='+', help='chunks of the individuals jobs as counter:stop, in order')
+    parser.add_argument('--compress', action='store_true', help='write gzipped slices')
+    args = parser.parse_args()
+
+    chunks = [tuple(int(x) for x in chunk.split(':')) for chunk in args.chunks]
+    profiling.start('split_vcf', 'chr{}n'.format(args.c))
+    stats = instrument.JobStats('split_vcf', compress=args.compress)
+    split(args.inputfile, args.c, args.total, chunks, stats, args.compress)
+    stats.emit()
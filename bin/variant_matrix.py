@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Sparse individuals x variants matrix of a chromosome.
+#
+# individuals_merge.py --format csr writes chr{c}n.npz instead of the 2504
+# per-sample text files of chr{c}n.tar.gz. Row i holds the variants carried by
+# sample i in CSR form, every stored entry being a 1:
+#   indptr, indices            CSR structure
+#   samples                    one sample name per row
+#   pos, id, ref, alt, af      variant metadata, one per column, by POS
+#   chromosome
+#
+# The text files do not tell the VCF order of the variants at the same POS, so
+# these columns are in order of first appearance. The indices of a row are kept
+# in the order of the lines of the sample's text file instead of sorted, and a
+# line repeated in it gives a column of its own (its n-th copy is the n-th
+# column with that content), so the export is the text merge, byte for byte.
+#
+# The analyses only use the rows of a population and the columns of the SIFT
+# variants: genotypes() expands that sub-matrix to a dense 0/1 array, whose
+# products are then done by BLAS.
+# mutation_overlap.py and frequency.py read it with --matrix. The per-sample
+# text layout is exported back with:
+#   variant_matrix.py export chr{c}n.npz chr{c}n.tar.gz
+
+import io
+import time
+import tarfile
+import argparse
+
+import numpy as np
+
+FIELDS = ['pos', 'id', 'ref', 'alt', 'af']
+
+
+class VariantMatrix(object):
+    def __init__(self, chromosome, indptr, indices, samples, variants):
+        self.chromosome = str(chromosome)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.samples = [str(name) for name in samples]
+        self.variants = {field: np.asarray(variants[field]) for field in FIELDS}
+        self.shape = (len(self.samples), len(self.variants['id']))
+
+    @classmethod
+    def from_individuals(cls, chromosome, individuals):
+        # individuals: {sample: lines of its text file ('POS ID REF ALT AF')}
+        columns = {}
+        rows = []
+        for lines in individuals.values():
+            row = []
+            copies = {}
+            for line in lines:
+                item = tuple(line.split())
+                if len(item) != len(FIELDS):
+                    continue
+                # The n-th copy of a line in a file is the n-th column with its content
+                copy = copies.get(item, 0)
+                copies[item] = copy + 1
+                if (item, copy) not in columns:
+                    columns[(item, copy)] = len(columns)
+                row.append(columns[(item, copy)])
+            rows.append(row)
+
+        keys = [item for item, _ in columns]
+        pos = np.array([int(key[0]) for key in keys], dtype=np.int64)
+        # Columns by POS, variants at the same position in order of first appearance
+        order = np.lexsort((np.arange(len(keys)), pos))
+        rank = np.empty(len(keys), dtype=np.int32)
+        rank[order] = np.arange(len(keys), dtype=np.int32)
+
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row) for row in rows])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        for i, row in enumerate(rows):
+            # In the order of the text file, not sorted
+            indices[indptr[i]:indptr[i+1]] = rank[row] if row else []
+
+        variants = {field: [keys[k][f] for k in order] for f, field in enumerate(FIELDS)}
+        variants['pos'] = pos[order]
+        return cls(chromosome, indptr, indices, individuals.keys(), variants)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as f:
+            return cls(f['chromosome'], f['indptr'], f['indices'], f['samples'],
+                       {field: f[field] for field in FIELDS})
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, chromosome=self.chromosome, indptr=self.indptr, indices=self.indices,
+                                samples=np.array(self.samples), **self.variants)
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def genotypes(self, ids, rs_numbers):
+        # Dense 0/1 matrix of the samples ids (rows) and of the distinct rs_numbers they carry (columns)
+        rows = {name: i for i, name in enumerate(self.samples)}
+        wanted = set(rs_numbers)
+        target = np.full(self.shape[1], -1, dtype=np.int32)
+        variants = []
+        seen = {}
+        for k, rs in enumerate(self.variants['id']):
+            if rs not in wanted:
+                continue
+            if rs not in seen:
+                seen[rs] = len(variants)
+                variants.append(str(rs))
+            target[k] = seen[rs]
+
+        matrix = np.zeros((len(ids), len(variants)), dtype=np.uint8)
+        for i, name in enumerate(ids):
+            cols = target[self.row(rows[name])]
+            matrix[i, cols[cols >= 0]] = 1
+        return matrix, variants
+
+    def export(self, archive):
+        # Per-sample text files, as written by individuals_merge.py --format text
+        with tarfile.open(archive, 'w:gz') as tar:
+            for i, name in enumerate(self.samples):
+                content = ''.join('{0}        {1}    {2}    {3}    {4}\n'.format(
+                    *(self.variants[field][k] for field in FIELDS)) for k in self.row(i)).encode()
+                info = tarfile.TarInfo('chr{}.{}'.format(self.chromosome, name))
+                info.size = len(content)
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(content))
+
+
+def mutation_index_array(matrix, variants):
+    return [[variants[k] for k in np.flatnonzero(row)] for row in matrix]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or export a chr{c}n.npz variant matrix')
+    parser.add_argument('command', choices=['info', 'export'])
+    parser.add_argument('matrix', help='chr{c}n.npz written by individuals_merge.py --format csr')
+    parser.add_argument('archive', nargs='?', default=None,
+                        help='export: per-sample archive (default: chr{c}n.tar.gz)')
+    args = parser.parse_args()
+
+    tic = time.perf_counter()
+    vm = VariantMatrix.load(args.matrix)
+    if args.command == 'info':
+        density = vm.nnz / max(1, vm.shape[0] * vm.shape[1])
+        print('= Chromosome {}: {} samples x {} variants, {} entries ({:0.2%})'.format(
+            vm.chromosome, vm.shape[0], vm.shape[1], vm.nnz, density))
+    else:
+        archive = args.archive or 'chr{}n.tar.gz'.format(vm.chromosome)
+        vm.export(archive)
+        print('= Exported {} samples to {} in {:0.2f} sec'.format(vm.shape[0], archive, time.perf_counter() - tic))
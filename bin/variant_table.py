@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Variants of an individuals chunk, stored once and shared by all the samples.
+#
+# The rows of the chunk ('POS        ID    REF    ALT    AF', the lines of the
+# per-sample files) are kept in a single uint8 buffer, newline terminated, with
+# the offset of each row. A sample is then the int32 array of the rows it
+# carries: those whose AF asks for the first allele of its column (0 when
+# AF >= 0.5, 1 otherwise), rows whose AF is not a number being carried by
+# nobody. individuals.py writes the sample files from it and
+# individuals_mpi.py sends it as it is to the merge ranks (mpi_transport.py).
+
+import math
+
+import numpy as np
+
+START_DATA = 9  # where the real data start, the first 0|1, 1|1, 1|0 or 0|0
+
+ROW = "{0}        {1}    {2}    {3}    {4}\n"
+NOT_A_NUMBER = 255
+
+
+class VariantTable(object):
+    def __init__(self, buffer):
+        self.buffer = np.asarray(buffer, dtype=np.uint8)
+        self.offsets = np.concatenate(([0], np.flatnonzero(self.buffer == ord('\n')) + 1)).astype(np.int64)
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows: newline terminated strings
+        return cls(np.frombuffer(''.join(rows).encode(), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, k):
+        return self.buffer[self.offsets[k]:self.offsets[k+1]].tobytes().decode()
+
+    def gather(self, indices):
+        # The bytes of rows indices, in that order, in a single copy
+        starts = self.offsets[indices]
+        lengths = self.offsets[np.asarray(indices) + 1] - starts
+        if not lengths.size:
+            return b''
+        shift = starts - np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return self.buffer[np.arange(lengths.sum()) + np.repeat(shift, lengths)].tobytes()
+
+    def take(self, indices):
+        # A table of rows indices, in that order
+        return VariantTable(np.frombuffer(self.gather(indices), dtype=np.uint8))
+
+    def write(self, f, indices):
+        # f is opened in binary mode
+        f.write(self.gather(indices))
+
+
+def parse(data, alleles, start_data=START_DATA):
+    # Rows of the lines of data and first allele of every sample (rows of alleles) and line
+    # (columns), the byte of split('|')[0] when it is a single character and 0 otherwise.
+    # Returns the table and the allele each line is kept for.
+    n_samples = alleles.shape[0]
+    wanted = np.full(len(data), NOT_A_NUMBER, dtype=np.uint8)
+    rows = []
+    for k, line in enumerate(data):
+        second = line.split('\t', 8)[0:8]
+        second = [elem for id, elem in enumerate(second) if id in [1, 2, 3, 4, 7]]
+        af_value = second[4].split(';')[8].split('=')[1]
+        second[4] = af_value
+        rows.append(ROW.format(*second))
+        try:
+            # We only keep the first value if more than one (that's what awk is doing)
+            af_value = float(af_value.split(',')[0])
+        except ValueError:
+            af_value = math.nan
+        # Neither comparison holds for nan, the row is carried by nobody
+        if not math.isnan(af_value):
+            wanted[k] = ord('0') if af_value >= 0.5 else ord('1')
+
+        raw = np.frombuffer(line.encode(), dtype=np.uint8)
+        tabs = np.flatnonzero(raw == ord('\t'))
+        if len(tabs) < start_data - 1 + n_samples:
+            raise IndexError("line {} has fewer than {} samples".format(k, n_samples))
+        starts = tabs[start_data - 1:start_data - 1 + n_samples] + 1
+        ends = np.append(tabs, len(raw))[start_data:start_data + n_samples]
+        first = raw[np.minimum(starts, len(raw) - 1)]
+        following = raw[np.minimum(starts + 1, len(raw) - 1)]
+        single = (ends - starts == 1) | ((ends - starts > 1) & (following == ord('|')))
+        alleles[:, k] = np.where(single, first, 0)
+    return VariantTable.from_rows(rows), wanted
+
+
+def sample_rows(alleles, wanted, i):
+    # Rows carried by sample i
+    return np.flatnonzero(alleles[i] == wanted).astype(np.int32)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Discovery of the input data of a dataset, instead of a hand-written data.csv.
+#
+# The chromosome VCFs are the ALL.chr<c>.*.vcf files of data/<dataset> (or
+# their .vcf.gz when there is no uncompressed copy) and their annotations the
+# ALL.chr<c>.*annotation.vcf files of data/<dataset>/sifting. The number of
+# lines of each VCF (what data.csv gives, as 'wc -l' counts them) is counted in
+# parallel, plain files by chunks of bytes and compressed files one per worker,
+# and cached in a sidecar next to the data:
+#
+#   data/<dataset>/.line_counts.json    {filename: {"size", "mtime", "lines"}}
+#
+# daxgen.py --discover uses it directly, and the rows can be written to a
+# data.csv for the other runners:
+#   ./data_discovery.py -D 20130502 -o data.csv
+
+import os
+import re
+import gzip
+import json
+import tempfile
+import multiprocessing
+from argparse import ArgumentParser
+
+CHUNK_SIZE = 64 << 20
+CACHE = '.line_counts.json'
+VCF = re.compile(r'^ALL\.chr(\w+?)\..*\.vcf(\.gz)?$')
+
+
+def count_range(task):
+    # Newlines in [offset, offset + length) of a plain file, or in a whole compressed file
+    path, offset, length = task
+    count = 0
+    if length is None:
+        with gzip.open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                count += block.count(b'\n')
+        return path, count
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(1 << 20, length))
+            if not block:
+                break
+            count += block.count(b'\n')
+            length -= len(block)
+    return path, count
+
+
+def count_lines(paths, workers=None, chunk_size=CHUNK_SIZE):
+    # {path: number of lines}, all the files being counted by the same pool
+    tasks = []
+    for path in paths:
+        if path.endswith('.gz'):
+            tasks.append((path, 0, None))
+            continue
+        size = os.path.getsize(path)
+        tasks += [(path, offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+    counts = {path: 0 for path in paths}
+    if not tasks:
+        return counts
+    with multiprocessing.Pool(min(workers or os.cpu_count(), len(tasks))) as pool:
+        for path, count in pool.imap_unordered(count_range, tasks):
+            counts[path] += count
+    return counts
+
+
+def load_cache(data_dir):
+    try:
+        with open(os.path.join(data_dir, CACHE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(data_dir, cache):
+    # Written aside and renamed, like the manifest
+    fd, tmp = tempfile.mkstemp(prefix='.line_counts-', dir=data_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(tmp, os.path.join(data_dir, CACHE))
+
+
+def find_files(directory, annotation):
+    # {chromosome: filename}, the uncompressed file when both forms are there
+    found = {}
+    for filename in sorted(os.listdir(directory)):
+        match = VCF.match(filename)
+        if not match or ('annotation' in filename) != annotation:
+            continue
+        c = match.group(1)
+        if c not in found or found[c].endswith('.gz'):
+            found[c] = filename
+    return found
+
+
+def chromosome_order(c):
+    return (0, int(c), '') if c.isdigit() else (1, 0, c)
+
+
+def discover(data_dir, workers=None):
+    # data.csv rows [vcf, lines, annotation] of the chromosomes with both files, in chromosome order
+    vcfs = find_files(data_dir, annotation=False)
+    sifting_dir = os.path.join(data_dir, 'sifting')
+    annotations = find_files(sifting_dir, annotation=True) if os.path.isdir(sifting_dir) else {}
+    for c in sorted(set(vcfs) - set(annotations), key=chromosome_order):
+        print("WARNING: no annotation for {} in {}, skipped".format(vcfs[c], sifting_dir))
+
+    chromosomes = sorted(set(vcfs) & set(annotations), key=chromosome_order)
+    cache = load_cache(data_dir)
+    todo = []
+    for c in chromosomes:
+        st = os.stat(os.path.join(data_dir, vcfs[c]))
+        known = cache.get(vcfs[c])
+        if not known or known['size'] != st.st_size or known['mtime'] != st.st_mtime_ns:
+            todo.append(os.path.join(data_dir, vcfs[c]))
+    if todo:
+        print("= Counting the lines of {} files".format(len(todo)))
+        for path, lines in count_lines(todo, workers).items():
+            st = os.stat(path)
+            cache[os.path.basename(path)] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'lines': lines}
+        try:
+            save_cache(data_dir, cache)
+        except OSError as e:
+            print("WARNING: cannot save the line counts in {}: {}".format(data_dir, e.strerror))
+
+    # Rows name the uncompressed VCF, like data.csv: daxgen.py and vine_genomes.py use the .gz
+    # when it is the only copy
+    return [[vcfs[c][:-3] if vcfs[c].endswith('.gz') else vcfs[c], cache[vcfs[c]]['lines'], annotations[c]]
+            for c in chromosomes]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Discover the chromosomes of a dataset and count their lines")
+    parser.add_argument('-D', '--dataset', default='20130502', help='Dataset folder')
+    parser.add_argument('-p', '--src-path', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='Source directory with data/<dataset>')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of counting processes')
+    parser.add_argument('-o', '--output', default=None, help='Write the rows to this data.csv')
+    args = parser.parse_args()
+
+    rows = discover(os.path.join(args.src_path, 'data', args.dataset), args.workers)
+    lines = ''.join('{},{},{}\n'.format(*row) for row in rows)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(lines)
+        print("= {} chromosomes written to {}".format(len(rows), args.output))
+    else:
+        print(lines, end='')
@@ -5,9 +5,18 @@ import sys
 import logging
 import os
 import csv
+import collections
 from datetime import datetime
 from pathlib import Path
 
+import job_planner
+import manifest
+import data_discovery
+
+# The layout of the sample shards is shared with the jobs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin'))
+import sample_shards
+
 logging.basicConfig(level=logging.INFO)
 
 # --- Import Pegasus API ------------------------------------------------------
@@ -37,6 +46,26 @@ class GenomeWorkflow(object):
                     use_decaf: Optional[bool] = False,
                     use_pmc: Optional[bool] = False,
                     custom_site_file: Optional[str] = None,
+                    genotype_cache: Optional[str] = None,
+                    target_runtime: Optional[float] = None,
+                    cores: int = 1,
+                    calibration: Optional[str] = None,
+                    profile: Optional[str] = None,
+                    sift_prefilter: Optional[bool] = False,
+                    variant_matrix: Optional[bool] = False,
+                    manifest: Optional[str] = None,
+                    subworkflows: Optional[bool] = False,
+                    priorities: Optional[bool] = False,
+                    colocate_analyses: Optional[int] = None,
+                    discover: Optional[bool] = False,
+                    individuals_workers: int = 1,
+                    sample_shards: Optional[int] = None,
+                    shard_populations: Optional[List[str]] = None,
+                    split_vcf: Optional[bool] = False,
+                    compress_slices: Optional[bool] = False,
+                    resource_profiles: Optional[bool] = False,
+                    cluster_size: Optional[int] = None,
+                    cluster_runtime: Optional[int] = None,
                 ) -> None:
 
         self.wf_name = "1000-genome"
@@ -55,9 +84,58 @@ class GenomeWorkflow(object):
         self.use_decaf = use_decaf
         self.use_pmc = use_pmc
         self.custom_site_file = custom_site_file
+        self.genotype_cache = genotype_cache
+        self.target_runtime = target_runtime
+        self.cores = cores
+        self.seconds_per_cell = job_planner.SECONDS_PER_CELL
+        if calibration:
+            self.seconds_per_cell = job_planner.load_calibration(calibration)
+        self.profile = profile
+        self.sift_prefilter = sift_prefilter
+        self.variant_matrix = variant_matrix
+        self.manifest = manifest
+        self.subworkflows = subworkflows
+        self.priorities = priorities
+        self.colocate_analyses = colocate_analyses
+        self.discover = discover
+        self.individuals_workers = individuals_workers
+        self.sample_shards = sample_shards
+        self.shard_populations = shard_populations
+        # sample_shards.py layout, set in create_replica_catalog
+        self.layout = None
+        # estimated runtime of the jobs (job_planner.py), for the priorities
+        self.runtimes = {}
+        self.split_vcf = split_vcf
+        self.compress_slices = compress_slices
+        self.resource_profiles = resource_profiles
+        self.cluster_size = cluster_size
+        self.cluster_runtime = cluster_runtime
 
         if self.use_decaf:
             print("Using Decaf...")
+            if self.profile:
+                print("WARNING: the profiles of the Decaf jobs are not staged out")
+        if self.variant_matrix and (self.use_decaf or use_bash):
+            print("WARNING: only individuals_merge.py writes the variant matrix, using chr{c}n.tar.gz")
+            self.variant_matrix = False
+        if self.variant_matrix and self.genotype_cache:
+            print("WARNING: the analysis jobs read the variant matrix, the genotype cache is disabled")
+            self.genotype_cache = None
+        if self.split_vcf and (self.use_decaf or use_bash):
+            print("WARNING: only individuals.py reads the VCF slices, every individuals job stages the whole VCF")
+            self.split_vcf = False
+        if self.individuals_workers > 1 and use_bash:
+            print("WARNING: only individuals.py writes the samples with several processes")
+            self.individuals_workers = 1
+        if (self.sample_shards or self.shard_populations) and (self.use_decaf or use_bash):
+            print("WARNING: only individuals.py and individuals_merge.py write sample shards, using chr{c}n.tar.gz")
+            self.sample_shards = self.shard_populations = None
+        if (self.sample_shards or self.shard_populations) and (self.variant_matrix or self.genotype_cache):
+            print("WARNING: the variant matrix and the genotype cache hold all the samples, using chr{c}n.tar.gz")
+            self.sample_shards = self.shard_populations = None
+        if (self.cluster_size or self.cluster_runtime) and (self.use_decaf or self.use_pmc):
+            print("WARNING: the individuals jobs are already clustered by label, horizontal clustering is disabled")
+            self.cluster_size = self.cluster_runtime = None
             
         if self.use_pmc:
             print("Using PMC...")
@@ -66,6 +144,7 @@ class GenomeWorkflow(object):
         if self.exec_site == "cori":
             self.file_site = "cori"
         
+        self.use_bash = use_bash
         self.suffix = ".py"
         if use_bash:
             self.suffix = ""
@@ -135,6 +214,11 @@ class GenomeWorkflow(object):
             )
             # .add_profiles(Namespace.PEGASUS, key="label", value="decaf")
         )
+        # Horizontal clustering of the individuals jobs of a level, by count or by estimated runtime
+        if self.cluster_size:
+            e_individuals.add_pegasus_profile(clusters_size=self.cluster_size)
+        if self.cluster_runtime:
+            e_individuals.add_pegasus_profile(clusters_max_runtime=self.cluster_runtime)
         e_individuals_merge = (
             Transformation(
                 "individuals_merge",
@@ -166,6 +250,15 @@ class GenomeWorkflow(object):
         self.tc.add_transformations(
             e_individuals, e_individuals_merge, e_sifting, e_mutation_overlap, e_freq)
 
+        if self.split_vcf:
+            e_split = Transformation(
+                "split_vcf",
+                site="local",
+                pfn=self.src_path + '/bin/split_vcf.py',
+                is_stageable=True,
+            )
+            self.tc.add_transformations(e_split)
+
     # --- Replica Catalog -----------------
 
     def create_replica_catalog(self) -> None:
@@ -180,121 +273,296 @@ class GenomeWorkflow(object):
             self.rc.add_replica(site=self.file_site, lfn=popfile,
                                 pfn=self.src_path + '/data/populations/' + popfile.lfn)
 
+        # Helper modules imported by every script: job records and optional profiling
+        self.helpers = [File('instrument.py'), File('profiling.py')]
+        for helper in self.helpers:
+            self.rc.add_replica(site=self.file_site, lfn=helper,
+                                pfn=self.src_path + '/bin/' + helper.lfn)
+
+        # Helper module of the individuals jobs: the variants of a chunk, shared by its samples
+        self.variant_table_py = File('variant_table.py')
+        self.rc.add_replica(site=self.file_site, lfn=self.variant_table_py,
+                            pfn=self.src_path + '/bin/variant_table.py')
+
+        # Helper module of the in-memory individuals -> merge transport (Decaf)
+        if self.use_decaf:
+            self.mpi_transport_py = File('mpi_transport.py')
+            self.rc.add_replica(site=self.file_site, lfn=self.mpi_transport_py,
+                                pfn=self.src_path + '/bin/mpi_transport.py')
+
+        # Helper module imported by the analysis jobs when the genotype cache is enabled
+        if self.genotype_cache:
+            self.genotype_cache_py = File('genotype_cache.py')
+            self.rc.add_replica(site=self.file_site, lfn=self.genotype_cache_py,
+                                pfn=self.src_path + '/bin/genotype_cache.py')
+
+        # Helper module of the merge and analysis jobs when the chromosomes are sparse matrices
+        if self.variant_matrix:
+            self.variant_matrix_py = File('variant_matrix.py')
+            self.rc.add_replica(site=self.file_site, lfn=self.variant_matrix_py,
+                                pfn=self.src_path + '/bin/variant_matrix.py')
+
+        # Layout of the sample shards of the individuals outputs, and its helper module
+        if self.sample_shards or self.shard_populations:
+            samples = sample_shards.read_samples(self.src_path + '/data/' + self.dataset + '/' + self.columns.lfn)
+            if self.sample_shards:
+                self.layout = sample_shards.by_index(samples, self.sample_shards)
+            else:
+                self.layout = sample_shards.by_population(
+                    samples, [self.wf_dir + 'data/populations/' + pop for pop in self.shard_populations])
+            # Written in the directory of this workflow, along its scratch and output directories
+            layout_path = os.path.join(self.wf_dir, self.wid, 'shards.json')
+            os.makedirs(os.path.dirname(layout_path), exist_ok=True)
+            sample_shards.save(self.layout, layout_path)
+            print("Sample layout {}: {} shards by {}".format(layout_path, len(self.layout['shards']), self.layout['by']))
+            self.layout_file = File('shards.json')
+            self.rc.add_replica(site=self.file_site, lfn=self.layout_file, pfn=layout_path)
+            self.sample_shards_py = File('sample_shards.py')
+            self.rc.add_replica(site=self.file_site, lfn=self.sample_shards_py,
+                                pfn=self.src_path + '/bin/sample_shards.py')
+
+    # --- Profiling -----------------------------------------------------------
+    def add_profile(self, job, stage, name):
+        # The job profiles itself (bin/profiling.py) and the profile is staged out with the outputs
+        if not self.profile:
+            return
+        ext = '.prof' if self.profile == 'cprofile' else '.collapsed'
+        job.add_env(JOB_PROFILE=self.profile)
+        job.add_outputs(File('%s.%s%s' % (stage, name, ext)), stage_out=True, register_replica=False)
+
+    # --- Input data ----------------------------------------------------------
+    def data_rows(self):
+        # base file, number of lines, annotations: from data.csv or found in the dataset folder
+        if self.discover:
+            return data_discovery.discover(self.src_path + '/data/' + self.dataset)
+        with open(self.datafile, 'r') as f:
+            return [row for row in csv.reader(f) if row]
+
+    # --- Resources -----------------------------------------------------------
+    def add_resources(self, job, stage, lines, samples, input_bytes=0, cores=1, compress=False):
+        # cores, memory and runtime of the job from the cost model of job_planner.py
+        resources = job_planner.job_resources(stage, lines, samples, input_bytes, self.seconds_per_cell, cores,
+                                              compress)
+        self.runtimes[job] = resources['runtime']
+        if self.resource_profiles:
+            job.add_pegasus_profile(cores=resources['cores'], memory=str(resources['memory']),
+                                    runtime=str(resources['runtime']))
+        elif self.cluster_runtime and stage == 'individuals':
+            # Clustering by runtime needs the runtime of every individuals job
+            job.add_pegasus_profile(runtime=str(resources['runtime']))
+        return resources
+
     # --- Create Workflow -----------------------------------------------------
 
     def create_workflow(self) -> None:
         self.wf = Workflow(self.wf_name, infer_dependencies=True)
 
         c_nums = []
+        thresholds = []
         individuals_files = []
         sifted_files = []
         sifted_jobs = []
         individuals_merge_jobs = []
+        # ids of the jobs of each chromosome, for the sub-workflows
+        chromosome_jobs = {}
         
-        with open(self.datafile, 'r') as f:
-            for row in csv.reader(f):
-                # base file, 250k, annotations
-                base_file = row[0]
-                threshold = int(row[1])
+        n_samples = job_planner.count_samples(
+            self.src_path + '/data/' + self.dataset + '/' + self.columns.lfn)
+        population_sizes = {}
+        population_samples = {}
+        for f_pop in self.populations:
+            with open(self.wf_dir + 'data/populations/' + f_pop.lfn, 'r') as f:
+                population_samples[f_pop.lfn] = f.read().split()
+            population_sizes[f_pop.lfn] = len(population_samples[f_pop.lfn])
+
+        # The cores are shared by the individuals jobs of all chromosomes
+        rows = self.data_rows()
+        cores = max(1, self.cores // max(1, len(rows)))
+
+        for row in rows:
+            # base file, 250k, annotations
+            base_file = row[0]
+            threshold = int(row[1])
+            if self.target_runtime:
+                chunks = job_planner.plan_chunks(threshold, n_samples, self.target_runtime,
+                                                 cores, self.seconds_per_cell)
+            else:
                 # To ensure we do not create too many individuals jobs
-                ind_jobs = min(self.ind_jobs, threshold)
-                step = threshold // ind_jobs
-                rest = threshold % ind_jobs
-                if rest != 0:
-                    sys.exit("ERROR: for file {}: required individuals jobs {} does not divide the number of rows {}.".format(
-                        base_file, ind_jobs, threshold))
-
-                counter = 1
-
-                individuals_jobs = []
-                output_files = []
-
-                # Individuals Jobs
-                # the input file for individuals is the base file 
-                f_individuals = File(base_file)
-                self.rc.add_replica(site=self.file_site, lfn=f_individuals, pfn=self.src_path +
-                                    '/data/' + self.dataset + '/' + f_individuals.lfn)
-
-                # get the c number (chromosome?). Looks like it is in the filename eg ALL.chr1.250000.vcf 
-                c_num = base_file[base_file.find('chr')+3:]
-                c_num = c_num[0:c_num.find('.')]
-                c_nums.append(c_num)
-
-                # while the counter is less than num rows of data file
-                # step / threshold num jobs
-                while counter < threshold:
-                    stop = counter + step
-
-                    # we create an ouput file of the format, 
-                    out_name = 'chr%sn-%s-%s.tar.gz' % (c_num, counter, stop)
-                    output_files.append(out_name)
-                    # f chr new output file
-                    f_chrn = File(out_name)
-
-
-                    # new job with args - data_file, chr number, number of chr? number of proc?, max proc?
-                    # ./individuals ALL.chr1.xyz 1 100 200 250000 
-                    # input pegasus file objects, f_indiv, columns.txt?
-                    # output pegasus file objects chrn. some flags
-                    j_individuals = (
-                        Job('individuals')
-                            .add_args(f_individuals, c_num, str(counter), str(stop), str(threshold))
-                            .add_inputs(f_individuals, self.columns)
-                            .add_outputs(f_chrn, stage_out=False, register_replica=False)
-                    )
-                    if self.use_decaf or self.use_pmc:
-                        j_individuals.add_profiles(Namespace.PEGASUS, key="label", value="cluster1")
-
-                    individuals_jobs.append(j_individuals)
-                    self.wf.add_jobs(j_individuals)
-
-                    counter = counter + step
-
-                # merge job
-                j_individuals_merge = Job('individuals_merge').add_args(c_num)
+                chunks = job_planner.split_lines(threshold, self.ind_jobs)
+            print("{}: {} individuals jobs of about {} lines".format(
+                base_file, len(chunks), threshold // len(chunks)))
+
+            first_job = len(self.wf.jobs)
+            individuals_jobs = []
+            output_files = []
+
+            # Individuals Jobs
+            # the input file for individuals is the base file, or its .gz when it is the only copy
+            # (data_discovery.py), which the Python jobs read as it is
+            vcf_path = self.src_path + '/data/' + self.dataset + '/' + base_file
+            if not os.path.exists(vcf_path) and os.path.exists(vcf_path + '.gz'):
+                if self.use_bash:
+                    sys.exit("ERROR: the bash jobs cannot read {}.gz, decompress it first (gunzip -k)".format(vcf_path))
+                base_file += '.gz'
+                vcf_path += '.gz'
+            f_individuals = File(base_file)
+            self.rc.add_replica(site=self.file_site, lfn=f_individuals, pfn=vcf_path)
+
+            # get the c number (chromosome?). Looks like it is in the filename eg ALL.chr1.250000.vcf 
+            c_num = base_file[base_file.find('chr')+3:]
+            c_num = c_num[0:c_num.find('.')]
+            c_nums.append(c_num)
+            thresholds.append(threshold)
+
+            f_sifted = File('sifted.SIFT.chr%s.txt' % c_num)
+            sifted_files.append(f_sifted)
+
+            # The VCF is cut once into the slices of the individuals jobs, which only stage their own
+            if self.split_vcf:
+                j_split = (
+                    Job('split_vcf')
+                        .add_args(f_individuals, c_num, str(threshold))
+                        .add_args(*['%s:%s' % (counter, stop) for counter, stop in chunks])
+                        .add_inputs(f_individuals, *self.helpers)
+                )
+                if self.compress_slices:
+                    j_split.add_args('--compress')
+                for counter, stop in chunks:
+                    j_split.add_outputs(File('chr%sn-%s-%s.vcf%s' % (c_num, counter, stop, '.gz' if self.compress_slices else '')),
+                                        stage_out=False, register_replica=False)
+                self.add_profile(j_split, 'split_vcf', 'chr%sn' % c_num)
+                self.add_resources(j_split, 'split_vcf', threshold, n_samples, compress=self.compress_slices)
+                self.wf.add_jobs(j_split)
+
+            # one job per chunk [counter, stop) of the data file
+            for counter, stop in chunks:
+                # we create an ouput file of the format, 
+                out_name = 'chr%sn-%s-%s.tar.gz' % (c_num, counter, stop)
+                output_files.append(out_name)
+                # f chr new output file
+                f_chrn = File(out_name)
+
+
+                # new job with args - data_file, chr number, number of chr? number of proc?, max proc?
+                # ./individuals ALL.chr1.xyz 1 100 200 250000 
+                # input pegasus file objects, f_indiv, columns.txt?
+                # output pegasus file objects chrn. some flags
+                f_input = f_individuals
+                if self.split_vcf:
+                    f_input = File('chr%sn-%s-%s.vcf%s' % (c_num, counter, stop, '.gz' if self.compress_slices else ''))
+                j_individuals = (
+                    Job('individuals')
+                        .add_args(f_input, c_num, str(counter), str(stop), str(threshold))
+                        .add_inputs(f_input, self.columns, self.variant_table_py, *self.helpers)
+                )
+                if self.layout:
+                    # One archive per shard of samples
+                    j_individuals.add_args('--shards', self.layout_file)
+                    j_individuals.add_inputs(self.layout_file, self.sample_shards_py)
+                    for shard in self.layout['shards']:
+                        j_individuals.add_outputs(File(sample_shards.archive_name(out_name, shard)),
+                                                  stage_out=False, register_replica=False)
+                else:
+                    j_individuals.add_outputs(f_chrn, stage_out=False, register_replica=False)
+                if self.split_vcf:
+                    j_individuals.add_args('--slice')
+                if self.sift_prefilter:
+                    # Only the variants with a SIFT score are extracted, individuals now depends on sifting
+                    j_individuals.add_args('--sift-file', f_sifted).add_inputs(f_sifted)
+                if self.use_decaf or self.use_pmc:
+                    j_individuals.add_profiles(Namespace.PEGASUS, key="label", value="cluster1")
+                if self.use_decaf:
+                    j_individuals.add_inputs(self.mpi_transport_py)
+                else:
+                    self.add_profile(j_individuals, 'individuals', 'chr%sn-%s-%s' % (c_num, counter, stop))
+                # Without slices, every individuals job reads the whole VCF
+                vcf_lines = stop - counter if self.split_vcf else threshold
+                self.add_resources(j_individuals, 'individuals', stop - counter, n_samples,
+                                   vcf_lines * n_samples * job_planner.VCF_BYTES_PER_CELL,
+                                   self.individuals_workers)
+                if self.individuals_workers > 1:
+                    # The samples of the chunk are written by several processes
+                    j_individuals.add_args('--workers', str(self.individuals_workers))
+                    j_individuals.add_pegasus_profile(cores=self.individuals_workers)
+
+                individuals_jobs.append(j_individuals)
+                self.wf.add_jobs(j_individuals)
+
+            # merge job, one per shard of samples with a layout, each reading its archive of every chunk
+            merged_files = {}
+            for shard in (self.layout['shards'] if self.layout else [None]):
+                j_individuals_merge = (
+                    Job('individuals_merge')
+                        .add_args(c_num)
+                        .add_inputs(*self.helpers)
+                )
 
                 for out_name in output_files:
-                    f_chrn = File(out_name)
+                    f_chrn = File(sample_shards.archive_name(out_name, shard) if shard else out_name)
                     j_individuals_merge.add_inputs(f_chrn)
                     j_individuals_merge.add_args(f_chrn)
 
                 individuals_filename = 'chr%sn.tar.gz' % c_num
+                if shard:
+                    individuals_filename = 'chr%sn.%s.tar.gz' % (c_num, shard)
+                    j_individuals_merge.add_args('--shard', shard)
+                if self.variant_matrix:
+                    individuals_filename = 'chr%sn.npz' % c_num
+                    j_individuals_merge.add_args('--format', 'csr').add_inputs(self.variant_matrix_py)
                 f_chrn_merged = File(individuals_filename)
-                individuals_files.append(f_chrn_merged)
+                merged_files[shard] = f_chrn_merged
                 j_individuals_merge.add_outputs(f_chrn_merged, stage_out=False, register_replica=False)
                 if self.use_decaf or self.use_pmc:
                     j_individuals_merge.add_profiles(Namespace.PEGASUS, key="label", value="cluster1")
+                if self.use_decaf:
+                    # The merge ranks take the sample names from columns.txt
+                    j_individuals_merge.add_inputs(self.columns, self.mpi_transport_py, self.variant_table_py)
+                else:
+                    self.add_profile(j_individuals_merge, 'individuals_merge',
+                                     'chr%sn.%s' % (c_num, shard) if shard else 'chr%sn' % c_num)
+                self.add_resources(j_individuals_merge, 'individuals_merge', threshold,
+                                   len(self.layout['shards'][shard]) if shard else n_samples)
 
                 self.wf.add_jobs(j_individuals_merge)
                 individuals_merge_jobs.append(j_individuals_merge)
-                
-                # Sifting Job
-                f_sifting = File(row[2])
-                self.rc.add_replica(site=self.file_site, lfn=f_sifting, pfn=self.src_path +
-                                    '/data/' + self.dataset + '/sifting/' + f_sifting.lfn)
-
-                f_sifted = File('sifted.SIFT.chr%s.txt' % c_num)
-                sifted_files.append(f_sifted)
-
-                j_sifting = (
-                    Job('sifting')
-                        .add_inputs(f_sifting)
-                        .add_outputs(f_sifted, stage_out=False, register_replica=False)
-                        .add_args(f_sifting, c_num)
-                )
+            individuals_files.append(merged_files if self.layout else merged_files[None])
+            
+            # Sifting Job
+            f_sifting = File(row[2])
+            self.rc.add_replica(site=self.file_site, lfn=f_sifting, pfn=self.src_path +
+                                '/data/' + self.dataset + '/sifting/' + f_sifting.lfn)
+
+            j_sifting = (
+                Job('sifting')
+                    .add_inputs(f_sifting, *self.helpers)
+                    .add_outputs(f_sifted, stage_out=False, register_replica=False)
+                    .add_args(f_sifting, c_num)
+            )
+            self.add_profile(j_sifting, 'sifting', 'sifted.SIFT.chr%s' % c_num)
+            annotation = self.src_path + '/data/' + self.dataset + '/sifting/' + f_sifting.lfn
+            self.add_resources(j_sifting, 'sifting', threshold, 1,
+                               os.path.getsize(annotation) if os.path.exists(annotation) else 0)
 
-                self.wf.add_jobs(j_sifting)
-                sifted_jobs.append(j_sifting)
+            self.wf.add_jobs(j_sifting)
+            sifted_jobs.append(j_sifting)
+            chromosome_jobs[c_num] = list(self.wf.jobs)[first_job:]
 
         # Analyses jobs
         for i in range(len(individuals_files)):
+            first_job = len(self.wf.jobs)
             for f_pop in self.populations:
+                f_individuals_in = [individuals_files[i]]
+                if self.layout:
+                    # Only the shards holding samples of the population
+                    f_individuals_in = [individuals_files[i][shard] for shard in
+                                        sample_shards.shards_of(self.layout, population_samples[f_pop.lfn])]
                 # Mutation Overlap Job
                 f_mut_out = File('chr%s-%s.tar.gz' % (c_nums[i], f_pop.lfn))
                 j_mutation = (
                     Job('mutation_overlap')
                         .add_args('-c', c_nums[i], '-pop', f_pop)
-                        .add_inputs(individuals_files[i], sifted_files[i], f_pop, self.columns)
+                        .add_inputs(*f_individuals_in, sifted_files[i], f_pop, self.columns,
+                                    *self.helpers)
                         .add_outputs(f_mut_out, stage_out=True, register_replica=False)
                 )
                 # Frequency Mutations Overlap Job
@@ -302,19 +570,176 @@ class GenomeWorkflow(object):
                 j_freq = (
                     Job('frequency')
                         .add_args('-c', c_nums[i], '-pop', f_pop)
-                        .add_inputs(individuals_files[i], sifted_files[i], f_pop, self.columns)
+                        .add_inputs(*f_individuals_in, sifted_files[i], f_pop, self.columns,
+                                    *self.helpers)
                         .add_outputs(f_freq_out, stage_out=True, register_replica=False)
                 )
+                self.add_profile(j_mutation, 'mutation_overlap', 'chr%s-%s' % (c_nums[i], f_pop.lfn))
+                self.add_profile(j_freq, 'frequency', 'chr%s-%s-freq' % (c_nums[i], f_pop.lfn))
+                resources = [
+                    self.add_resources(j_mutation, 'mutation_overlap', thresholds[i], population_sizes[f_pop.lfn]),
+                    self.add_resources(j_freq, 'frequency', thresholds[i], population_sizes[f_pop.lfn]),
+                ]
+                if self.colocate_analyses:
+                    # The analyses of a chromosome are one clustered job running on the cores of a
+                    # node, its archive and sifted file are staged in once
+                    for j, r in zip((j_mutation, j_freq), resources):
+                        j.add_profiles(Namespace.PEGASUS, key="label", value="analyses-chr%s" % c_nums[i])
+                        j.add_pegasus_profile(cores=self.colocate_analyses)
+                        if not self.use_pmc:
+                            # pegasus-cluster runs up to CORES tasks in parallel
+                            j.add_pegasus_profile(job_aggregator_arguments='-n %d' % self.colocate_analyses)
+                        if self.resource_profiles:
+                            j.add_pegasus_profile(memory=str(r['memory'] * self.colocate_analyses))
+                if self.genotype_cache:
+                    for j in (j_mutation, j_freq):
+                        j.add_args('--cache-dir', self.genotype_cache)
+                        j.add_inputs(self.genotype_cache_py)
+                if self.layout:
+                    for j in (j_mutation, j_freq):
+                        j.add_args('--shards', self.layout_file)
+                        j.add_inputs(self.layout_file, self.sample_shards_py)
+                if self.variant_matrix:
+                    for j in (j_mutation, j_freq):
+                        j.add_args('--matrix', individuals_files[i])
+                        j.add_inputs(self.variant_matrix_py)
                 self.wf.add_jobs(j_mutation, j_freq)
+            chromosome_jobs[c_nums[i]] += list(self.wf.jobs)[first_job:]
+
+        if self.manifest:
+            self.apply_manifest()
+        if self.priorities:
+            self.add_priorities(chromosome_jobs)
+        if self.subworkflows:
+            self.create_subworkflows(chromosome_jobs)
+
+    # --- Priorities ----------------------------------------------------------
+
+    def add_priorities(self, chromosome_jobs) -> None:
+        # Condor and DAGMan priorities from the critical paths of the estimated runtimes
+        producers = {}
+        for job_id, job in self.wf.jobs.items():
+            for f in job.get_outputs():
+                producers[f.lfn] = job_id
+        parents = collections.defaultdict(set)
+        children = collections.defaultdict(set)
+        for job_id, job in self.wf.jobs.items():
+            for f in job.get_inputs():
+                if f.lfn in producers:
+                    parents[job_id].add(producers[f.lfn])
+                    children[producers[f.lfn]].add(job_id)
+
+        # Longest estimated path from each job to the end of the workflow
+        bottom = {}
+        def bottom_level(job_id):
+            if job_id not in bottom:
+                bottom[job_id] = self.runtimes.get(self.wf.jobs[job_id], 0) + max(
+                    [bottom_level(child) for child in children[job_id]], default=0)
+            return bottom[job_id]
+
+        # The chromosome with the longest critical path first, and its jobs ahead of the next chromosome
+        chromosome = {job_id: c_num for c_num, job_ids in chromosome_jobs.items() for job_id in job_ids}
+        length = collections.defaultdict(int)
+        for job_id in self.wf.jobs:
+            length[chromosome[job_id]] = max(length[chromosome[job_id]], bottom_level(job_id))
+        order = {c_num: rank for rank, c_num in enumerate(sorted(length, key=lambda c_num: -length[c_num]))}
+
+        def key(job_id):
+            # sifting and split_vcf are cheap and hold back all the other jobs of their chromosome
+            gate = self.wf.jobs[job_id].transformation in ('sifting', 'split_vcf')
+            return (gate, -order[chromosome[job_id]], bottom_level(job_id))
+
+        for priority, job_id in enumerate(sorted(self.wf.jobs, key=key), 1):
+            self.wf.jobs[job_id].add_condor_profile(priority=str(priority)).add_dagman_profile(priority=str(priority))
+
+    # --- Sub-workflows -------------------------------------------------------
+
+    def create_subworkflows(self, chromosome_jobs) -> None:
+        # One sub-workflow per chromosome under a small top-level workflow. They are
+        # independent, so Pegasus plans them in parallel, each when its job starts.
+        top = Workflow(self.wf_name, infer_dependencies=True)
+        top.hooks = self.wf.hooks
+        # They are written in the directory of this workflow rather than in the current one, where
+        # the next generation would replace them before they are planned
+        sub_dir = os.path.join(self.wf_dir, self.wid)
+        os.makedirs(sub_dir, exist_ok=True)
+        sub_rc = ReplicaCatalog()
+        for c_num, job_ids in chromosome_jobs.items():
+            jobs = [self.wf.jobs[job_id] for job_id in job_ids if job_id in self.wf.jobs]
+            if not jobs:
+                continue
+            # Catalogs embedded into the root workflow are not inherited by the sub-workflows
+            sub = (
+                Workflow('%s-chr%s' % (self.wf_name, c_num), infer_dependencies=True)
+                    .add_jobs(*jobs)
+                    .add_replica_catalog(self.rc)
+                    .add_transformation_catalog(self.tc)
+            )
+            sub_path = os.path.join(sub_dir, '%s.yml' % sub.name)
+            sub.write(sub_path)
+            sub_rc.add_replica(site='local', lfn=File(os.path.basename(sub_path)), pfn=sub_path)
+            j_sub = SubWorkflow(File(os.path.basename(sub_path)), is_planned=False, _id='chr%s' % c_num).add_args(
+                '--sites', self.exec_site, '--output-sites', 'local', '--output-dir', self.local_storage_dir,
+                '--cleanup', 'leaf', '--force')
+            if self.cluster_type():
+                j_sub.add_args('--cluster', ','.join(self.cluster_type()))
+            top.add_jobs(j_sub)
+        top.add_replica_catalog(sub_rc)
+        print("{} jobs in {} sub-workflows".format(len(self.wf.jobs), len(top.jobs)))
+        self.wf = top
+
+    # --- Incremental re-runs -------------------------------------------------
+
+    def apply_manifest(self) -> None:
+        # Jobs already run with the same inputs and code are dropped and their outputs become replicas
+        m = manifest.Manifest(self.manifest)
+        planner = manifest.Planner(m)
+        replicas = {entry.lfn: next(iter(entry.pfns)).pfn for entry in self.rc.entries.values()}
+        scripts = {t.name: t.sites['local'].pfn for t in self.tc.transformations.values()}
+        for job_id, job in self.wf.jobs.items():
+            args = [a.lfn if isinstance(a, File) else a for a in job.args]
+            planner.add(job_id, job.transformation, args, scripts[job.transformation],
+                        {f.lfn: replicas.get(f.lfn) for f in job.get_inputs()},
+                        [f.lfn for f in job.get_outputs()])
+
+        skipped = 0
+        for job_id, key in planner.keys().items():
+            job = self.wf.jobs[job_id]
+            entry = m.lookup(key)
+            if entry:
+                del self.wf.jobs[job_id]
+                for lfn, out in entry['outputs'].items():
+                    self.rc.add_replica(site="local", lfn=File(lfn), pfn=out['path'])
+                skipped += 1
+                continue
+            outputs = {}
+            for use in job.uses:
+                if use._type == 'output':
+                    # Every output is kept in the output directory for the next runs
+                    use.stage_out = True
+                    outputs[use.file.lfn] = os.path.join(self.local_storage_dir, use.file.lfn)
+            m.plan(key, job.transformation, sorted(outputs)[0], outputs)
+        m.save()
+
+        # The outputs of the run are checked and recorded once it succeeded
+        self.wf.add_shell_hook(EventType.SUCCESS, "{} commit {}".format(
+            os.path.join(self.wf_dir, 'manifest.py'), m.filename))
+        print("Manifest {}: {} jobs up to date, {} jobs to run".format(m.filename, skipped, len(self.wf.jobs)))
 
     # --- Run Workflow -----------------------------------------------------
 
+    def cluster_type(self):
+        cluster_type = []
+        if self.cluster_size or self.cluster_runtime:
+            cluster_type.append("horizontal")
+        if self.use_decaf or self.use_pmc or self.colocate_analyses:
+            cluster_type.append("label")
+        return cluster_type or None
+
     def run(self, dir_name, submit=False, wait=False):
         try:
             plan_site = [self.exec_site]
-            cluster_type = None
-            if self.use_decaf or self.use_pmc: 
-                cluster_type = ["label"]
+            cluster_type = self.cluster_type()
             self.wf.plan(
                 dir=self.wf_dir,
                 relative_dir=dir_name,
@@ -424,7 +849,144 @@ if __name__ == "__main__":
         default=None,
         help="Use an existing site catalog (XML OR YAML)",
     )
+    parser.add_argument(
+        "-g",
+        "--genotype-cache",
+        metavar="DIR",
+        type=str,
+        default=None,
+        help="Node-local directory where mutation_overlap and frequency jobs share a memory-mapped genotype matrix per chromosome (disabled by default)",
+    )
+    parser.add_argument(
+        "-t",
+        "--target-runtime",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Pick the number of individuals jobs per chromosome so each one runs for about SECONDS (overrides -i)",
+    )
+    parser.add_argument(
+        "--cores",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of cores available to the individuals jobs, used with --target-runtime",
+    )
+    parser.add_argument(
+        "--calibration",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="Timing records of previous runs (JSON lines) used to calibrate --target-runtime",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "py-spy"],
+        default=None,
+        help="Profile every job and stage out the profiles (merge them with analysis/merge-profiles.py)",
+    )
+    parser.add_argument(
+        "--sift-prefilter",
+        action="store_true",
+        dest="sift_prefilter",
+        help="Individuals jobs only extract the variants with a SIFT score (they wait for the sifting jobs)",
+    )
+    parser.add_argument(
+        "--variant-matrix",
+        action="store_true",
+        dest="variant_matrix",
+        help="Merge each chromosome into a sparse individuals x variants matrix (chr{c}n.npz) read by the analysis jobs",
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="Manifest of the previous runs (manifest.py): only emit the jobs whose inputs or code changed",
+    )
+    parser.add_argument(
+        "--split-vcf",
+        action="store_true",
+        dest="split_vcf",
+        help="Split each VCF into the slices of its individuals jobs with a split_vcf job, so they only stage their own lines",
+    )
+    parser.add_argument(
+        "--compress-slices",
+        action="store_true",
+        dest="compress_slices",
+        help="Gzip the slices written with --split-vcf",
+    )
+    parser.add_argument(
+        "-r",
+        "--resource-profiles",
+        action="store_true",
+        dest="resource_profiles",
+        help="Request cores, memory and runtime for every job from the cost model of job_planner.py",
+    )
+    parser.add_argument(
+        "--cluster-size",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Cluster the individuals jobs horizontally by groups of N",
+    )
+    parser.add_argument(
+        "--cluster-runtime",
+        metavar="SECONDS",
+        type=int,
+        default=None,
+        help="Cluster the individuals jobs horizontally up to SECONDS of estimated runtime per cluster",
+    )
+    parser.add_argument(
+        "--subworkflows",
+        action="store_true",
+        dest="subworkflows",
+        help="Emit one sub-workflow per chromosome, planned when it starts, under a top-level workflow",
+    )
+    parser.add_argument(
+        "--priorities",
+        action="store_true",
+        dest="priorities",
+        help="Prioritize the jobs by critical path: sifting first, then each chromosome as a whole, longest first",
+    )
+    parser.add_argument(
+        "--colocate-analyses",
+        metavar="CORES",
+        type=int,
+        default=None,
+        help="Cluster the analysis jobs of each chromosome into one job running CORES of them at a time on a node",
+    )
+    parser.add_argument(
+        "--discover",
+        action="store_true",
+        dest="discover",
+        help="Find the chromosome VCFs and annotations in the dataset folder and count their lines instead of reading the data file",
+    )
+    parser.add_argument(
+        "--individuals-workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of processes writing the samples in each individuals job (and cores requested)",
+    )
+    parser.add_argument(
+        "--sample-shards",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Partition the individuals outputs into N shards of samples, merged separately, the analysis jobs only fetch the shards of their population",
+    )
+    parser.add_argument(
+        "--shard-populations",
+        metavar="POP",
+        nargs="+",
+        default=None,
+        help="Partition the individuals outputs by population instead, one shard per population file given (e.g. AFR AMR EAS EUR SAS)",
+    )
     args = parser.parse_args()
+    if args.sample_shards and args.shard_populations:
+        parser.error("--sample-shards and --shard-populations are exclusive")
 
     workflow = GenomeWorkflow(
         datafile = args.datafile,
@@ -435,7 +997,27 @@ if __name__ == "__main__":
         src_path = args.src_path,
         use_decaf = args.use_decaf,
         use_pmc = args.use_pmc,
-        custom_site_file = args.sites_catalog
+        custom_site_file = args.sites_catalog,
+        genotype_cache = args.genotype_cache,
+        target_runtime = args.target_runtime,
+        cores = args.cores,
+        calibration = args.calibration,
+        profile = args.profile,
+        sift_prefilter = args.sift_prefilter,
+        variant_matrix = args.variant_matrix,
+        manifest = args.manifest,
+        subworkflows = args.subworkflows,
+        priorities = args.priorities,
+        colocate_analyses = args.colocate_analyses,
+        discover = args.discover,
+        individuals_workers = args.individuals_workers,
+        sample_shards = args.sample_shards,
+        shard_populations = args.shard_populations,
+        split_vcf = args.split_vcf,
+        compress_slices = args.compress_slices,
+        resource_profiles = args.resource_profiles,
+        cluster_size = args.cluster_size,
+        cluster_runtime = args.cluster_runtime
     )
 
     # catalog compute resources
@@ -453,6 +1035,9 @@ if __name__ == "__main__":
     # create the workflow
     print("Creating pipeline workflow dag...")
     workflow.create_workflow()
+    if not workflow.wf.jobs:
+        print("All the jobs are up to date in the manifest, nothing to run")
+        sys.exit(0)
 
     if not args.dir_name:
         args.dir_name = workflow.wid
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Chunk planner for the individuals jobs.
+#
+# An individuals job processes the lines [start, stop) of a chromosome VCF
+# (start and stop follow the convention of daxgen.py, the first chunk starts at
+# line 1) and its runtime grows with lines x sample columns. The planner picks
+# the number of jobs and their boundaries from the size of the input, a target
+# runtime per job and the number of cores available, optionally calibrated from
+# the timings recorded by previous runs.
+#
+# The same model gives the cores, memory and runtime of the jobs of every stage
+# (daxgen.py --resource-profiles), from their number of lines and samples.
+
+import json
+import math
+from argparse import ArgumentParser
+
+START_DATA = 9  # where the real data start in columns.txt
+
+# Cori Haswell, README: 10 individuals jobs of 25,000 lines x 2504 samples in 11431 s
+SECONDS_PER_CELL = 11431 / (25000 * 2504)
+
+# Below this size, the time to read the input dominates an individuals job
+MIN_LINES = 1000
+
+# README memory table: an individuals job holds the whole VCF (about 4 bytes per
+# genotype, '0|1\t') and about 12 bytes per line x sample of its own chunk
+VCF_BYTES_PER_CELL = 4
+CHUNK_BYTES_PER_CELL = (6.10 - 2.93) * 2**30 / ((125000 - 15625) * 2504)
+MEMORY_BASE = 256 * 2**20
+
+# split_vcf streams the whole VCF through Python (about VCF_BYTES_PER_CELL bytes
+# per line x sample) and, with --compress-slices, through gzip at level 1
+SPLIT_BYTES_PER_SECOND = 100 * 2**20
+GZIP_BYTES_PER_SECOND = 30 * 2**20
+
+# README execution times (one chromosome of 250,000 lines x 2504 samples) for
+# the other stages: (seconds, bytes) per line x sample, sifting only depends on
+# the lines and split_vcf does not hold the VCF in memory
+CELLS = 250000 * 2504
+STAGE_COSTS = {
+    'individuals_merge': (500 / CELLS, 4),
+    'mutation_overlap': (468 / CELLS, 1),
+    'frequency': (1492 / CELLS, 1),
+    'sifting': (6 / 250000, 0),
+    'split_vcf': (VCF_BYTES_PER_CELL / SPLIT_BYTES_PER_SECOND, 0),
+}
+
+# Estimates are padded, a job going over its memory request gets killed
+RUNTIME_MARGIN = 2.0
+MEMORY_MARGIN = 1.25
+MIN_RUNTIME = 60
+
+
+def count_samples(columfile):
+    with open(columfile, 'r') as f:
+        return len(f.readline().rstrip('\n').split('\t')) - START_DATA
+
+
+def split_lines(total, n_jobs):
+    # n_jobs chunks covering [1, total + 1), their sizes differ by one line at most and the
+    # longer ones are spread among them (split_lines(10, 3) gives 3, 3 and 4 lines)
+    n_jobs = max(1, min(int(n_jobs), int(total)))
+    edges = [1 + (k * total) // n_jobs for k in range(n_jobs + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def load_calibration(filename, stage='individuals'):
+    # JSON records, one per line: {"stage": ..., "lines": ..., "samples": ..., "wall": ...}
+    cells = 0
+    seconds = 0.0
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('stage') != stage or not record.get('lines') or not record.get('samples'):
+                continue
+            cells += record['lines'] * record['samples']
+            seconds += record['wall']
+    if cells == 0:
+        print("WARNING: no {} timings in {}, using the default cost model".format(stage, filename))
+        return SECONDS_PER_CELL
+    return seconds / cells
+
+
+def plan_chunks(total, n_samples, target_runtime, cores=1, seconds_per_cell=SECONDS_PER_CELL,
+                min_lines=MIN_LINES):
+    cost = total * n_samples * seconds_per_cell
+    n_jobs = math.ceil(cost / target_runtime)
+    # Do not leave cores idle as long as the chunks stay large enough
+    n_jobs = max(n_jobs, min(cores, total // min_lines))
+    return split_lines(total, max(1, n_jobs))
+
+
+def estimate_runtime(lines, n_samples, seconds_per_cell=SECONDS_PER_CELL):
+    return lines * n_samples * seconds_per_cell
+
+
+def job_resources(stage, lines, n_samples, input_bytes=0, seconds_per_cell=SECONDS_PER_CELL, cores=1,
+                  compress=False):
+    # cores, memory (MB) and runtime (seconds) of a job processing lines x n_samples,
+    # input_bytes being the size of the inputs it reads whole, compress whether it gzips its outputs
+    cells = lines * n_samples
+    if stage == 'individuals':
+        # The samples are written by the cores of the job (individuals.py --workers)
+        runtime = estimate_runtime(lines, n_samples, seconds_per_cell) / cores
+        memory = input_bytes + cells * CHUNK_BYTES_PER_CELL
+    else:
+        seconds, per_cell = STAGE_COSTS[stage]
+        runtime = cells * seconds
+        if compress and stage == 'split_vcf':
+            runtime += cells * VCF_BYTES_PER_CELL / GZIP_BYTES_PER_SECOND
+        memory = input_bytes + cells * per_cell
+    return {
+        'cores': cores,
+        'memory': math.ceil((MEMORY_BASE + memory) * MEMORY_MARGIN / 2**20),
+        'runtime': max(MIN_RUNTIME, math.ceil(runtime * RUNTIME_MARGIN)),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Plan the individuals jobs of a chromosome")
+    parser.add_argument('total', type=int, help='Number of lines of the chromosome VCF')
+    parser.add_argument('-C', '--columns', default='data/20130502/columns.txt', help='columns.txt of the dataset')
+    parser.add_argument('-t', '--target-runtime', type=float, default=3600, help='Target runtime of a job (seconds)')
+    parser.add_argument('--cores', type=int, default=1, help='Number of cores available')
+    parser.add_argument('--calibration', default=None, help='Timing records of previous runs (JSON lines)')
+    args = parser.parse_args()
+
+    n_samples = count_samples(args.columns)
+    spc = load_calibration(args.calibration) if args.calibration else SECONDS_PER_CELL
+    chunks = plan_chunks(args.total, n_samples, args.target_runtime, args.cores, spc)
+    print("{} jobs for {} lines x {} samples:".format(len(chunks), args.total, n_samples))
+    for start, stop in chunks:
+        print("  [{}, {}) ~{:0.0f} sec".format(start, stop, estimate_runtime(stop - start, n_samples, spc)))
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# Single-node runner for the whole 1000 genome workflow, without Pegasus,
+# TaskVine or MPI. It reads the same data.csv and populations as daxgen.py and
+# runs individuals, individuals_merge, sifting, mutation_overlap and frequency
+# as a dependency-aware task graph in a process pool.
+#
+# Every task runs in its own sandbox directory (inputs are symlinked in), and
+# the intermediate files are kept under a work directory placed on a RAM-disk
+# (/dev/shm) when there is one. Only the analysis archives are copied to the
+# output directory.
+
+import os
+import sys
+import csv
+import time
+import runpy
+import shutil
+import tempfile
+import argparse
+import cProfile
+import contextlib
+import multiprocessing
+import heapq
+import collections
+import concurrent.futures
+from pathlib import Path
+
+import job_planner
+import manifest
+
+STAGES = ['individuals', 'individuals_merge', 'sifting', 'mutation_overlap', 'frequency']
+
+
+class Task(object):
+    def __init__(self, name, stage, args, inputs, outputs, final=False):
+        self.name = name
+        self.stage = stage
+        self.args = [str(a) for a in args]
+        # inputs are either paths of input data or names of outputs of other tasks
+        self.inputs = inputs
+        self.outputs = outputs
+        self.final = final
+        self.deps = set()
+
+
+class ReadyTasks(object):
+    # Tasks whose dependencies are done, per stage and in creation order. Every task counts
+    # its unmet dependencies, and the completion of a task only looks at the tasks depending on it
+    def __init__(self, tasks, done):
+        self.tasks = tasks
+        self.names = list(tasks)
+        self.order = {name: k for k, name in enumerate(self.names)}
+        self.unmet = {}
+        self.dependents = collections.defaultdict(list)
+        self.ready = collections.defaultdict(list)
+        for name, task in tasks.items():
+            if name in done:
+                continue
+            deps = task.deps - done
+            self.unmet[name] = len(deps)
+            for dep in deps:
+                self.dependents[dep].append(name)
+            if not deps:
+                heapq.heappush(self.ready[task.stage], self.order[name])
+        self.pending = len(self.unmet)
+
+    def release(self, name):
+        for child in self.dependents.pop(name, []):
+            self.unmet[child] -= 1
+            if not self.unmet[child]:
+                heapq.heappush(self.ready[self.tasks[child].stage], self.order[child])
+
+    def pop(self, stages=None):
+        # First ready task in creation order, of one of stages if given, None if there is none
+        heads = [(heap[0], stage) for stage, heap in self.ready.items()
+                 if heap and (stages is None or stage in stages)]
+        if not heads:
+            return None
+        _, stage = min(heads)
+        self.pending -= 1
+        return self.names[heapq.heappop(self.ready[stage])]
+
+
+def run_task(bin_dir, sandbox, stage, args, inputs, outputs, store_dir, stats_dir, profile=False):
+    # Executed in a worker process of the pool
+    tic = time.perf_counter()
+    cwd = os.getcwd()
+    argv = sys.argv
+    os.makedirs(sandbox, exist_ok=True)
+    for path in inputs:
+        os.symlink(path, os.path.join(sandbox, os.path.basename(path)))
+
+    if bin_dir not in sys.path:
+        sys.path.insert(0, bin_dir)
+    script = os.path.join(bin_dir, stage + '.py')
+    log = os.path.join(store_dir, os.path.basename(sandbox) + '.log')
+
+    try:
+        os.chdir(sandbox)
+        sys.argv = [script] + args
+        # Job records of the scripts (bin/instrument.py)
+        os.environ['JOBSTATS_DIR'] = stats_dir
+        with open(log, 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+            profiler = cProfile.Profile() if profile else None
+            try:
+                if profiler:
+                    profiler.runcall(runpy.run_path, script, run_name='__main__')
+                else:
+                    runpy.run_path(script, run_name='__main__')
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise RuntimeError('{} exited with status {}'.format(stage, e.code))
+            if profiler:
+                # Same name as the profiles of bin/profiling.py, for analysis/merge-profiles.py
+                name = outputs[0].replace('.tar.gz', '').replace('.txt', '')
+                profiler.dump_stats(os.path.join(stats_dir, '{}.{}.prof'.format(stage, name)))
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+
+    for name in outputs:
+        shutil.move(os.path.join(sandbox, name), os.path.join(store_dir, name))
+    shutil.rmtree(sandbox, ignore_errors=True)
+    return time.perf_counter() - tic
+
+
+def process_pool(workers):
+    # Every task runs in a new process, so that the CPU times and the peak RSS of its job record
+    # (bin/instrument.py) are its own and not those of the tasks run before it by the same worker
+    if sys.version_info >= (3, 11):
+        # max_tasks_per_child cannot be used with the fork start method
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1,
+                                                      mp_context=multiprocessing.get_context('forkserver'))
+    print("WARNING: workers are reused before Python 3.11, the max_rss of the job records "
+          "is the highest of all the tasks run so far by the worker")
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+
+class LocalWorkflow(object):
+    def __init__(self, datafile='data.csv', dataset='20130502', ind_jobs=1,
+                 src_path=None, columns='columns.txt', target_runtime=None, cores=1,
+                 calibration=None, sift_prefilter=False, variant_matrix=False):
+        self.wf_dir = str(Path(__file__).parent.resolve())
+        self.src_path = src_path or self.wf_dir
+        self.bin_dir = os.path.join(self.src_path, 'bin')
+        self.data_dir = os.path.join(self.src_path, 'data', dataset)
+        self.datafile = datafile
+        self.ind_jobs = ind_jobs
+        self.columns = os.path.join(self.data_dir, columns)
+        self.target_runtime = target_runtime
+        self.cores = cores
+        self.sift_prefilter = sift_prefilter
+        self.variant_matrix = variant_matrix
+        self.seconds_per_cell = job_planner.SECONDS_PER_CELL
+        if calibration:
+            self.seconds_per_cell = job_planner.load_calibration(calibration)
+
+        pop_dir = os.path.join(self.src_path, 'data', 'populations')
+        self.populations = [os.path.join(pop_dir, p) for p in sorted(os.listdir(pop_dir))]
+
+        self.tasks = {}
+        self.producers = {}
+
+    def add_task(self, task):
+        self.tasks[task.name] = task
+        for out in task.outputs:
+            self.producers[out] = task.name
+
+    def create_workflow(self):
+        n_samples = job_planner.count_samples(self.columns)
+
+        with open(self.datafile, 'r') as f:
+            rows = list(csv.reader(f))
+
+        for row in rows:
+            # base file, 250k, annotations
+            base_file = row[0]
+            threshold = int(row[1])
+            if self.target_runtime:
+                chunks = job_planner.plan_chunks(threshold, n_samples, self.target_runtime,
+                                                 max(1, self.cores // len(rows)), self.seconds_per_cell)
+            else:
+                chunks = job_planner.split_lines(threshold, self.ind_jobs)
+
+            c_num = base_file[base_file.find('chr')+3:]
+            c_num = c_num[0:c_num.find('.')]
+            f_individuals = os.path.join(self.data_dir, base_file)
+
+            sifted_filename = 'sifted.SIFT.chr%s.txt' % c_num
+            output_files = []
+            for counter, stop in chunks:
+                out_name = 'chr%sn-%s-%s.tar.gz' % (c_num, counter, stop)
+                output_files.append(out_name)
+                args = [base_file, c_num, counter, stop, threshold]
+                inputs = [f_individuals, self.columns]
+                if self.sift_prefilter:
+                    args += ['--sift-file', sifted_filename]
+                    inputs.append(sifted_filename)
+                self.add_task(Task(
+                    'individuals-%s-%s' % (c_num, counter), 'individuals',
+                    args=args,
+                    inputs=inputs,
+                    outputs=[out_name]))
+
+            individuals_filename = 'chr%sn.tar.gz' % c_num
+            merge_args = [c_num] + output_files
+            analysis_args = []
+            if self.variant_matrix:
+                individuals_filename = 'chr%sn.npz' % c_num
+                merge_args += ['--format', 'csr']
+                analysis_args = ['--matrix', individuals_filename]
+            self.add_task(Task(
+                'individuals_merge-%s' % c_num, 'individuals_merge',
+                args=merge_args,
+                inputs=output_files,
+                outputs=[individuals_filename]))
+
+            f_sifting = os.path.join(self.data_dir, 'sifting', row[2])
+            self.add_task(Task(
+                'sifting-%s' % c_num, 'sifting',
+                args=[row[2], c_num],
+                inputs=[f_sifting],
+                outputs=[sifted_filename]))
+
+            for f_pop in self.populations:
+                pop = os.path.basename(f_pop)
+                analysis_inputs = [individuals_filename, sifted_filename, f_pop, self.columns]
+                self.add_task(Task(
+                    'mutation_overlap-%s-%s' % (c_num, pop), 'mutation_overlap',
+                    args=['-c', c_num, '-pop', pop] + analysis_args,
+                    inputs=analysis_inputs,
+                    outputs=['chr%s-%s.tar.gz' % (c_num, pop)], final=True))
+                self.add_task(Task(
+                    'frequency-%s-%s' % (c_num, pop), 'frequency',
+                    args=['-c', c_num, '-pop', pop] + analysis_args,
+                    inputs=analysis_inputs,
+                    outputs=['chr%s-%s-freq.tar.gz' % (c_num, pop)], final=True))
+
+        for task in self.tasks.values():
+            task.deps = {self.producers[i] for i in task.inputs if i in self.producers}
+
+    def run(self, work_dir, output_dir, workers, limits, stats_dir=None, profile=False, manifest_file=None):
+        store_dir = os.path.join(work_dir, 'store')
+        os.makedirs(store_dir, exist_ok=True)
+        os.makedirs(output_dir, exist_ok=True)
+        stats_dir = os.path.abspath(stats_dir or store_dir)
+        os.makedirs(stats_dir, exist_ok=True)
+
+        done = set()
+        running = {}
+        active = {stage: 0 for stage in STAGES}
+
+        def resolve(path):
+            if path in self.producers:
+                return os.path.join(store_dir, path)
+            return os.path.abspath(path)
+
+        keys = {}
+        if manifest_file:
+            # Tasks already run with the same inputs and code take their outputs from the manifest
+            m = manifest.Manifest(manifest_file)
+            planner = manifest.Planner(m)
+            for name, task in self.tasks.items():
+                planner.add(name, task.stage, task.args, os.path.join(self.bin_dir, task.stage + '.py'),
+                            {os.path.basename(i): resolve(i) for i in task.inputs}, task.outputs)
+            keys = planner.keys()
+            for name, task in self.tasks.items():
+                entry = m.lookup(keys[name])
+                if not entry:
+                    continue
+                for out in task.outputs:
+                    os.symlink(entry['outputs'][out]['path'], os.path.join(store_dir, out))
+                    if task.final:
+                        shutil.copy(os.path.join(store_dir, out), output_dir)
+                done.add(name)
+            m.save()
+            print("Manifest {}: {} tasks up to date, {} tasks to run".format(
+                m.filename, len(done), len(self.tasks) - len(done)))
+
+        ready = ReadyTasks(self.tasks, done)
+        tic = time.perf_counter()
+        with process_pool(workers) as pool:
+            while ready.pending or running:
+                # Tasks are submitted in creation order as soon as their inputs exist
+                while len(running) < workers:
+                    name = ready.pop([stage for stage in STAGES if active[stage] < limits.get(stage, workers)])
+                    if name is None:
+                        break
+                    task = self.tasks[name]
+                    future = pool.submit(run_task, self.bin_dir, os.path.join(work_dir, name),
+                                         task.stage, task.args, [resolve(i) for i in task.inputs],
+                                         task.outputs, store_dir, stats_dir, profile)
+                    running[future] = task
+                    active[task.stage] += 1
+
+                if not running:
+                    sys.exit("ERROR: no task can be scheduled, check the stage limits.")
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    active[task.stage] -= 1
+                    try:
+                        elapsed = future.result()
+                    except Exception as e:
+                        print("task {} failed: {} (see {}/{}.log)".format(task.name, e, store_dir, task.name))
+                        for f in running:
+                            f.cancel()
+                        sys.exit(1)
+                    done.add(task.name)
+                    ready.release(task.name)
+                    print("task {} done in {:0.2f} sec ({}/{})".format(
+                        task.name, elapsed, len(done), len(self.tasks)))
+                    if keys:
+                        m.record(keys[task.name], task.stage, task.name,
+                                 {out: os.path.join(store_dir, out) for out in task.outputs})
+                        m.save()
+
+                    if task.final:
+                        for out in task.outputs:
+                            shutil.copy(os.path.join(store_dir, out), output_dir)
+
+        print("all {} tasks complete in {:0.2f} seconds!".format(len(self.tasks), time.perf_counter() - tic))
+
+
+def default_work_dir():
+    # Intermediates live in memory when a RAM-disk is available
+    shm = '/dev/shm'
+    base = shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else None
+    return tempfile.mkdtemp(prefix='1000genome-', dir=base)
+
+
+def parse_limit(value):
+    # STAGE=N, the type of -l
+    stage, _, n = value.partition('=')
+    if stage not in STAGES or not n.isdigit():
+        raise argparse.ArgumentTypeError('invalid stage limit {}, expected STAGE=N with STAGE one of {}'.format(
+            value, ', '.join(STAGES)))
+    return stage, int(n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the 1000Genome workflow on the local node",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('-D', '--dataset', default='20130502', help='Dataset folder')
+    parser.add_argument('-f', '--datafile', default='data.csv', help='Data file with list of input data')
+    parser.add_argument('-i', '--individuals-jobs', dest='ind_jobs', type=int, default=1,
+                        help='Number of individuals jobs that will be created for each chromosome')
+    parser.add_argument('-t', '--target-runtime', type=float, default=None,
+                        help='Pick the number of individuals jobs so each one runs for about this many seconds (overrides -i)')
+    parser.add_argument('--calibration', default=None,
+                        help='Timing records of previous runs (JSON lines) used to calibrate --target-runtime')
+    parser.add_argument('--sift-prefilter', action='store_true',
+                        help='Individuals tasks only extract the variants with a SIFT score (they wait for sifting)')
+    parser.add_argument('--variant-matrix', action='store_true',
+                        help='Merge each chromosome into a sparse matrix (chr<c>n.npz) read by the analysis tasks')
+    parser.add_argument('-j', '--workers', type=int, default=len(os.sched_getaffinity(0)),
+                        help='Number of processes in the pool')
+    parser.add_argument('-l', '--limit', action='append', type=parse_limit, default=[], metavar='STAGE=N',
+                        help='Maximum number of concurrent tasks of a stage, e.g. individuals_merge=2 (repeatable)')
+    parser.add_argument('-p', '--src-path', default=None,
+                        help='Absolute path of source directory (default: directory of this script)')
+    parser.add_argument('-w', '--work-dir', default=None,
+                        help='Directory for sandboxes and intermediate files (default: a new directory in /dev/shm)')
+    parser.add_argument('-o', '--output-dir', default='output', help='Directory for the analysis outputs')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the work directory when done')
+    parser.add_argument('-s', '--stats-dir', default=None,
+                        help='Directory for the timing and resource records of the tasks (default: next to the logs)')
+    parser.add_argument('-m', '--manifest', default=None,
+                        help='Manifest of the previous runs (manifest.py): only run the tasks whose inputs or code changed')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile every task with cProfile, the profiles are written with the records (see -s)')
+    args = parser.parse_args()
+
+    workflow = LocalWorkflow(
+        datafile=args.datafile,
+        dataset=args.dataset,
+        ind_jobs=args.ind_jobs,
+        src_path=args.src_path,
+        target_runtime=args.target_runtime,
+        cores=args.workers,
+        calibration=args.calibration,
+        sift_prefilter=args.sift_prefilter,
+        variant_matrix=args.variant_matrix,
+    )
+    workflow.create_workflow()
+
+    work_dir = args.work_dir or default_work_dir()
+    os.makedirs(work_dir, exist_ok=True)
+    print("Running {} tasks with {} workers in {}".format(len(workflow.tasks), args.workers, work_dir))
+
+    try:
+        workflow.run(work_dir, args.output_dir, args.workers, dict(args.limit), args.stats_dir, args.profile,
+                     args.manifest)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
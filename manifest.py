@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Manifest of the jobs of previous runs, for incremental re-runs.
+#
+# The key of a job hashes its stage, its arguments, the code it runs (the
+# script and the bin/ modules it imports) and its inputs: the checksum of an
+# input data file, or the key of the job producing an intermediate file. A
+# job whose key is in the manifest, with all its outputs still in place, does
+# not need to run again, and neither do the jobs downstream of it unless one of
+# their other inputs changed.
+#
+#   {"files": {path: {"size", "mtime", "sha256"}},     checksums of the inputs
+#    "jobs":  {key:  {"stage", "name", "state",        planned or done
+#                     "outputs": {lfn: {"path", "size", "sha256"}}}}}
+#
+# local_genomes.py and vine_genomes.py record the outputs of their tasks as
+# they complete, copied into a content-addressed store next to the manifest.
+# daxgen.py plans the jobs with the output directory of the run as location of
+# their outputs, they are checked and recorded after the run with:
+#   ./manifest.py commit manifest.json
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+from argparse import ArgumentParser
+
+IMPORT = re.compile(r'^\s*(?:import|from)\s+(\w+)', re.MULTILINE)
+
+
+def checksum(filename, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, filename, store_dir=None):
+        self.filename = os.path.abspath(filename)
+        self.store_dir = store_dir or os.path.splitext(self.filename)[0] + '.store'
+        self.files = {}
+        self.jobs = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                content = json.load(f)
+            self.files = content.get('files', {})
+            self.jobs = content.get('jobs', {})
+
+    def save(self):
+        # Written aside and renamed, a crash never leaves a truncated manifest
+        fd, tmp = tempfile.mkstemp(prefix='.manifest-', dir=os.path.dirname(self.filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'files': self.files, 'jobs': self.jobs}, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.filename)
+
+    def file_hash(self, path):
+        # Checksums are only recomputed when the size or the mtime of a file changed
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        known = self.files.get(path)
+        if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+            return known['sha256']
+        digest = checksum(path)
+        self.files[path] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': digest}
+        return digest
+
+    def code_hash(self, script):
+        # The script and the modules of its directory it imports, transitively
+        bin_dir = os.path.dirname(os.path.abspath(script))
+        h = hashlib.sha256()
+        seen = set()
+        todo = [os.path.abspath(script)]
+        while todo:
+            path = todo.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            with open(path, 'rb') as f:
+                content = f.read()
+            h.update(os.path.basename(path).encode() + b'\0' + content)
+            for module in IMPORT.findall(content.decode(errors='replace')):
+                candidate = os.path.join(bin_dir, module + '.py')
+                if os.path.exists(candidate):
+                    todo.append(candidate)
+        return h.hexdigest()
+
+    @staticmethod
+    def job_key(stage, args, code, inputs):
+        # inputs: (name, digest) pairs, the digest being a file checksum or the key of its producer
+        h = hashlib.sha256()
+        h.update(json.dumps([stage, [str(a) for a in args], code, sorted(inputs)]).encode())
+        return h.hexdigest()
+
+    def lookup(self, key):
+        # The entry of a previous job with the same key, if its outputs are still there
+        entry = self.jobs.get(key)
+        if not entry:
+            return None
+        for out in entry['outputs'].values():
+            if not os.path.exists(out['path']):
+                return None
+            if 'size' in out and os.path.getsize(out['path']) != out['size']:
+                return None
+        return entry
+
+    def plan(self, key, stage, name, outputs):
+        # outputs: {lfn: path where the run will leave it}, recorded by commit()
+        self.jobs[key] = {'stage': stage, 'name': name, 'state': 'planned',
+                          'outputs': {lfn: {'path': path} for lfn, path in outputs.items()}}
+
+    def record(self, key, stage, name, outputs, store=True):
+        # outputs: {lfn: path of the file produced by the job}
+        entry = {'stage': stage, 'name': name, 'state': 'done', 'outputs': {}}
+        for lfn, path in outputs.items():
+            digest = checksum(path)
+            if store:
+                stored = os.path.join(self.store_dir, digest[:2], digest)
+                if not os.path.exists(stored):
+                    os.makedirs(os.path.dirname(stored), exist_ok=True)
+                    try:
+                        os.link(path, stored)
+                    except OSError:
+                        shutil.copyfile(path, stored + '.tmp')
+                        os.rename(stored + '.tmp', stored)
+                path = stored
+            entry['outputs'][lfn] = {'path': os.path.abspath(path), 'size': os.path.getsize(path), 'sha256': digest}
+        self.jobs[key] = entry
+
+    def commit(self):
+        # Records the planned jobs whose outputs were all produced, returns how many
+        committed = 0
+        for key, entry in list(self.jobs.items()):
+            if entry['state'] != 'planned':
+                continue
+            paths = {lfn: out['path'] for lfn, out in entry['outputs'].items()}
+            if all(os.path.exists(path) for path in paths.values()):
+                self.record(key, entry['stage'], entry['name'], paths, store=False)
+                committed += 1
+        return committed
+
+    def prune(self):
+        # Drops the jobs whose outputs are gone, returns how many
+        stale = [key for key, entry in self.jobs.items()
+                 if entry['state'] == 'done' and not self.lookup(key)]
+        for key in stale:
+            del self.jobs[key]
+        return len(stale)
+
+
+class Planner(object):
+    # Keys of the jobs of a workflow, whatever the order the jobs are added in
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.jobs = {}
+        self.producers = {}
+
+    def add(self, name, stage, args, script, inputs, outputs):
+        # inputs: {lfn: path of the data file}, the path of the outputs of other jobs is not used
+        self.jobs[name] = (stage, args, script, inputs)
+        for lfn in outputs:
+            self.producers[lfn] = name
+
+    def keys(self):
+        keys = {}
+        codes = {}
+
+        def key(name):
+            if name not in keys:
+                stage, args, script, inputs = self.jobs[name]
+                if script not in codes:
+                    codes[script] = self.manifest.code_hash(script)
+                digests = []
+                for lfn, path in inputs.items():
+                    if lfn in self.producers:
+                        digests.append((lfn, key(self.producers[lfn])))
+                    else:
+                        digests.append((lfn, self.manifest.file_hash(path)))
+                keys[name] = self.manifest.job_key(stage, args, codes[script], digests)
+            return keys[name]
+
+        for name in self.jobs:
+            key(name)
+        return keys
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Inspect and update the manifest of the incremental re-runs")
+    parser.add_argument('command', choices=['show', 'commit', 'prune'],
+                        help='show the jobs, record the planned jobs whose outputs exist, or drop the jobs whose outputs are gone')
+    parser.add_argument('manifest', help='Manifest file (JSON)')
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    if args.command == 'show':
+        for key, entry in sorted(manifest.jobs.items(), key=lambda x: (x[1]['stage'], x[1]['name'])):
+            print("{:<18} {:<28} {:<8} {} {}".format(
+                entry['stage'], entry['name'], entry['state'], key[:12],
+                'ok' if manifest.lookup(key) else 'missing'))
+    elif args.command == 'commit':
+        print("= {} planned jobs recorded".format(manifest.commit()))
+        manifest.save()
+    else:
+        print("= {} jobs with missing outputs dropped".format(manifest.prune()))
+        manifest.save()
@@ -4,10 +4,117 @@
 # This software is distributed under the GNU General Public License.
 # See the file COPYING for details.
 
+# TaskVine runner for the whole 1000 genome workflow.
+#
+# The task graph is the one of local_genomes.py: every chromosome of data.csv,
+# every population, the same chunk planning and options. Tasks are submitted as
+# soon as their inputs exist instead of one stage after the other: sifting runs
+# along the individuals tasks, the merge of a chromosome starts when its
+# individuals tasks are done (with --merge-fanin, partial merges start as soon
+# as their group is done) and the analyses of a chromosome start when its merge
+# and sifting are done, while the other chromosomes are still being processed.
+#
+# With --function-calls, the individuals chunks are function calls of a
+# TaskVine library per chromosome: the library process reads the VCF once and
+# every call only extracts its lines, without starting a new interpreter.
+#
+# Compressed VCFs are decompressed once per worker by a mini task and cached
+# there: peer transfers only move the compressed file, and all the tasks of a
+# worker share the same decompressed copy.
+
 import ndcctools.taskvine as vine
-import random
+import local_genomes
+import manifest
 import argparse
 import getpass
+import shutil
+import json
+import sys
+import os
+
+# Helper modules imported by the scripts
+HELPERS = ["instrument.py", "profiling.py", "variant_matrix.py", "variant_table.py"]
+
+
+def save_output(t, stats_dir):
+    # The job records printed by the scripts are collected by analysis/records.py
+    output = t.std_output
+    if isinstance(t, vine.FunctionCall) and isinstance(t.output, dict):
+        # Function calls return their record (bin/instrument.py) instead of printing it
+        output = "@@jobstats " + json.dumps(t.output, sort_keys=True) + "\n"
+    if stats_dir and output:
+        with open(os.path.join(stats_dir, f"task-{t.id}.out"), "w") as f:
+            f.write(output)
+
+
+def load_chromosome(vcf, columns):
+    # Context of an individuals library: the chromosome is read once and shared by the function calls
+    import os
+    import sys
+    sys.path.insert(0, os.getcwd())
+    with open(vcf, "r") as f:
+        rawdata = f.readlines()
+    with open(columns, "r") as f:
+        columndata = f.readline().rstrip("\n").split("\t")
+    return {"rawdata": rawdata, "columndata": columndata}
+
+
+def individuals_chunk(c, counter, stop, total, siftfile=None):
+    # One individuals chunk, extracted from the chromosome held by the library
+    from ndcctools.taskvine.utils import load_variable_from_library
+    import individuals
+    import instrument
+    stats = instrument.JobStats("individuals", transport="library", prefilter=bool(siftfile))
+    stats.set(args=[c, counter, stop, total])
+    individuals.extract(load_variable_from_library("rawdata"), load_variable_from_library("columndata"),
+                        c, counter, stop, total, stats, siftfile)
+    return stats.emit()
+
+
+def record_outputs(t, db, records):
+    # The outputs of the successful tasks are recorded in the manifest (manifest.py)
+    if db and t.id in records and t.successful():
+        key, stage, name, outputs = records.pop(t.id)
+        db.record(key, stage, name, outputs, store=False)
+        db.save()
+
+
+def data_path(path):
+    # Compressed VCFs are expanded on the workers
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+
+def strip_ext(name):
+    return name.replace(".tar.gz", "").replace(".txt", "").replace(".npz", "")
+
+
+def add_tree_merges(workflow, fanin):
+    # Merges of more than fanin archives first merge groups of fanin consecutive archives,
+    # returns {partial merge task: name of the archive it writes}
+    renames = {}
+    for name, task in list(workflow.tasks.items()):
+        if task.stage != "individuals_merge" or not fanin or len(task.inputs) <= fanin:
+            continue
+        c = task.args[0]
+        options = task.args[1 + len(task.inputs):]
+        parts = []
+        for k in range(0, len(task.inputs), fanin):
+            group = task.inputs[k:k + fanin]
+            part = f"chr{c}n-part{len(parts)}.tar.gz"
+            workflow.add_task(local_genomes.Task(
+                f"{name}-part{len(parts)}", "individuals_merge",
+                args=[c] + group, inputs=group, outputs=[part]))
+            renames[f"{name}-part{len(parts)}"] = f"chr{c}n.tar.gz"
+            parts.append(part)
+        task.args = [c] + parts + options
+        task.inputs = parts
+
+    for task in workflow.tasks.values():
+        task.deps = {workflow.producers[i] for i in task.inputs if i in workflow.producers}
+    return renames
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -42,99 +149,316 @@ if __name__ == "__main__":
         help="maximum number of concurrent peer transfers",
         default=3,
     )
+    parser.add_argument(
+        "--max-file-transfers",
+        nargs="?",
+        type=int,
+        help="maximum number of concurrent transfers of the same file (e.g. a chromosome VCF) from one source.",
+        default=None,
+    )
+    parser.add_argument(
+        "--datafile",
+        nargs="?",
+        type=str,
+        help="data file with the chromosome VCFs, their number of lines and their annotations.",
+        default="data.csv",
+    )
+    parser.add_argument(
+        "--dataset",
+        nargs="?",
+        type=str,
+        help="dataset folder.",
+        default="20130502",
+    )
+    parser.add_argument(
+        "--src-path",
+        nargs="?",
+        type=str,
+        help="source directory with bin/ and data/ (default: directory of this script).",
+        default=None,
+    )
+    parser.add_argument(
+        "--output-dir",
+        nargs="?",
+        type=str,
+        help="directory for the analysis outputs.",
+        default="output",
+    )
+    parser.add_argument(
+        "--individuals-jobs",
+        nargs="?",
+        type=int,
+        help="number of individuals tasks per chromosome.",
+        default=2500,
+    )
+    parser.add_argument(
+        "--target-runtime",
+        nargs="?",
+        type=float,
+        help="pick the number of individuals tasks so each one runs for about this many seconds (overrides --individuals-jobs).",
+        default=None,
+    )
+    parser.add_argument(
+        "--calibration",
+        nargs="?",
+        type=str,
+        help="timing records of previous runs (JSON lines) used to calibrate --target-runtime.",
+        default=None,
+    )
+    parser.add_argument(
+        "--cores",
+        nargs="?",
+        type=int,
+        help="number of cores expected among the workers, used with --target-runtime.",
+        default=1,
+    )
+    parser.add_argument(
+        "--merge-fanin",
+        nargs="?",
+        type=int,
+        help="merge the individuals archives by groups of this size as soon as a group is done, then merge the groups (0: one merge per chromosome).",
+        default=0,
+    )
+    parser.add_argument(
+        "--sift-prefilter",
+        action="store_true",
+        help="individuals tasks only extract the variants with a SIFT score (they wait for sifting).",
+        default=False,
+    )
+    parser.add_argument(
+        "--variant-matrix",
+        action="store_true",
+        help="merge each chromosome into a sparse matrix (chr<c>n.npz) read by the analysis tasks.",
+        default=False,
+    )
+    parser.add_argument(
+        "--function-calls",
+        action="store_true",
+        help="run the individuals chunks as function calls of a library per chromosome holding its VCF in memory.",
+        default=False,
+    )
+    parser.add_argument(
+        "--library-slots",
+        nargs="?",
+        type=int,
+        help="number of concurrent function calls (and cores) of each individuals library.",
+        default=4,
+    )
+    parser.add_argument(
+        "--stats-dir",
+        nargs="?",
+        type=str,
+        help="directory where the output of every task is saved, with its timing and resource records.",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        type=str,
+        choices=["cprofile", "py-spy"],
+        help="profile every task, the profiles are written to --stats-dir (or the current directory).",
+        default=None,
+    )
+    parser.add_argument(
+        "--manifest",
+        nargs="?",
+        type=str,
+        help="manifest of the previous runs (manifest.py): only run the tasks whose inputs or code changed.",
+        default=None,
+    )
     args = parser.parse_args()
 
+    if args.stats_dir:
+        os.makedirs(args.stats_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    workflow = local_genomes.LocalWorkflow(
+        datafile=args.datafile,
+        dataset=args.dataset,
+        ind_jobs=args.individuals_jobs,
+        src_path=args.src_path,
+        target_runtime=args.target_runtime,
+        cores=args.cores,
+        calibration=args.calibration,
+        sift_prefilter=args.sift_prefilter,
+        variant_matrix=args.variant_matrix,
+    )
+    workflow.create_workflow()
+    renames = add_tree_merges(workflow, args.merge_fanin)
+
     m = vine.Manager(port=args.port)
     m.set_name(args.name)
 
     if args.disable_peer_transfers:
         m.disable_peer_transfers()
-    
+
     if args.max_concurrent_transfers:
         m.tune("worker-source-max-transfers", args.max_concurrent_transfers)
 
-    print("Declaring individuals tasks...")
-
-    tarname = "ALL.chr1.250000.vcf.gz"
-    input_tar = m.declare_file(tarname, cache="always")
-    individuals = m.declare_file("bin/individuals.py", cache="always")
-    columns = m.declare_file("columns.txt", cache="always")
-
-    c = 1
-    total = 250000
-    n_workers = 2500
-    t_per_worker = 100
-    domain = range(1, 275000, 100)
-
-    individuals_outputs = []
-    individuals_outnames = []
-
-    for i in range(n_workers):
-        input_data = f"ALL.chr{c}.250000.vcf"
-        start = domain[i]
-        stop = domain[i+1] - 1
-
-        outfile = m.declare_temp()
-        outname = f"chr{c}n-{start}-{stop}.tar.gz"
-        individuals_outputs.append(outfile)
-        individuals_outnames.append(outname)
-
-        t = vine.Task(
-            command=f"gunzip -f {tarname}; python3 individuals.py {input_data} {c} {start} {stop} {total}",
-            inputs={
-                individuals: {"remote_name": "individuals.py"},
-                input_tar: {"remote_name": f"{tarname}"},
-                columns: {"remote_name": "columns.txt"},
-            },
-            outputs={
-                outfile: {"remote_name":f"chr{c}n-{start}-{stop}.tar.gz"},
-            },
-            cores=1,
-        )
-
-        task_id = m.submit(t)
-        print(f"submitted task {t.id}: {t.command}")
-
-    print("Waiting for individuals tasks to complete...")
-    while not m.empty():
-        t = m.wait(5)
-        if t:
-            if t.completed():
-                print(
-                    f"task {t.id} completed with an execution error,  {t.std_output}"
-                )
+    if args.max_file_transfers:
+        m.tune("file-source-max-transfers", args.max_file_transfers)
+
+    # The scripts profile themselves when JOB_PROFILE is set (bin/profiling.py)
+    profile_env = f"JOB_PROFILE={args.profile} " if args.profile else ""
+    profile_ext = ".prof" if args.profile == "cprofile" else ".collapsed"
+
+    scripts = {stage: m.declare_file(os.path.join(workflow.bin_dir, f"{stage}.py"), cache="always")
+               for stage in local_genomes.STAGES}
+    helpers = {name: m.declare_file(os.path.join(workflow.bin_dir, name), cache="always") for name in HELPERS}
+
+    # Incremental re-runs: the keys of the tasks hash their inputs and code (manifest.py)
+    db = manifest.Manifest(args.manifest) if args.manifest else None
+    keys = {}
+    records = {}
+    if db:
+        planner = manifest.Planner(db)
+        for name, task in workflow.tasks.items():
+            planner.add(name, task.stage, task.args, os.path.join(workflow.bin_dir, task.stage + ".py"),
+                        {os.path.basename(i): data_path(i) for i in task.inputs}, task.outputs)
+        keys = planner.keys()
+        # The intermediate files are kept for the next runs
+        outputs_dir = os.path.splitext(db.filename)[0] + ".outputs"
+        os.makedirs(outputs_dir, exist_ok=True)
+
+    # vine files of the outputs, and where the ones kept on the manager are written
+    files = {}
+    paths = {}
+    done = set()
+    for name, task in workflow.tasks.items():
+        entry = db.lookup(keys[name]) if db else None
+        if entry:
+            for out in task.outputs:
+                files[out] = m.declare_file(entry["outputs"][out]["path"], cache="always")
+                target = os.path.join(args.output_dir, out)
+                if task.final and os.path.abspath(target) != entry["outputs"][out]["path"]:
+                    shutil.copy(entry["outputs"][out]["path"], target)
+            done.add(name)
+            continue
+        for out in task.outputs:
+            if task.final:
+                paths[out] = os.path.join(args.output_dir, out)
+            elif db:
+                paths[out] = os.path.join(outputs_dir, out)
+            if out in paths:
+                files[out] = m.declare_file(paths[out], cache="always")
             else:
-                print(f"task {t.id} failed with status {t.result}")
+                files[out] = m.declare_temp()
+    if db:
+        print(f"{len(done)} tasks up to date in {db.filename}, {len(workflow.tasks) - len(done)} to run")
+
+    inputs = {}
 
-    print("Individual tasks complete!")
+    def declare_input(path):
+        # Data files are sent once to every worker
+        if path in workflow.producers:
+            return files[path], os.path.basename(path)
+        path = data_path(path)
+        if path not in inputs:
+            f = m.declare_file(path, cache="always")
+            remote = os.path.basename(path)
+            if remote.endswith(".gz") and not remote.endswith(".tar.gz"):
+                # Decompressed once per worker, peers only transfer the compressed file
+                remote = remote[:-3]
+                unpack = vine.Task(f"gunzip -c {remote}.gz > {remote}")
+                unpack.add_input(f, f"{remote}.gz")
+                f = m.declare_minitask(unpack, remote, cache="always", peer_transfer=False)
+            inputs[path] = (f, remote)
+        return inputs[path]
 
-    print("Declaring individual_merge task")
+    # Individuals libraries, installed on the workers before the first function call
+    libraries = set()
+    if args.function_calls:
+        if args.profile:
+            print("WARNING: the individuals function calls are not profiled")
+        for name, task in workflow.tasks.items():
+            c = task.args[1]
+            if task.stage != "individuals" or name in done or c in libraries:
+                continue
+            vcf, columns = (declare_input(path) for path in task.inputs[:2])
+            library = m.create_library_from_functions(
+                f"individuals-chr{c}", individuals_chunk,
+                library_context_info=[load_chromosome, [vcf[1], columns[1]], {}], add_env=False)
+            library.add_input(vcf[0], vcf[1])
+            library.add_input(columns[0], columns[1])
+            library.add_input(scripts["individuals"], "individuals.py")
+            for helper, f in helpers.items():
+                library.add_input(f, helper)
+            library.set_cores(args.library_slots)
+            library.set_function_slots(args.library_slots)
+            m.install_library(library)
+            libraries.add(c)
 
-    individuals_merge = m.declare_file("bin/individuals_merge.py")
-    merged_output = m.declare_file(f"chr{c}n.tar.gz")
+    def function_call(task):
+        vcf, c, counter, stop, total = task.args[:5]
+        siftfile = task.args[6] if "--sift-file" in task.args else None
+        t = vine.FunctionCall(f"individuals-chr{c}", "individuals_chunk", c, counter, stop, total, siftfile)
+        if siftfile:
+            t.add_input(files[siftfile], siftfile)
+        for out in task.outputs:
+            t.add_output(files[out], out)
+        return t, f"individuals_chunk({c}, {counter}, {stop}, {total})"
 
-    t = vine.Task(command=f"python3 individuals_merge.py {c} {' '.join(individuals_outnames)}")
-    for f,n in zip(individuals_outputs, individuals_outnames):
-        t.add_input(f, n)
+    def submit(name):
+        task = workflow.tasks[name]
+        if task.stage == "individuals" and args.function_calls:
+            t, description = function_call(task)
+            submit_task(name, task, t, description)
+            return
 
-    t.add_input(individuals_merge, "individuals_merge.py")
-    t.add_output(merged_output, f"chr{c}n.tar.gz")
+        declared = [declare_input(path) for path in task.inputs]
+        command = f"{profile_env}python3 {task.stage}.py {' '.join(task.args)}"
+        if name in renames:
+            # Partial merges write chr<c>n.tar.gz like the final merge
+            command += f" && mv {renames[name]} {task.outputs[0]}"
 
-    task_id = m.submit(t)
-    
-    print("Waiting for merge task to complete...")
-    while not m.empty():
+        t = vine.Task(command=command, cores=1)
+        t.add_input(scripts[task.stage], f"{task.stage}.py")
+        for helper, f in helpers.items():
+            t.add_input(f, helper)
+        for f, remote in declared:
+            t.add_input(f, remote)
+        for out in task.outputs:
+            t.add_output(files[out], out)
+        if args.profile:
+            natural = renames.get(name, task.outputs[0])
+            remote = f"{task.stage}.{strip_ext(natural)}{profile_ext}"
+            local = f"{task.stage}.{strip_ext(task.outputs[0])}{profile_ext}"
+            t.add_output(m.declare_file(os.path.join(args.stats_dir or ".", local)), remote)
+        submit_task(name, task, t, command)
+
+    def submit_task(name, task, t, description):
+        m.submit(t)
+        if db:
+            records[t.id] = (keys[name], task.stage, name, {out: os.path.abspath(paths[out]) for out in task.outputs})
+        running[t.id] = name
+        print(f"submitted task {t.id} ({name}): {description}")
+
+    # Tasks are submitted in creation order as soon as the tasks they depend on are done
+    ready = local_genomes.ReadyTasks(workflow.tasks, done)
+    running = {}
+
+    def submit_ready():
+        name = ready.pop()
+        while name is not None:
+            submit(name)
+            name = ready.pop()
+
+    submit_ready()
+    while ready.pending or running:
         t = m.wait(5)
-        if t:
-            if t.successful:
-                print(f"task {t.id} succeeded with {t.std_output}")
-            elif t.completed():
-                print(
-                    f"task {t.id} completed with an execution error,  {t.std_output}"
-                )
-            else:
-                print(f"task {t.id} failed with status {t.result} {t.std_output}")
-    
+        if not t:
+            continue
+        name = running.pop(t.id)
+        save_output(t, args.stats_dir)
+        record_outputs(t, db, records)
+        if not t.successful():
+            print(f"task {t.id} ({name}) failed with status {t.result}: {t.std_output}")
+            sys.exit(1)
+        done.add(name)
+        print(f"task {t.id} ({name}) done ({len(done)}/{len(workflow.tasks)})")
+        ready.release(name)
+        submit_ready()
+
     print("all tasks complete!")
 
 